@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Offline benchmarks of each part of the symbolication engine, on synthetic
+symbol files (from tiny to about the size of xul.sym) and synthetic v4
+and v5 request payloads:
+
+    * parse      - parsing a .sym file (tecken.symbolicate.symparser)
+    * pack       - packing the parsed offsets and names into a symbol table
+    * memory     - the peak memory allocated while parsing and packing
+    * store      - writing the packed symbol table into Redis
+    * fetch      - reading it back out of Redis, as one MGET
+    * resolve    - looking up every frame of a request in the symbol tables
+    * json-load  - parsing the JSON of a request
+    * json-dump  - serializing the JSON of a response
+
+Nothing needs the network. The store and fetch benchmarks use fakeredis,
+if it's installed, or whatever Redis --redis-url points at. Without
+either they're skipped.
+
+To compare a change, save a baseline before it and compare with it after:
+
+    $ python bin/benchmark-symbolication.py --save master
+    $ git checkout my-branch
+    $ python bin/benchmark-symbolication.py --compare master
+
+Baselines are saved as JSON files in .benchmarks/symbolication/.
+"""
+
+import argparse
+import importlib.util
+import json
+import platform
+import random
+import statistics
+import time
+import tracemalloc
+from pathlib import Path
+
+import ujson
+
+ROOT = Path(__file__).parent.parent
+BASELINES_DIR = ROOT / ".benchmarks" / "symbolication"
+
+
+def load_module(name, path):
+    # Load the modules straight from their files so that this doesn't need
+    # Django (which importing the 'tecken' package would require).
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+symparser = load_module("symparser", ROOT / "tecken/symbolicate/symparser.py")
+symboltable = load_module("symboltable", ROOT / "tecken/symbolicate/symboltable.py")
+# The synthetic .sym files are the same as the ones benchmark-symparser.py
+# uses.
+make_symbol_file = load_module(
+    "benchmark_symparser", ROOT / "bin/benchmark-symparser.py"
+).make_symbol_file
+
+CHUNK_SIZE = 64 * 1024
+# Same as tecken.symbolicate.views.STORE_CHUNK_SIZE.
+STORE_CHUNK_SIZE = 5 * 1024 * 1024
+
+# Name -> (funcs, lines_per_func, publics). "xul" is about the size of a
+# real xul.sym.
+SIZES = {
+    "small": (1_000, 10, 200),
+    "medium": (30_000, 20, 5_000),
+    "xul": (300_000, 30, 50_000),
+}
+
+# Name -> (version, jobs, stacks per job, frames per stack). "v5-batch" is
+# like a batch of crash pings and "v4" like a single profile.
+PAYLOADS = {"v4": (4, 1, 20, 200), "v5": (5, 1, 10, 50), "v5-batch": (5, 100, 1, 40)}
+
+
+def chunked(data):
+    for i in range(0, len(data), CHUNK_SIZE):
+        yield data[i : i + CHUNK_SIZE]  # noqa
+
+
+def measure(function, repeat):
+    """Return the median number of seconds of calling 'function' and
+    what it returned."""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times), result
+
+
+def measure_memory(function):
+    """Return the peak number of bytes allocated, by Python, while calling
+    'function'. Only what's allocated during the call counts."""
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def parse(data):
+    """Parse a .sym file the way
+    tecken.symbolicate.views.SymbolicateJSON.load_symbol does."""
+    parser = symparser.SymbolFileParser()
+    for chunk in chunked(data):
+        parser.feed(chunk)
+    return parser.close_index()
+
+
+def get_redis(redis_url):
+    if redis_url:
+        import redis
+
+        return redis.StrictRedis.from_url(redis_url)
+    try:
+        import fakeredis
+    except ImportError:
+        return None
+    return fakeredis.FakeStrictRedis()
+
+
+def store_buffer(connection, key, buffer):
+    """Write a packed symbol table the way
+    tecken.symbolicate.views.SymbolicateJSON._store_symbol_table does."""
+    pipeline = connection.pipeline(transaction=False)
+    if len(buffer) <= STORE_CHUNK_SIZE:
+        pipeline.set(key, buffer)
+    else:
+        temporary_key = key + ":tmp"
+        pipeline.delete(temporary_key)
+        for start in range(0, len(buffer), STORE_CHUNK_SIZE):
+            end = start + STORE_CHUNK_SIZE
+            pipeline.append(temporary_key, buffer[start:end])
+        pipeline.rename(temporary_key, key)
+    pipeline.execute()
+
+
+def make_payload(version, jobs, stacks, frames, symbol_tables):
+    """Return a request payload whose frames are spread over all the
+    modules and land somewhere inside their functions."""
+    random.seed(version * jobs * stacks * frames)
+    memory_map = [[name, "DEBUGID%d" % i] for i, name in enumerate(symbol_tables)]
+    tables = list(symbol_tables.values())
+
+    def make_stack():
+        stack = []
+        for _ in range(frames):
+            module_index = random.randrange(len(tables))
+            offsets = tables[module_index].offsets
+            offset = offsets[random.randrange(len(offsets))] + random.randint(0, 8)
+            stack.append([module_index, offset])
+        return stack
+
+    job_list = [
+        {"memoryMap": memory_map, "stacks": [make_stack() for _ in range(stacks)]}
+        for _ in range(jobs)
+    ]
+    if version == 4:
+        job, = job_list
+        return dict(job, version=4)
+    return {"jobs": job_list}
+
+
+def resolve(payload, symbol_tables):
+    """Return the v5-shaped result of all the jobs of the payload. Like
+    SymbolicateJSON.symbolicate_jobs(), every offset of a module is
+    looked up in one go."""
+    jobs = payload["jobs"] if "jobs" in payload else [payload]
+    offsets_per_module = {}
+    for job in jobs:
+        for stack in job["stacks"]:
+            for module_index, module_offset in stack:
+                module = job["memoryMap"][module_index][0]
+                offsets_per_module.setdefault(module, []).append(module_offset)
+    nearest_per_module = {
+        module: symbol_tables[module].lookup_many(offsets)
+        for module, offsets in offsets_per_module.items()
+    }
+    results = []
+    for job in jobs:
+        result_stacks = []
+        for stack in job["stacks"]:
+            frames = []
+            for j, (module_index, module_offset) in enumerate(stack):
+                module = job["memoryMap"][module_index][0]
+                frame = {
+                    "module_offset": hex(module_offset),
+                    "module": module,
+                    "frame": j,
+                }
+                nearest = nearest_per_module[module].get(module_offset)
+                if nearest is not None:
+                    function_start, function = nearest
+                    frame["function"] = function
+                    frame["function_offset"] = hex(module_offset - function_start)
+                frames.append(frame)
+            result_stacks.append(frames)
+        results.append({"stacks": result_stacks})
+    return {"results": results}
+
+
+def run(sizes, payloads, repeat, redis_url):
+    """Return a tuple of a dict of benchmark name -> median seconds and a
+    dict of benchmark name -> peak bytes allocated."""
+    results = {}
+    memory = {}
+
+    def report(name, seconds, note=""):
+        results[name] = seconds
+        print(f"{name:<28} {seconds * 1000:>10.2f}ms  {note}")
+
+    def report_memory(name, size):
+        memory[name] = size
+        print(f"{name:<28} {size / 1024 / 1024:>10.2f}MB")
+
+    connection = get_redis(redis_url)
+    if connection is None:
+        print("No fakeredis installed and no --redis-url. Skipping store/fetch.\n")
+
+    packed = {}
+    for size in sizes:
+        data = make_symbol_file(*SIZES[size])
+        megabytes = len(data) / 1024 / 1024
+        seconds, (offsets, index, names) = measure(lambda: parse(data), repeat)
+        throughput = megabytes / seconds
+        report(f"parse/{size}", seconds, f"{megabytes:.1f}MB, {throughput:.1f}MB/s")
+        seconds, buffer = measure(
+            lambda: symboltable.pack_symbol_table_from_index(offsets, index, names),
+            repeat,
+        )
+        report(f"pack/{size}", seconds, f"{len(offsets):,} symbols")
+        packed[size] = buffer
+        report_memory(
+            f"memory/{size}",
+            measure_memory(
+                lambda: symboltable.pack_symbol_table_from_index(*parse(data))
+            ),
+        )
+
+        if connection is not None:
+            key = f"benchmark:symbolication:{size}"
+            seconds, _ = measure(lambda: store_buffer(connection, key, buffer), repeat)
+            report(f"store/{size}", seconds, f"{len(buffer) / 1024 / 1024:.1f}MB")
+            seconds, _ = measure(
+                lambda: symboltable.SymbolTable(connection.mget([key])[0]), repeat
+            )
+            report(f"fetch/{size}", seconds)
+            connection.delete(key)
+
+    symbol_tables = {
+        f"{size}.pdb": symboltable.SymbolTable(buffer)
+        for size, buffer in packed.items()
+    }
+    for name in payloads:
+        payload = make_payload(*PAYLOADS[name], symbol_tables)
+        body = ujson.dumps(payload)
+        seconds, _ = measure(lambda: ujson.loads(body), repeat)
+        report(f"json-load/{name}", seconds, f"{len(body) / 1024:.0f}KB")
+        seconds, result = measure(lambda: resolve(payload, symbol_tables), repeat)
+        frames = sum(len(x) for job in result["results"] for x in job["stacks"])
+        report(f"resolve/{name}", seconds, f"{frames:,} frames")
+        seconds, _ = measure(lambda: ujson.dumps(result), repeat)
+        report(f"json-dump/{name}", seconds)
+    return results, memory
+
+
+def save(name, results, memory):
+    BASELINES_DIR.mkdir(parents=True, exist_ok=True)
+    path = BASELINES_DIR / f"{name}.json"
+    baseline = {
+        "python": platform.python_version(),
+        "results": results,
+        "memory": memory,
+    }
+    path.write_text(json.dumps(baseline, indent=2, sort_keys=True))
+    print(f"\nSaved baseline {path}")
+
+
+def compare(name, results, memory):
+    path = BASELINES_DIR / f"{name}.json"
+    saved = json.loads(path.read_text())
+    baseline = saved["results"]
+    print(f"\nCompared to {path}:")
+    for key, seconds in results.items():
+        if key not in baseline:
+            continue
+        before = baseline[key]
+        change = (seconds - before) / before * 100 if before else 0.0
+        print(
+            f"{key:<28} {before * 1000:>10.2f}ms -> {seconds * 1000:>10.2f}ms  "
+            f"{change:+.1f}%"
+        )
+    # Baselines saved before memory was measured don't have any.
+    baseline = saved.get("memory", {})
+    for key, size in memory.items():
+        if key not in baseline:
+            continue
+        before = baseline[key]
+        change = (size - before) / before * 100 if before else 0.0
+        print(
+            f"{key:<28} {before / 1024 / 1024:>10.2f}MB -> "
+            f"{size / 1024 / 1024:>10.2f}MB  {change:+.1f}%"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES))
+    parser.add_argument(
+        "--payloads", nargs="+", choices=list(PAYLOADS), default=list(PAYLOADS)
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--redis-url", help="e.g. redis://localhost:6379/15 (default is fakeredis)"
+    )
+    parser.add_argument("--save", metavar="NAME", help="save the results as NAME")
+    parser.add_argument("--compare", metavar="NAME", help="compare with baseline NAME")
+    args = parser.parse_args()
+    results, memory = run(args.sizes, args.payloads, args.repeat, args.redis_url)
+    if args.compare:
+        compare(args.compare, results, memory)
+    if args.save:
+        save(args.save, results, memory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Micro-benchmark of tecken.symbolicate.symparser compared to the old way of
+parsing .sym files line by line.
+
+Run it on real symbol files:
+
+    $ python bin/benchmark-symparser.py ~/Downloads/xul.sym
+
+...or, without any arguments, on a synthetic file about the size of xul.sym
+(see --help for how to tweak that).
+"""
+
+import argparse
+import importlib.util
+import os
+import random
+import statistics
+import time
+from io import BytesIO
+from pathlib import Path
+
+# Load the parser module straight from its file so that this doesn't need
+# Django (which importing the 'tecken' package would require).
+_path = Path(__file__).parent.parent / "tecken" / "symbolicate" / "symparser.py"
+_spec = importlib.util.spec_from_file_location("symparser", _path)
+symparser = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(symparser)
+
+CHUNK_SIZE = 64 * 1024
+
+
+def make_symbol_file(funcs, lines_per_func, publics):
+    """Return bytes that look like a Breakpad .sym file with roughly the
+    same mix of records as a real xul.sym."""
+    random.seed(funcs)
+    out = BytesIO()
+    out.write(b"MODULE windows x86 44E4EC8C2F41492B9369D6B9A059577C2 xul.pdb\n")
+    out.write(b"INFO CODE_ID 54AF957E1B34000 xul.dll\n")
+    for i in range(funcs // 10):
+        out.write(b"FILE %d c:/builds/moz2_slave/m-cen/build/src/file%d.cpp\n" % (i, i))
+    address = 0x1000
+    for i in range(funcs):
+        size = random.randint(0x10, 0x400)
+        name = "mozilla::dom::SomeClass%d::SomeMethod(nsIFoo*, unsigned int)" % i
+        out.write(b"FUNC %x %x 0 %s\n" % (address, size, name.encode("utf-8")))
+        for j in range(lines_per_func):
+            out.write(b"%x %x %d %d\n" % (address + j * 4, 4, 100 + j, i % 1000))
+        address += size
+    for i in range(publics):
+        out.write(b"PUBLIC %x 0 _ZN7mozilla3dom5Thing%dEv\n" % (address, i))
+        address += 0x10
+    for i in range(funcs // 4):
+        out.write(b"STACK WIN 4 %x 13 4 0 0 0 0 0 1\n" % (0x1000 + i * 16))
+    return out.getvalue()
+
+
+def chunked(data):
+    for i in range(0, len(data), CHUNK_SIZE):
+        yield data[i : i + CHUNK_SIZE]  # noqa
+
+
+def parse_legacy(data):
+    """How SymbolicateJSON.load_symbol() used to do it. Every line is
+    decoded and split before it's known whether it's interesting."""
+    public_symbols = {}
+    func_symbols = {}
+    pending = b""
+    for chunk in chunked(data):
+        lines = (pending + chunk).splitlines()
+        pending = lines.pop() if not chunk.endswith(b"\n") else b""
+        for line in lines:
+            line = line.decode("utf-8")
+            if "FUNC " in line or "PUBLIC " in line:
+                prefix, rest = line.split(None, 1)
+                if prefix not in ("FUNC", "PUBLIC"):
+                    continue
+                if rest.startswith("m "):
+                    rest = rest[2:]
+            else:
+                continue
+            if prefix == "PUBLIC":
+                fields = rest.strip().split(None, 2)
+                if len(fields) != 3:
+                    continue
+                public_symbols[int(fields[0], 16)] = fields[2]
+            else:
+                fields = rest.strip().split(None, 3)
+                if len(fields) != 4:
+                    continue
+                func_symbols[int(fields[0], 16)] = fields[3]
+    func_symbols.update(public_symbols)
+    return func_symbols
+
+
+def parse_new(data):
+    offsets, names, _ = symparser.parse_symbol_file(chunked(data))
+    return offsets, names
+
+
+def benchmark(name, function, data, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = function(data)
+        times.append(time.perf_counter() - t0)
+    median = statistics.median(times)
+    print(
+        f"{name:<10} median {median:.3f}s  best {min(times):.3f}s  "
+        f"({len(data) / median / 1024 / 1024:.1f}MB/s)"
+    )
+    return result, median
+
+
+def run(files, funcs, lines_per_func, publics, repeat):
+    if files:
+        inputs = [(os.path.basename(fn), Path(fn).read_bytes()) for fn in files]
+    else:
+        inputs = [("synthetic", make_symbol_file(funcs, lines_per_func, publics))]
+
+    for name, data in inputs:
+        print(f"{name}: {len(data) / 1024 / 1024:.1f}MB")
+        legacy, legacy_time = benchmark("legacy", parse_legacy, data, repeat)
+        (offsets, names), new_time = benchmark("symparser", parse_new, data, repeat)
+        assert list(offsets) == sorted(legacy), "Different offsets!"
+        assert [x.decode("utf-8") for x in names] == [
+            legacy[x] for x in offsets
+        ], "Different names!"
+        print(f"{len(offsets):,} symbols. {legacy_time / new_time:.1f}x faster\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("files", nargs="*", help="real .sym files to parse")
+    parser.add_argument("--funcs", type=int, default=300_000)
+    parser.add_argument("--lines-per-func", type=int, default=30)
+    parser.add_argument("--publics", type=int, default=50_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run(args.files, args.funcs, args.lines_per_func, args.publics, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -43,6 +43,12 @@ urlpatterns = [
     path("_users/user/<int:id>", views.edit_user, name="edit_user"),
     path("_settings/", views.current_settings, name="current_settings"),
     path("_versions/", views.current_versions, name="current_versions"),
+    path("_symbolicate/pinned/", views.symbolicate_pinned, name="symbolicate_pinned"),
+    path(
+        "_symboldownloader/sources/",
+        views.symboldownloader_sources,
+        name="symboldownloader_sources",
+    ),
     path("downloads/missing/", views.downloads_missing, name="downloads_missing"),
     path("downloads/microsoft/", views.downloads_microsoft, name="downloads_microsoft"),
 ]
@@ -28,7 +28,9 @@ from tecken.tokens.models import Token
 from tecken.upload.models import Upload, FileUpload, UploadsCreated
 from tecken.upload.views import get_possible_bucket_urls
 from tecken.storage import StorageBucket
+from tecken.download import views as download_views
 from tecken.download.models import MissingSymbol, MicrosoftDownload
+from tecken.symbolicate.pinned import get_pinned_symbol_tables
 from tecken.symbolicate.views import get_symbolication_count_key
 from tecken.base.decorators import (
     api_login_required,
@@ -36,6 +38,7 @@ from tecken.base.decorators import (
     api_require_http_methods,
     api_superuser_required,
 )
+from tecken.base.sourcestats import get_source_key, source_stats
 from tecken.base.utils import filesizeformat
 from . import forms
 
@@ -1186,6 +1189,56 @@ def current_versions(request):
     return http.JsonResponse(context)
 
 
+@api_login_required
+@api_superuser_required
+def symbolicate_pinned(request):
+    """return a JSON dict of the patterns of modules that are pinned and
+    every symbol table that is pinned, with its size."""
+    symbol_tables = get_pinned_symbol_tables()
+    context = {
+        "patterns": settings.SYMBOLICATE_PINNED_MODULES,
+        "symbol_tables": symbol_tables,
+        "total": {
+            "count": len(symbol_tables),
+            "size": sum(x["size"] for x in symbol_tables),
+        },
+    }
+    return http.JsonResponse(context)
+
+
+@api_login_required
+@api_superuser_required
+def symboldownloader_sources(request):
+    """return a JSON dict of, for the downloaders of regular and of Try
+    symbols, the statistics of every source and the order they're looked
+    in."""
+
+    def describe(downloader):
+        sources = downloader.sources
+        stats = source_stats.get_stats(sources, refresh=True)
+        if settings.SYMBOLDOWNLOAD_ADAPTIVE_ORDERING:
+            order = source_stats.get_order(sources)
+        else:
+            order = range(len(sources))
+        return {
+            "sources": [
+                dict(stats[get_source_key(source)], url=get_source_key(source))
+                for source in sources
+            ],
+            "order": [get_source_key(sources[i]) for i in order],
+        }
+
+    context = {
+        "adaptive_ordering": settings.SYMBOLDOWNLOAD_ADAPTIVE_ORDERING,
+        "parallel_probing": settings.SYMBOLDOWNLOAD_PARALLEL_PROBING,
+        "downloaders": {
+            "regular": describe(download_views.normal_downloader),
+            "try": describe(download_views.try_downloader),
+        },
+    }
+    return http.JsonResponse(context)
+
+
 @metrics.timer_decorator("api", tags=["endpoint:downloads_missing"])
 def downloads_missing(request):
     context = {}
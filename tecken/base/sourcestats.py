@@ -0,0 +1,149 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+How often, and how fast, every symbol source (see
+tecken.base.symboldownloader) has had the symbols it was asked for.
+
+Every web worker counts the hits, misses and total lookup time, per
+source, in memory and every FLUSH_INTERVAL_SECONDS adds them to counters,
+in the default cache, of the current window of WINDOW_SECONDS. The
+statistics are the sum of the last WINDOWS windows. So they're shared by
+all web workers and roll over.
+"""
+
+import threading
+import time
+
+from django.core.cache import cache
+
+from tecken.storage import scrub_credentials
+
+
+# Each window is an hour and the statistics are of the last 24 of them.
+WINDOW_SECONDS = 60 * 60
+WINDOWS = 24
+
+# How often the counts of a web worker are added to the shared ones.
+FLUSH_INTERVAL_SECONDS = 10
+
+# How long the shared statistics are used before they're read again.
+STATS_TTL_SECONDS = 60
+
+# How many lookups a source needs before its hit rate is trusted.
+MIN_LOOKUPS = 100
+
+COUNTERS = ("hits", "misses", "ms")
+
+
+def get_source_key(source):
+    """Return the name of a StorageBucket in the statistics. The base URL
+    and the prefix, without any credentials."""
+    return scrub_credentials(f"{source.base_url}/{source.prefix}")
+
+
+def _make_cache_key(window, source_key, counter):
+    return f"sourcestats:{window}:{source_key}:{counter}"
+
+
+class SourceStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Source key -> {counter: count} not yet added to the shared ones.
+        self._pending = {}
+        self._last_flush = time.time()
+        # Tuple of source keys -> (when, stats).
+        self._stats = {}
+
+    def record(self, source, found, seconds):
+        """Count one lookup of a symbol in this source."""
+        key = get_source_key(source)
+        with self._lock:
+            counts = self._pending.setdefault(key, dict.fromkeys(COUNTERS, 0))
+            counts["hits" if found else "misses"] += 1
+            counts["ms"] += int(seconds * 1000)
+            flush = time.time() - self._last_flush >= FLUSH_INTERVAL_SECONDS
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Add all the counts, of this process, to the shared ones."""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._last_flush = time.time()
+        window = int(time.time() // WINDOW_SECONDS)
+        timeout = WINDOW_SECONDS * (WINDOWS + 1)
+        for source_key, counts in pending.items():
+            for counter, count in counts.items():
+                if not count:
+                    continue
+                cache_key = _make_cache_key(window, source_key, counter)
+                try:
+                    cache.incr(cache_key, count)
+                except ValueError:
+                    # First in this window. If some other process beat us to
+                    # it, add to theirs.
+                    if not cache.add(cache_key, count, timeout):
+                        cache.incr(cache_key, count)
+
+    def get_stats(self, sources, refresh=False):
+        """Return a dict of source key -> dict of the number of 'hits' and
+        'misses', the 'hit_rate' and the 'mean_time' (in seconds) of the
+        lookups of each of these sources in the last WINDOWS windows."""
+        source_keys = tuple(get_source_key(source) for source in sources)
+        now = time.time()
+        if not refresh and source_keys in self._stats:
+            read_at, stats = self._stats[source_keys]
+            if now - read_at < STATS_TTL_SECONDS:
+                return stats
+        window = int(now // WINDOW_SECONDS)
+        cache_keys = [
+            _make_cache_key(window - i, source_key, counter)
+            for i in range(WINDOWS)
+            for source_key in source_keys
+            for counter in COUNTERS
+        ]
+        values = cache.get_many(cache_keys)
+        stats = {}
+        for source_key in source_keys:
+            counts = {
+                counter: sum(
+                    values.get(_make_cache_key(window - i, source_key, counter), 0)
+                    for i in range(WINDOWS)
+                )
+                for counter in COUNTERS
+            }
+            lookups = counts["hits"] + counts["misses"]
+            stats[source_key] = {
+                "hits": counts["hits"],
+                "misses": counts["misses"],
+                "hit_rate": counts["hits"] / lookups if lookups else 0.0,
+                "mean_time": counts["ms"] / 1000 / lookups if lookups else 0.0,
+            }
+        self._stats[source_keys] = (now, stats)
+        return stats
+
+    def get_order(self, sources):
+        """Return a list of the indexes of these sources, in the order they
+        should be looked in. That's the highest hit rate first. Sources with
+        too few lookups to tell keep their configured order, after the
+        others."""
+        stats = self.get_stats(sources)
+
+        def sort_key(i):
+            source_stats = stats[get_source_key(sources[i])]
+            if source_stats["hits"] + source_stats["misses"] < MIN_LOOKUPS:
+                return (1, 0.0, i)
+            return (0, -source_stats["hit_rate"], i)
+
+        return sorted(range(len(sources)), key=sort_key)
+
+    def clear(self):
+        with self._lock:
+            self._pending = {}
+            self._stats = {}
+
+
+source_stats = SourceStats()
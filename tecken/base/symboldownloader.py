@@ -2,9 +2,13 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
+import concurrent.futures
+import hashlib
+import tempfile
+import threading
 import time
-from io import BytesIO
-from gzip import GzipFile
+import zlib
+from collections import deque
 from functools import wraps
 
 import logging
@@ -15,14 +19,39 @@ from google.cloud.storage.client import Bucket as google_Bucket
 from cache_memoize import cache_memoize
 
 from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import force_bytes, force_text
 
+from tecken.base.sourcestats import source_stats
+from tecken.base.symbolindex import get_index_id, symbol_index
 from tecken.storage import StorageBucket
 
 
 logger = logging.getLogger("tecken")
 metrics = markus.get_metrics("tecken")
 
-ITER_CHUNK_SIZE = 512
+ITER_CHUNK_SIZE = 64 * 1024
+
+# Makes zlib expect, and check, a gzip header and trailer.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# How many of the most recent lookups, per source, that weren't memoized,
+# the hedge delay is based on. And how many there have to be before anything is hedged.
+HEDGE_LATENCY_SAMPLES = 200
+HEDGE_MIN_SAMPLES = 20
+
+# The most of the time a presigned URL is valid that it's handed out
+# again. So whoever follows a cached redirect to it has time to.
+MAX_PRESIGNED_URL_CACHE_FRACTION = 0.9
+
+_PENDING = object()
+
+# How long the most recent lookup in this thread that actually went to a
+# source, i.e. that wasn't memoized, took. See time_source_call().
+_source_call = threading.local()
+
+_probe_executor = None
+_probe_executor_lock = threading.Lock()
 
 
 class SymbolNotFound(Exception):
@@ -42,10 +71,15 @@ def iter_lines(stream, chunk_size=ITER_CHUNK_SIZE):
 
     .. note:: This method is not reentrant safe.
     """
+    return split_lines(iter(lambda: stream.read(chunk_size), b""))
+
+
+def split_lines(chunks):
+    """Iterates over an iterable of chunks of bytes, one line at a time."""
 
     pending = None
 
-    for chunk in iter(lambda: stream.read(chunk_size), b""):
+    for chunk in chunks:
 
         if pending is not None:
             chunk = pending + chunk
@@ -64,6 +98,61 @@ def iter_lines(stream, chunk_size=ITER_CHUNK_SIZE):
         yield pending
 
 
+def gunzip_chunks(chunks):
+    """Decompress an iterable of chunks of gzip'ed bytes one chunk at a time,
+    yielding chunks of no more than ITER_CHUNK_SIZE bytes. So, unlike
+    decompressing it all first, it doesn't matter how big the file is.
+
+    Raises OSError if it's not gzip'ed at all and EOFError if it ends
+    before the end of the gzip stream, like gzip.GzipFile does. Returns the
+    number of (compressed) bytes read.
+    """
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    compressed_size = 0
+    started = False
+    for chunk in chunks:
+        compressed_size += len(chunk)
+        while chunk:
+            try:
+                data = decompressor.decompress(chunk, ITER_CHUNK_SIZE)
+            except zlib.error as exception:
+                if not started:
+                    raise OSError(f"Not a gzipped file ({exception})")
+                raise
+            started = True
+            if data:
+                yield data
+            if decompressor.eof:
+                # There might be another gzip member after this one.
+                chunk = decompressor.unused_data
+                if chunk:
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+            else:
+                chunk = decompressor.unconsumed_tail
+    data = decompressor.flush()
+    if data:
+        yield data
+    if started and not decompressor.eof:
+        raise EOFError(
+            "Compressed file ended before the end-of-stream marker was reached"
+        )
+    return compressed_size
+
+
+def get_probe_executor():
+    """Return the thread pool, shared by all SymbolDownloaders in this
+    process, that sources are looked in when SYMBOLDOWNLOAD_PARALLEL_PROBING
+    is on."""
+    global _probe_executor
+    with _probe_executor_lock:
+        if _probe_executor is None:
+            _probe_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=settings.SYMBOLDOWNLOAD_PROBE_MAX_WORKERS,
+                thread_name_prefix="symboldownloader-probe",
+            )
+    return _probe_executor
+
+
 def set_time_took(method):
     @wraps(method)
     def wrapper(self, *args, **kwargs):
@@ -76,12 +165,47 @@ def set_time_took(method):
     return wrapper
 
 
+def time_source_call(function):
+    """Remember, per thread, how many seconds calling the function took.
+    For the functions that cache_memoize only calls when it's not
+    memoized."""
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        t0 = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _source_call.seconds = time.time() - t0
+
+    return wrapper
+
+
+def _make_memoize_key(function_name, *args):
+    """Return the same cache key cache_memoize makes by default, for these
+    (rewritten) arguments. Defined here so that SymbolDownloader can look
+    up the keys of many lookups in one go."""
+    cache_key = ":".join(force_text(x) for x in args)
+    return hashlib.md5(
+        force_bytes("cache_memoize" + function_name + cache_key)
+    ).hexdigest()
+
+
+def make_exists_in_source_key(source, key):
+    return _make_memoize_key("exists_in_source", source.name, key)
+
+
+def make_check_url_head_key(source, url):
+    return _make_memoize_key("check_url_head", url)
+
+
 @cache_memoize(
     settings.SYMBOLDOWNLOAD_EXISTS_TTL_SECONDS,
-    args_rewrite=lambda source, key: (source.name, key),
+    key_generator_callable=make_exists_in_source_key,
     hit_callable=lambda *a, **k: metrics.incr("symboldownloader_exists_cache_hit", 1),
     miss_callable=lambda *a, **k: metrics.incr("symboldownloader_exists_cache_miss", 1),
 )
+@time_source_call
 @metrics.timer_decorator("symboldownloader_exists")
 def exists_in_source(source, key):
     """Return a key or URL or something truthy if it exists. False otherwise.
@@ -100,11 +224,13 @@ def exists_in_source(source, key):
         if obj["Key"] == key:
             # It exists!
             return key
+    count_false_positive(source)
     return False
 
 
 @cache_memoize(
     settings.SYMBOLDOWNLOAD_EXISTS_TTL_SECONDS,
+    key_generator_callable=make_check_url_head_key,
     hit_callable=lambda *a, **k: metrics.incr(
         "symboldownloader_public_exists_cache_hit", 1
     ),
@@ -112,9 +238,87 @@ def exists_in_source(source, key):
         "symboldownloader_public_exists_cache_miss", 1
     ),
 )
+@time_source_call
 @metrics.timer_decorator("symboldownloader_public_exists")
-def check_url_head(url):
-    return requests.head(url).status_code == 200
+def check_url_head(source, url):
+    if source.session.head(url).status_code == 200:
+        return True
+    count_false_positive(source)
+    return False
+
+
+def count_false_positive(source):
+    """Count that the symbol index said something might be in this source
+    but it wasn't."""
+    if symbol_index.has_filter(source):
+        metrics.incr(
+            "symbolindex_false_positive", tags=[f"index:{get_index_id(source)}"]
+        )
+
+
+def make_presigned_url_key(bucket_name, key):
+    return (
+        "presigned_url:" + hashlib.md5(force_bytes(f"{bucket_name}/{key}")).hexdigest()
+    )
+
+
+def get_presigned_urls(objects, refresh_cache=False):
+    """Return a list of a tuple of a presigned URL and for how many more
+    seconds it can be handed out, of every (source, bucket name, key)
+    tuple.
+
+    The same URL is handed out, from the cache, for
+    SYMBOLDOWNLOAD_PRESIGNED_URL_CACHE_FRACTION of the time it's valid.
+    That way, the redirect to it can be cached too, and whoever follows a
+    cached redirect still has the rest of the time to do so. The cached
+    URLs are all read, and the new ones all stored, in one go."""
+    expires = settings.SYMBOLDOWNLOAD_PRESIGNED_URL_EXPIRES_SECONDS
+    # Whatever it's set to, never hand out a URL that's (about to be)
+    # expired.
+    fraction = min(
+        max(settings.SYMBOLDOWNLOAD_PRESIGNED_URL_CACHE_FRACTION, 0.0),
+        MAX_PRESIGNED_URL_CACHE_FRACTION,
+    )
+    timeout = int(expires * fraction)
+    cache_keys = [
+        make_presigned_url_key(bucket_name, key) for _, bucket_name, key in objects
+    ]
+    now = time.time()
+    cached = {}
+    if timeout > 0 and not refresh_cache:
+        cached = cache.get_many(cache_keys)
+        if cached:
+            metrics.incr("symboldownloader_presigned_url_cache_hit", len(cached))
+
+    results = []
+    new = {}
+    for (source, bucket_name, key), cache_key in zip(objects, cache_keys):
+        if cache_key in cached:
+            url, cached_until = cached[cache_key]
+            results.append((url, max(int(cached_until - now), 0)))
+            continue
+        # generate_presigned_url() actually works for both private
+        # and public buckets.
+        url = source.client.generate_presigned_url(
+            "get_object", Params={"Bucket": bucket_name, "Key": key}, ExpiresIn=expires
+        )
+        if timeout <= 0:
+            results.append((url, None))
+        else:
+            new[cache_key] = (url, now + timeout)
+            results.append((url, timeout))
+    if new:
+        cache.set_many(new, timeout)
+    return results
+
+
+def get_presigned_url(source, bucket_name, key, refresh_cache=False):
+    """Return a tuple of a presigned URL of this key and for how many more
+    seconds it can be handed out. See get_presigned_urls()."""
+    result, = get_presigned_urls(
+        [(source, bucket_name, key)], refresh_cache=refresh_cache
+    )
+    return result
 
 
 class SymbolDownloader:
@@ -126,8 +330,9 @@ class SymbolDownloader:
     3. Give me a stream for this particular symbol.
 
     This class takes a list of URLs. If the URL contains ``access=public``
-    in the query string part, this class will use ``requests.get`` or
-    ``requests.head`` depending on the task.
+    in the query string part, this class will use ``requests`` to do a GET
+    or a HEAD depending on the task. With one session per source, so that
+    connections are kept alive.
     If the URL does NOT contain ``access=public`` it will use a
     ``boto3`` S3 client to do the check or download.
 
@@ -171,6 +376,9 @@ class SymbolDownloader:
         self.urls = urls
         self._sources = None
         self.file_prefix = file_prefix
+        self.source_timings = []
+        # (bucket name, prefix) -> the seconds of its most recent lookups.
+        self._latencies = {}
 
     def __repr__(self):
         return f"<{self.__class__.__name__} urls={self.urls}>"
@@ -193,27 +401,10 @@ class SymbolDownloader:
         # used when the key was cached by exists_in_source() we have
         # to iterate over the source.
         for source in self.sources:
-            prefix = source.prefix
-            assert prefix
-            if source.private:
-                # At some point we ran
-                # exists_in_source(source, key)
-                # But that function is wrapped and now has an extra
-                # function to "undoing" it.
-                if source.is_google_cloud_storage:
-                    bucket = source.get_or_load_bucket()
-                    exists_in_source.invalidate(
-                        bucket, self._make_key(prefix, symbol, debugid, filename)
-                    )
-                else:
-                    exists_in_source.invalidate(
-                        source, self._make_key(prefix, symbol, debugid, filename)
-                    )
-            else:
-                file_url = "{}/{}".format(
-                    source.base_url, self._make_key(prefix, symbol, debugid, filename)
-                )
-                check_url_head.invalidate(file_url)
+            # Whatever function was called for the lookup is wrapped, by
+            # cache_memoize, and now has an extra function to "undoing" it.
+            function, args = self._get_lookup(source, symbol, debugid, filename)
+            function.invalidate(*args)
 
     @staticmethod
     def _make_key(prefix, symbol, debugid, filename):
@@ -233,46 +424,220 @@ class SymbolDownloader:
         depending on if the symbol was found a public bucket or a
         private bucket.
         Consumers of this method can use the fact that anything truish
-        was returned as an indication that the symbol actually exists."""
+        was returned as an indication that the symbol actually exists.
+
+        Also sets `self.source_timings` to a list of tuples of (source,
+        seconds, found) of every source that was looked in."""
+        self.source_timings = []
+        args = (symbol, debugid, filename, refresh_cache)
+        if len(self.sources) > 1:
+            if settings.SYMBOLDOWNLOAD_PARALLEL_PROBING:
+                return self._probe_all(*args)
+            if settings.SYMBOLDOWNLOAD_ADAPTIVE_ORDERING:
+                return self._probe_adaptive(*args)
         for source in self.sources:
+            found, seconds = self._timed_probe(source, *args)
+            self._add_timing(source, seconds, found)
+            if found:
+                return found
+
+    def _add_timing(self, source, seconds, found):
+        """Count one lookup of a symbol in this source. However many times
+        it was actually looked for in there (see _probe_all())."""
+        self.source_timings.append((source, seconds, bool(found)))
+        source_stats.record(source, bool(found), seconds)
+
+    def _probe(self, source, symbol, debugid, filename, refresh_cache=False):
+        """Return a dict (see _get()) if the symbol can be found in this
+        source. None otherwise."""
+        function, args = self._get_lookup(source, symbol, debugid, filename)
+        logger.debug(f"Looking for symbol file {args[1]!r} in {source.name}")
+        result = self._call_lookup(source, function, args, refresh_cache=refresh_cache)
+        return self._get_found(source, args, result)
 
-            prefix = source.prefix
-            assert prefix
-
-            if source.private:
-                # If it's a private bucket we use boto3 or google cloud storage.
-                key = self._make_key(prefix, symbol, debugid, filename)
-                logger.debug(f"Looking for symbol file {key!r} in bucket {source.name}")
-
-                if source.is_google_cloud_storage:
-                    bucket = source.get_or_load_bucket()
-                    url = exists_in_source(bucket, key, _refresh=refresh_cache)
-                    if not url:
-                        continue
-                    return {"url": url}
-
-                else:
-                    if not exists_in_source(source, key, _refresh=refresh_cache):
-                        continue
-
-                    # It exists if we're still here.
-                    return {"bucket_name": source.name, "key": key, "source": source}
+    @staticmethod
+    def _call_lookup(source, function, args, refresh_cache=False):
+        """Return what the function from _get_lookup() returns. Unless the
+        symbol index says the symbol definitely isn't in this source. That
+        isn't memoized, like what the source itself says, because the
+        filter might be discarded (see SymbolIndex.add())."""
+        if not source.is_google_cloud_storage:
+            if function is exists_in_source:
+                key = args[1]
+            else:
+                key = args[1][len(source.base_url) + 1 :]  # noqa
+            if not symbol_index.might_exist(source, key):
+                return False
+        return function(*args, _refresh=refresh_cache)
+
+    def _get_lookup(self, source, symbol, debugid, filename):
+        """Return a tuple of the memoized function that looks for the
+        symbol in this source and the arguments to call it with."""
+        prefix = source.prefix
+        assert prefix
+        key = self._make_key(prefix, symbol, debugid, filename)
+
+        if source.private:
+            # If it's a private bucket we use boto3 or google cloud storage.
+            if source.is_google_cloud_storage:
+                return exists_in_source, (source.get_or_load_bucket(), key)
+            return exists_in_source, (source, key)
+
+        elif source.is_google_cloud_storage:
+            raise NotImplementedError(
+                "Currently don't support regular HTTP download from GCS."
+            )
 
-            elif source.is_google_cloud_storage:
-                raise NotImplementedError(
-                    "Currently don't support regular HTTP download from GCS."
-                )
+        # We'll put together the URL manually
+        return check_url_head, (source, f"{source.base_url}/{key}")
 
+    @staticmethod
+    def _get_found(source, args, result):
+        """Return what _probe() returns, given what the function from
+        _get_lookup() returned."""
+        if not result:
+            return None
+        if not source.private:
+            url = args[1]
+            return {"url": url, "source": source}
+        if source.is_google_cloud_storage:
+            # It's the blob's public URL.
+            return {"url": result}
+        key = args[1]
+        return {"bucket_name": source.name, "key": key, "source": source}
+
+    def _probe_all(self, *args):
+        """Like looking in every source in order, but they're all looked in
+        at the same time. The first source (in order) that has the symbol
+        wins, once all the sources before it are known not to have it.
+
+        If a source takes longer than its SYMBOLDOWNLOAD_HEDGE_PERCENTILE
+        percentile of how long it's recently taken, the same lookup is
+        started again, in case the first one got stuck somewhere. Then
+        whichever of the two finishes first counts.
+        """
+        executor = get_probe_executor()
+        sources = self.sources
+        t0 = time.time()
+        results = [_PENDING] * len(sources)
+        hedge_delays = [self._get_hedge_delay(source) for source in sources]
+        futures = {}
+        for i, source in enumerate(sources):
+            futures[executor.submit(self._timed_probe, source, *args)] = i
+
+        while True:
+            for i, result in enumerate(results):
+                if result is _PENDING:
+                    break
+                found, exception = result
+                if exception is not None:
+                    raise exception
+                if found:
+                    return found
             else:
-                # We'll put together the URL manually
-                file_url = "{}/{}".format(
-                    source.base_url, self._make_key(prefix, symbol, debugid, filename)
+                # Nothing found anywhere.
+                return None
+
+            elapsed = time.time() - t0
+            deadlines = [
+                delay - elapsed
+                for i, delay in enumerate(hedge_delays)
+                if delay is not None and results[i] is _PENDING
+            ]
+            done, _ = concurrent.futures.wait(
+                list(futures),
+                timeout=max(min(deadlines), 0) if deadlines else None,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                i = futures.pop(future)
+                if results[i] is not _PENDING:
+                    # The other one of a hedged pair already finished.
+                    continue
+                try:
+                    found, _ = future.result()
+                except Exception as exception:
+                    results[i] = (None, exception)
+                else:
+                    results[i] = (found, None)
+                    self._add_timing(sources[i], time.time() - t0, found)
+
+            elapsed = time.time() - t0
+            for i, delay in enumerate(hedge_delays):
+                if delay is not None and results[i] is _PENDING and delay <= elapsed:
+                    # Don't hedge the same source twice.
+                    hedge_delays[i] = None
+                    metrics.incr("symboldownloader_hedged_probe", 1)
+                    future = executor.submit(self._timed_probe, sources[i], *args)
+                    futures[future] = i
+
+    def _probe_adaptive(self, *args):
+        """Like looking in every source in order, but the sources that most
+        often have the symbols (see tecken.base.sourcestats) are looked in
+        first. When one has it, the sources before it (in order) that
+        haven't been looked in yet are looked in, at the same time, since
+        any one of them would win.
+        """
+        sources = self.sources
+        order = source_stats.get_order(sources)
+        for n, i in enumerate(order):
+            found, seconds = self._timed_probe(sources[i], *args)
+            self._add_timing(sources[i], seconds, found)
+            if not found:
+                continue
+            before = sorted(j for j in order[n + 1 :] if j < i)  # noqa
+            if not before:
+                return found
+            executor = get_probe_executor()
+            t0 = time.time()
+            futures = [
+                (j, executor.submit(self._timed_probe, sources[j], *args))
+                for j in before
+            ]
+            for j, future in futures:
+                better, _ = future.result()
+                self._add_timing(sources[j], time.time() - t0, better)
+                if better:
+                    return better
+            return found
+
+    def _timed_probe(self, source, *args):
+        """Return a tuple of what _probe() returns and how many seconds it
+        took. If it actually went to the source, rather than being
+        memoized, how long that took is remembered for _get_hedge_delay()."""
+        _source_call.seconds = None
+        t0 = time.time()
+        found = self._probe(source, *args)
+        seconds = time.time() - t0
+        if _source_call.seconds is not None:
+            key = (source.name, source.prefix)
+            latencies = self._latencies.get(key)
+            if latencies is None:
+                latencies = self._latencies.setdefault(
+                    key, deque(maxlen=HEDGE_LATENCY_SAMPLES)
                 )
-                logger.debug(f"Looking for symbol file by URL {file_url!r}")
-                if check_url_head(file_url, _refresh=refresh_cache):
-                    return {"url": file_url, "source": source}
+            latencies.append(_source_call.seconds)
+        return found, seconds
+
+    def _get_hedge_delay(self, source):
+        """Return the number of seconds after which to start the same
+        lookup in this source again. Or None if it shouldn't be."""
+        percentile = settings.SYMBOLDOWNLOAD_HEDGE_PERCENTILE
+        latencies = self._latencies.get((source.name, source.prefix))
+        if not percentile or not latencies or len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(latencies)
+        return latencies[min(len(latencies) * percentile // 100, len(latencies) - 1)]
 
     def _get_stream(self, symbol, debugid, filename):
+        chunks = self._get_chunks(symbol, debugid, filename)
+        yield next(chunks)
+        for line in split_lines(chunks):
+            # filter out empty lines
+            if line:
+                yield line.decode("utf-8")
+
+    def _get_chunks(self, symbol, debugid, filename):
         for source in self.sources:
 
             prefix = source.prefix
@@ -300,13 +665,13 @@ class SymbolDownloader:
                         continue
 
                     yield (source.name, key)
-                    bytestream = BytesIO()
-                    blob.download_to_file(bytestream)
-                    bytestream.seek(0)
-                    whole = bytestream.read().decode("utf-8")
-                    for line in whole.splitlines():
-                        if line:
-                            yield line
+                    # The client can only download into a file. So, instead
+                    # of holding all of it in memory, download it to a
+                    # temporary file and read that back in chunks.
+                    with tempfile.TemporaryFile() as f:
+                        blob.download_to_file(f)
+                        f.seek(0)
+                        yield from iter(lambda: f.read(ITER_CHUNK_SIZE), b"")
                     return
                 else:
                     try:
@@ -314,23 +679,21 @@ class SymbolDownloader:
                             response = source.client.get_object(
                                 Bucket=source.name, Key=key
                             )
-                        stream = response["Body"]
-                        # But if the content encoding is gzip we have
-                        # re-wrap the stream.
-                        if response.get("ContentEncoding") == "gzip":
-                            with metrics.timer("symboldownloader_get_object_read"):
-                                body = response["Body"].read()
-                            metrics.incr(
-                                "symboldownloader_download_bytes",
-                                len(body),
-                                tags=["encoding:gzip"],
-                            )
-                            bytestream = BytesIO(body)
-                            stream = GzipFile(None, "rb", fileobj=bytestream)
+                        body = response["Body"]
+                        chunks = iter(lambda: body.read(ITER_CHUNK_SIZE), b"")
                         yield (source.name, key)
                         try:
-                            for line in iter_lines(stream):
-                                yield line.decode("utf-8")
+                            # If the content encoding is gzip it's
+                            # decompressed as it's downloaded.
+                            if response.get("ContentEncoding") == "gzip":
+                                compressed_size = yield from gunzip_chunks(chunks)
+                                metrics.incr(
+                                    "symboldownloader_download_bytes",
+                                    compressed_size,
+                                    tags=["encoding:gzip"],
+                                )
+                            else:
+                                yield from chunks
                             return
                         except OSError as exception:
                             if "Not a gzipped file" in str(exception):
@@ -364,28 +727,18 @@ class SymbolDownloader:
                     source.base_url, prefix, symbol, debugid.upper(), filename
                 )
                 logger.debug(f"Looking for symbol file by URL {file_url!r}")
-                response = requests.get(file_url, stream=True)
+                response = source.session.get(file_url, stream=True)
                 if response.status_code == 404:
                     # logger.warning('{} 404 Not Found'.format(file_url))
                     continue
                 elif response.status_code == 200:
                     # Files downloaded from S3 should be UTF-8 but it's
-                    # unlikely that S3 exposes this in a header.
-                    # If the Content-Type in 'text/plain' requests will
-                    # assume the ISO-8859-1 encoding (this is according
-                    # to RFC 2616).
-                    # But if the content type is 'binary/octet-stream' it
-                    # can't assume any encoding so it will be returned
-                    # as a bytestring.
-                    if not response.encoding:
-                        response.encoding = "utf-8"
+                    # unlikely that S3 exposes this in a header. So
+                    # don't let requests guess. It's always just bytes
+                    # and the decoding, if any, is done by the caller.
                     yield file_url
                     try:
-                        for line in response.iter_lines():
-                            # filter out keep-alive newlines
-                            if line:
-                                line = line.decode("utf-8")
-                                yield line
+                        yield from response.iter_content(ITER_CHUNK_SIZE)
                         # Stop the iterator
                         return
                     except requests.exceptions.ContentDecodingError as exc:
@@ -408,27 +761,138 @@ class SymbolDownloader:
         found in any of the URLs provided."""
         return bool(self._get(symbol, debugid, filename, refresh_cache=refresh_cache))
 
-    @set_time_took
     def get_symbol_url(self, symbol, debugid, filename, refresh_cache=False):
         """return the redirect URL or None. If we return None
         it means we can't find the object in any of the URLs provided."""
+        url, _ = self.get_symbol_redirect(
+            symbol, debugid, filename, refresh_cache=refresh_cache
+        )
+        return url
+
+    @set_time_took
+    def get_symbol_redirect(self, symbol, debugid, filename, refresh_cache=False):
+        """return a tuple of the redirect URL (see get_symbol_url()) and for
+        how many seconds a redirect to it can be cached. The latter is None
+        if it's not known."""
         found = self._get(symbol, debugid, filename, refresh_cache=refresh_cache)
         if found:
-            if "url" in found:
-                return found["url"]
-
-            # If a URL wasn't returned, the bucket it was found in
-            # was not public.
-            bucket_name = found["bucket_name"]
-            key = found["key"]
-            # generate_presigned_url() actually works for both private
-            # and public buckets.
-            return found["source"].client.generate_presigned_url(
-                "get_object",
-                Params={"Bucket": bucket_name, "Key": key},
-                # Left commented-in to remind us of what the default is
-                # ExpiresIn=3600
-            )
+            return self._get_url(found, refresh_cache=refresh_cache)
+        return None, None
+
+    @set_time_took
+    def get_symbol_urls(self, symbols, refresh_cache=False):
+        """return a dict of every (symbol, debugid, filename) tuple to its
+        redirect URL, or None if it can't be found in any of the URLs
+        provided.
+
+        What's known, in the cache, about every symbol in every source is
+        read in one go. The symbols that then still need to be looked for
+        are looked for at the same time, each in a thread."""
+        # The lookups of many symbols aren't timed per source.
+        self.source_timings = []
+        symbols = list(dict.fromkeys(tuple(x) for x in symbols))
+        sources = self.sources
+        lookups = {
+            symbol: [self._get_lookup(source, *symbol) for source in sources]
+            for symbol in symbols
+        }
+        # The cache_memoize key of every lookup. Or None if the cache
+        # shouldn't be looked in.
+        cache_keys = {
+            symbol: [
+                None if refresh_cache else self._get_lookup_cache_key(*lookup)
+                for lookup in symbol_lookups
+            ]
+            for symbol, symbol_lookups in lookups.items()
+        }
+        cached = cache.get_many(
+            [key for keys in cache_keys.values() for key in keys if key]
+        )
+        metrics.incr("symboldownloader_batch_cache_hit", len(cached))
+
+        def iter_results(symbol):
+            # Generates tuples of (source, function, arguments, cached
+            # result or _PENDING if it has to be looked for) in order.
+            for source, (function, args), cache_key in zip(
+                sources, lookups[symbol], cache_keys[symbol]
+            ):
+                yield source, function, args, cached.get(cache_key, _PENDING)
+
+        def resolve(symbol):
+            for source, function, args, result in iter_results(symbol):
+                if result is _PENDING:
+                    # Known not to be in the cache, so don't look there
+                    # again. It's still stored there.
+                    result = self._call_lookup(
+                        source, function, args, refresh_cache=True
+                    )
+                found = self._get_found(source, args, result)
+                if found:
+                    return found
+
+        def is_cached(symbol):
+            for source, _, args, result in iter_results(symbol):
+                if result is _PENDING:
+                    return False
+                if self._get_found(source, args, result):
+                    break
+            return True
+
+        founds = {}
+        executor = get_probe_executor()
+        futures = {}
+        for symbol in symbols:
+            if is_cached(symbol):
+                founds[symbol] = resolve(symbol)
+            else:
+                futures[symbol] = executor.submit(resolve, symbol)
+        for symbol, future in futures.items():
+            founds[symbol] = future.result()
+
+        urls = {}
+        # Those in private buckets all get their presigned URL in one go.
+        private = []
+        for symbol in symbols:
+            found = founds[symbol]
+            urls[symbol] = found and found.get("url")
+            if found and "url" not in found:
+                private.append(symbol)
+        presigned_urls = get_presigned_urls(
+            [
+                (
+                    founds[symbol]["source"],
+                    founds[symbol]["bucket_name"],
+                    founds[symbol]["key"],
+                )
+                for symbol in private
+            ],
+            refresh_cache=refresh_cache,
+        )
+        for symbol, (url, _) in zip(private, presigned_urls):
+            urls[symbol] = url
+        return urls
+
+    @staticmethod
+    def _get_lookup_cache_key(function, args):
+        if function is exists_in_source:
+            return make_exists_in_source_key(*args)
+        return make_check_url_head_key(*args)
+
+    @staticmethod
+    def _get_url(found, refresh_cache=False):
+        """return a tuple of the redirect URL of what _get() found and for
+        how many seconds a redirect to it can be cached, or None."""
+        if "url" in found:
+            return found["url"], None
+
+        # If a URL wasn't returned, the bucket it was found in
+        # was not public.
+        return get_presigned_url(
+            found["source"],
+            found["bucket_name"],
+            found["key"],
+            refresh_cache=refresh_cache,
+        )
 
     def get_symbol_stream(self, symbol, debugid, filename):
         """return a body stream for download if the file can be found.
@@ -436,3 +900,9 @@ class SymbolDownloader:
         The first item in the generator is always the URL or the
         (bucketname, objectkey) tuple if found."""
         return self._get_stream(symbol, debugid, filename)
+
+    def get_symbol_chunks(self, symbol, debugid, filename):
+        """Like get_symbol_stream() but, after the URL or the
+        (bucketname, objectkey) tuple, the generator yields the raw
+        (but uncompressed) bytes in chunks instead of decoded lines."""
+        return self._get_chunks(symbol, debugid, filename)
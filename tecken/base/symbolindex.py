@@ -0,0 +1,333 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Most symbols that are asked for are symbols we'll never have. Looking for
+each of them in every source means a list_objects_v2 or HEAD request to
+S3, memoized only for SYMBOLDOWNLOAD_EXISTS_TTL_SECONDS.
+
+So, with SYMBOL_INDEX_ENABLED, there's a Bloom filter of every key under
+the prefix of every S3 source. If it says a key isn't there, it
+definitely isn't and S3 isn't asked. If it says it might be, S3 is asked
+like before.
+
+The filter is built (see the build-symbol-index management command) from a
+listing of the bucket and every key that is uploaded afterwards is added
+to it. It's kept in the "pinned" Redis as one string of bits. A lookup
+is one round trip to read the bits of the key.
+
+A filter that's missing keys would say symbols we have don't exist. So
+the index is only used if the pinned Redis never evicts anything (its
+maxmemory-policy is noeviction) and bits are only ever set on a filter
+that still exists. Never on one that's been evicted, or replaced, which
+would then be a new filter of only those keys. If keys can't be added to
+a filter, it's thrown away and every key might exist until it's built
+again.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import time
+from datetime import timedelta
+
+import markus
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from tecken.symbolicate.utils import queue_set_buffer
+from tecken.upload.models import FileUpload
+
+
+logger = logging.getLogger("tecken")
+metrics = markus.get_metrics("tecken")
+
+# How long the description of the filters, e.g. their size, is used
+# before it's read again.
+META_TTL_SECONDS = 60
+
+# Keys uploaded this much before the listing of a bucket started might
+# still have been missed by it.
+CATCH_UP_MARGIN = timedelta(hours=1)
+
+# How many keys to ask for per list_objects_v2 request.
+LIST_PAGE_SIZE = 1000
+
+
+def get_index_id(source):
+    """Return the name of the filter of the keys of this StorageBucket."""
+    return f"{source.name}/{source.prefix}"
+
+
+def get_eviction_policy(connection):
+    """Return the maxmemory-policy of this Redis. From INFO, because not
+    every hosted Redis (e.g. ElastiCache) allows CONFIG GET."""
+    return connection.info("memory").get("maxmemory_policy")
+
+
+def get_parameters(capacity, error_rate):
+    """Return a tuple of the number of bits and number of hashes of a
+    Bloom filter of 'capacity' keys with this false positive rate."""
+    size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    hashes = max(1, round(size / capacity * math.log(2)))
+    return size, hashes
+
+
+def get_error_rate(size, hashes, count):
+    """Return the expected false positive rate of a Bloom filter of this
+    number of bits and hashes with 'count' keys in it."""
+    return (1 - math.exp(-hashes * count / size)) ** hashes
+
+
+def get_positions(key, size, hashes):
+    """Return the bits of this key. Two hashes, from one md5 digest, are
+    combined into as many as needed."""
+    digest = hashlib.md5(key.encode("utf-8")).digest()
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:], "little") | 1
+    return [(h1 + i * h2) % size for i in range(hashes)]
+
+
+class BloomFilter:
+    """A Bloom filter in memory. The bits are in the same order as Redis'
+    SETBIT and GETBIT commands, so the whole thing can be stored as one
+    string and then read, and added to, one bit at a time."""
+
+    def __init__(self, size, hashes):
+        self.size = size
+        self.hashes = hashes
+        self.count = 0
+        self.bits = bytearray((size + 7) // 8)
+
+    def add(self, key):
+        for position in get_positions(key, self.size, self.hashes):
+            self.bits[position >> 3] |= 0x80 >> (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(
+            self.bits[position >> 3] & (0x80 >> (position & 7))
+            for position in get_positions(key, self.size, self.hashes)
+        )
+
+
+class SymbolIndex:
+    def __init__(self):
+        # Index ID -> (when it was read, its meta dict or None)
+        self._meta = {}
+        # Whether there's a pinned Redis fit to keep the filters in. Only
+        # checked once per process.
+        self._usable = None
+
+    @staticmethod
+    def _connection():
+        return get_redis_connection("pinned")
+
+    @staticmethod
+    def _make_key(name):
+        return caches["pinned"].make_key(f"symbolindex:{name}")
+
+    def _make_bits_key(self, index_id, meta):
+        # A filter of a different size is a different key. So whoever
+        # still knows the previous size doesn't read, or add to, the wrong
+        # bits.
+        return self._make_key(f"{index_id}:{meta['size']}:{meta['hashes']}")
+
+    def is_usable(self):
+        """Return true if there is a pinned Redis (REDIS_PINNED_URL) and
+        it never evicts anything."""
+        if self._usable is None:
+            self._usable = False
+            if settings.REDIS_PINNED_URL:
+                policy = get_eviction_policy(self._connection())
+                self._usable = policy == "noeviction"
+            if not self._usable and settings.SYMBOL_INDEX_ENABLED:
+                logger.warning(
+                    "SYMBOL_INDEX_ENABLED is set but REDIS_PINNED_URL isn't a "
+                    "Redis with maxmemory-policy noeviction. It's not used."
+                )
+        return self._usable
+
+    def get_all_meta(self):
+        """Return a dict of index ID -> dict of the 'size', 'hashes', when
+        the filter was 'built_at' (a UNIX timestamp) and how many keys
+        have been added to it ('count') of every filter."""
+        pipeline = self._connection().pipeline(transaction=False)
+        pipeline.hgetall(self._make_key("meta"))
+        pipeline.hgetall(self._make_key("count"))
+        all_meta, counts = pipeline.execute()
+        found = {}
+        for index_id, meta in all_meta.items():
+            meta = json.loads(meta)
+            meta["count"] = int(counts.get(index_id, 0))
+            found[index_id.decode("utf-8")] = meta
+        return found
+
+    def _get_meta(self, index_id):
+        now = time.time()
+        cached = self._meta.get(index_id)
+        if cached and now - cached[0] < META_TTL_SECONDS:
+            return cached[1]
+        pipeline = self._connection().pipeline(transaction=False)
+        pipeline.hget(self._make_key("meta"), index_id)
+        pipeline.hget(self._make_key("count"), index_id)
+        meta, count = pipeline.execute()
+        if meta is not None:
+            meta = json.loads(meta)
+            tags = [f"index:{index_id}"]
+            metrics.gauge("symbolindex_age_seconds", now - meta["built_at"], tags=tags)
+            metrics.gauge(
+                "symbolindex_error_rate",
+                get_error_rate(meta["size"], meta["hashes"], int(count or 0)),
+                tags=tags,
+            )
+        self._meta[index_id] = (now, meta)
+        return meta
+
+    def has_filter(self, source):
+        """Return true if there is a filter, that's used, of this source."""
+        if not settings.SYMBOL_INDEX_ENABLED or not self.is_usable():
+            return False
+        return self._get_meta(get_index_id(source)) is not None
+
+    def might_exist(self, source, key):
+        """Return False if this key is definitely not in this source.
+        True if it might be or if there's no filter of this source."""
+        if not settings.SYMBOL_INDEX_ENABLED or not self.is_usable():
+            return True
+        index_id = get_index_id(source)
+        meta = self._get_meta(index_id)
+        if meta is None:
+            return True
+        bits_key = self._make_bits_key(index_id, meta)
+        pipeline = self._connection().pipeline(transaction=False)
+        pipeline.exists(bits_key)
+        for position in get_positions(key, meta["size"], meta["hashes"]):
+            pipeline.getbit(bits_key, position)
+        exists, *bits = pipeline.execute()
+        if not exists:
+            # It's been rebuilt, with a different size, since the meta
+            # was read. Or it's gone.
+            return True
+        if all(bits):
+            return True
+        metrics.incr("symbolindex_negative", tags=[f"index:{index_id}"])
+        return False
+
+    def add(self, bucket_name, keys):
+        """Add these keys, just uploaded into this bucket, to every filter
+        of a source they're in. Even when SYMBOL_INDEX_ENABLED is off, so
+        that the filters are still right when it's turned on.
+
+        A filter these keys can't be added to is discarded."""
+        if not self.is_usable():
+            # Then there's nowhere to keep any filters.
+            return
+        connection = self._connection()
+        all_meta = connection.hgetall(self._make_key("meta"))
+        # Usually there are none because no filter has ever been built.
+        for index_id, meta in all_meta.items():
+            index_id = index_id.decode("utf-8")
+            meta = json.loads(meta)
+            name, prefix = index_id.split("/", 1)
+            if name != bucket_name:
+                continue
+            matching = [key for key in keys if key.startswith(prefix + "/")]
+            if not matching:
+                continue
+            bits_key = self._make_bits_key(index_id, meta)
+
+            def add_keys(pipeline):
+                # If the filter is gone, setting bits would make a new one
+                # of only these keys.
+                if not pipeline.exists(bits_key):
+                    return
+                pipeline.multi()
+                for key in matching:
+                    for position in get_positions(key, meta["size"], meta["hashes"]):
+                        pipeline.setbit(bits_key, position, 1)
+                pipeline.hincrby(self._make_key("count"), index_id, len(matching))
+
+            try:
+                connection.transaction(add_keys, bits_key)
+            except Exception:
+                logger.error(
+                    f"Unable to add {len(matching)} keys to the symbol index "
+                    f"{index_id}. Discarding it.",
+                    exc_info=True,
+                )
+                self.discard(index_id, meta)
+
+    def discard(self, index_id, meta):
+        """Delete this filter. Until it's built again, every key might be in
+        its source."""
+        pipeline = self._connection().pipeline()
+        pipeline.hdel(self._make_key("meta"), index_id)
+        pipeline.hdel(self._make_key("count"), index_id)
+        # Whoever still has the meta in memory sees the bits are gone.
+        pipeline.delete(self._make_bits_key(index_id, meta))
+        pipeline.execute()
+        self._meta.pop(index_id, None)
+        metrics.incr("symbolindex_discarded", tags=[f"index:{index_id}"])
+
+    def build(self, source):
+        """(Re)build the filter of this source from a listing of every key
+        under its prefix. Return the number of keys in it."""
+        index_id = get_index_id(source)
+        started = timezone.now()
+        previous = self.get_all_meta().get(index_id)
+        # Leave room for as many new keys as there are now.
+        capacity = max(
+            settings.SYMBOL_INDEX_CAPACITY, previous["count"] * 2 if previous else 0
+        )
+        size, hashes = get_parameters(capacity, settings.SYMBOL_INDEX_ERROR_RATE)
+        bloom_filter = BloomFilter(size, hashes)
+        paginator = source.client.get_paginator("list_objects_v2")
+        pages = paginator.paginate(
+            Bucket=source.name,
+            Prefix=source.prefix + "/",
+            PaginationConfig={"PageSize": LIST_PAGE_SIZE},
+        )
+        for page in pages:
+            for obj in page.get("Contents", []):
+                bloom_filter.add(obj["Key"])
+        listed = bloom_filter.count
+        # Whatever was uploaded while listing might not be in the listing.
+        file_uploads = FileUpload.objects.filter(
+            bucket_name=source.name,
+            key__startswith=source.prefix + "/",
+            created_at__gte=started - CATCH_UP_MARGIN,
+        )
+        for key in file_uploads.values_list("key", flat=True):
+            bloom_filter.add(key)
+
+        meta = {"size": size, "hashes": hashes, "built_at": time.time()}
+        bits_key = self._make_bits_key(index_id, meta)
+        pipeline = self._connection().pipeline()
+        queue_set_buffer(pipeline, bits_key, bytes(bloom_filter.bits))
+        pipeline.hset(self._make_key("meta"), index_id, json.dumps(meta))
+        # The keys that are added again, below, are counted then.
+        pipeline.hset(self._make_key("count"), index_id, listed)
+        if previous:
+            previous_bits_key = self._make_bits_key(index_id, previous)
+            if previous_bits_key != bits_key:
+                pipeline.delete(previous_bits_key)
+        pipeline.execute()
+        self._meta.pop(index_id, None)
+
+        # And whatever was uploaded since might have been added to the
+        # previous filter, not this one.
+        self.add(source.name, list(file_uploads.values_list("key", flat=True)))
+        return bloom_filter.count
+
+    def clear(self):
+        self._meta = {}
+        self._usable = None
+
+
+symbol_index = SymbolIndex()
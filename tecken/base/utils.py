@@ -12,7 +12,11 @@ from django.template.defaultfilters import filesizeformat as dj_filesizeformat
 
 
 def requests_retry_session(
-    retries=3, backoff_factor=0.3, status_forcelist=(500, 502, 504)
+    retries=3,
+    backoff_factor=0.3,
+    status_forcelist=(500, 502, 504),
+    pool_maxsize=None,
+    raise_on_status=True,
 ):
     """Opinionated wrapper that creates a requests session with a
     HTTPAdapter that sets up a Retry policy that includes connection
@@ -32,6 +36,15 @@ def requests_retry_session(
     A default of retries=3 and backoff_factor=0.3 means it will sleep like::
 
         [0.3, 0.6, 1.2]
+
+    The session keeps connections alive, in a pool per host, between
+    requests. If the session is used by more threads at the same time
+    than 'pool_maxsize' (default 10), the extra connections are closed
+    after their requests instead of being put back in the pool.
+
+    If 'raise_on_status' is false, the last response is returned, instead
+    of raising a RetryError, when it's still one of the 'status_forcelist'
+    after all the retries.
     """  # noqa
     session = requests.Session()
     retry = Retry(
@@ -40,8 +53,12 @@ def requests_retry_session(
         connect=retries,
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
+        raise_on_status=raise_on_status,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter_options = {"max_retries": retry}
+    if pool_maxsize:
+        adapter_options["pool_maxsize"] = pool_maxsize
+    adapter = HTTPAdapter(**adapter_options)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     return session
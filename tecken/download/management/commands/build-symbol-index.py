@@ -0,0 +1,31 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from tecken.base.symbolindex import get_index_id, symbol_index
+from tecken.storage import StorageBucket
+
+
+class Command(BaseCommand):
+    help = (
+        "(Re)build the Bloom filter of every key in every S3 source. Meant to "
+        "be run periodically, e.g. daily."
+    )
+
+    def handle(self, *args, **options):
+        if not symbol_index.is_usable():
+            raise CommandError(
+                "REDIS_PINNED_URL isn't a Redis with maxmemory-policy noeviction"
+            )
+        urls = settings.SYMBOL_URLS + [settings.UPLOAD_TRY_SYMBOLS_URL]
+        for url in dict.fromkeys(urls):
+            source = StorageBucket(url, file_prefix=settings.SYMBOL_FILE_PREFIX)
+            index_id = get_index_id(source)
+            if source.is_google_cloud_storage:
+                self.stdout.write(self.style.WARNING(f"Skipping {index_id} (GCS)"))
+                continue
+            count = symbol_index.build(source)
+            self.stdout.write(self.style.SUCCESS(f"Built {index_id} ({count:,} keys)"))
@@ -37,6 +37,7 @@ app_name = "download"
 
 urlpatterns = [
     path("missingsymbols.csv", views.missing_symbols_csv, name="missing_symbols_csv"),
+    path("symbols/", views.download_symbols, name="download_symbols"),
     path(
         "try/<str:symbol>/<hex:debugid>/<str:filename>",
         views.download_symbol_try,
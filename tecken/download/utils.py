@@ -6,6 +6,8 @@ import logging
 
 import markus
 
+from django.db import connection
+
 from tecken.download.models import MissingSymbol
 
 
@@ -63,3 +65,53 @@ def store_missing_symbol(symbol, debugid, filename, code_file=None, code_id=None
             MissingSymbol.incr_total_count()
 
     return hash_
+
+
+@metrics.timer_decorator("download_store_missing_symbols")
+def store_missing_symbols(entries):
+    """Like store_missing_symbol() but for many tuples of (symbol, debugid,
+    filename, code_file, code_id) in one single query. Return a dict of
+    each one that was stored to its hash."""
+    hashes = {}
+    for entry in entries:
+        if any(x and len(x) > 150 for x in entry):
+            logger.info(f"Ignoring log missing symbol ({entry[0][:150]!r})")
+            continue
+        hashes[entry] = MissingSymbol.make_md5_hash(*entry)
+    if not hashes:
+        return hashes
+    # The same hash twice in one INSERT ... ON CONFLICT DO UPDATE is an error.
+    rows = {
+        hash_: (hash_, symbol, debugid, filename, code_file or None, code_id or None)
+        for (symbol, debugid, filename, code_file, code_id), hash_ in hashes.items()
+    }
+    values = ", ".join(
+        ["(%s, %s, %s, %s, %s, %s, 1, CLOCK_TIMESTAMP(), CLOCK_TIMESTAMP())"]
+        * len(rows)
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+                INSERT INTO download_missingsymbol (
+                    hash, symbol, debugid, filename, code_file, code_id,
+                    count, created_at, modified_at
+                ) VALUES {values}
+                ON CONFLICT (hash)
+                DO UPDATE SET
+                    count = download_missingsymbol.count + 1,
+                    modified_at = CLOCK_TIMESTAMP()
+                RETURNING created_at, modified_at
+                """,
+            # In the order of the unique key. Otherwise two of these, with
+            # some of the same rows in a different order, could deadlock
+            # on the row locks of the ON CONFLICT.
+            [value for _, row in sorted(rows.items()) for value in row],
+        )
+        # See store_missing_symbol() about telling inserts from updates.
+        inserted = sum(
+            (modified_at - created_at).total_seconds() < 0.0001
+            for created_at, modified_at in cursor.fetchall()
+        )
+    if inserted:
+        MissingSymbol.incr_total_count(inserted)
+    return hashes
@@ -5,7 +5,9 @@
 import csv
 import datetime
 import hashlib
+import json
 import logging
+import re
 
 import markus
 from cache_memoize import cache_memoize
@@ -13,9 +15,11 @@ from cache_memoize import cache_memoize
 from django import http
 from django.conf import settings
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
 from django.core.cache import cache
 from django.utils.encoding import force_bytes
 from django.db import OperationalError
+from django.views.decorators.csrf import csrf_exempt
 
 from tecken.base.utils import invalid_key_name_characters
 from tecken.base.symboldownloader import SymbolDownloader
@@ -25,7 +29,7 @@ from tecken.base.decorators import (
     set_cors_headers,
 )
 from tecken.download.models import MissingSymbol
-from tecken.download.utils import store_missing_symbol
+from tecken.download.utils import store_missing_symbol, store_missing_symbols
 from tecken.download.tasks import download_microsoft_symbol, store_missing_symbol_task
 from tecken.download.forms import DownloadForm
 
@@ -45,6 +49,23 @@ try_downloader = SymbolDownloader(
 # repeatly get it from the settings module in runtime.
 file_extensions_whitelist = tuple(settings.DOWNLOAD_FILE_EXTENSIONS_WHITELIST)
 
+# Same as what the URL of download_symbol() accepts.
+debugid_regex = re.compile(r"^[0-9A-Fa-f]+$")
+
+
+def set_debug_time(response, downloader):
+    """Set the Debug-Time header to the total time, in seconds, the
+    downloader took. And Debug-Time-Sources to how long it took for each
+    source it looked in. E.g. ``bucket/v0;dur=0.0123;miss, try/v0;dur=0.4977;hit``
+    """
+    response["Debug-Time"] = downloader.time_took
+    timings = ", ".join(
+        f"{source.name}/{source.prefix};dur={seconds:.4f};{'hit' if found else 'miss'}"
+        for source, seconds, found in downloader.source_timings
+    )
+    if timings:
+        response["Debug-Time-Sources"] = timings
+
 
 def _ignore_symbol(symbol, debugid, filename):
     # The MS debugger will always try to look up these files. We
@@ -61,6 +82,22 @@ def _ignore_symbol(symbol, debugid, filename):
     return False
 
 
+def make_microsoft_download_key(symbol, debugid):
+    return hashlib.md5(
+        force_bytes(f"microsoft-download:{symbol}:{debugid}")
+    ).hexdigest()
+
+
+def should_download_from_microsoft(symbol, filename):
+    """Return true if, when this symbol can't be found, it should be
+    downloaded from Microsoft."""
+    return (
+        settings.ENABLE_DOWNLOAD_FROM_MICROSOFT
+        and symbol.lower().endswith(".pdb")
+        and filename.lower().endswith(".sym")
+    )
+
+
 # Note! The reason this can't use the cache_memoize decorator
 # is because we need tight control of what the cache key becomes. That
 # way we can cache invalidate it later.
@@ -70,9 +107,7 @@ def download_from_microsoft(
     """Only kick off the 'download_microsoft_symbol' background task
     if we haven't already done so recently."""
 
-    cache_key = hashlib.md5(
-        force_bytes(f"microsoft-download:{symbol}:{debugid}")
-    ).hexdigest()
+    cache_key = make_microsoft_download_key(symbol, debugid)
     if not cache.get(cache_key):
         # Commence the background task to try to download from Microsoft
         download_microsoft_symbol.delay(
@@ -135,28 +170,20 @@ def download_symbol(request, symbol, debugid, filename, try_symbols=False):
         ):
             response = http.HttpResponse()
             if request._request_debug:
-                response["Debug-Time"] = downloader.time_took
+                set_debug_time(response, downloader)
             return response
     else:
-        url = downloader.get_symbol_url(
+        url, max_age = downloader.get_symbol_redirect(
             symbol, debugid, filename, refresh_cache=refresh_cache
         )
         if url:
-            # If doing local development, with Docker, you're most likely
-            # running minio as a fake S3 client. It runs on its own
-            # hostname that is only available from other Docker containers.
-            # But to make it really convenient, for testing symbol download
-            # we'll rewrite the URL to one that is possible to reach
-            # from the host.
-            if (
-                settings.DEBUG
-                and "http://minio:9000" in url
-                and request.get_host() == "localhost:8000"
-            ):  # pragma: no cover
-                url = url.replace("minio:9000", "localhost:9000")
+            url = _rewrite_minio_url(request, url)
             response = http.HttpResponseRedirect(url)
+            if max_age:
+                # It's the same URL, from the cache, until then.
+                patch_cache_control(response, max_age=max_age)
             if request._request_debug:
-                response["Debug-Time"] = downloader.time_took
+                set_debug_time(response, downloader)
             return response
 
     # Assume that we don't do a delayed (background task) lookup and
@@ -180,53 +207,236 @@ def download_symbol(request, symbol, debugid, filename, try_symbols=False):
         # Only bother logging it if the client used GET.
         # Otherwise it won't be possible to pick up the extra
         # query string parameters.
-        missing_symbol_hash = log_symbol_get_404(
+        delayed_lookup = handle_missing_symbol(
             symbol, debugid, filename, code_file=code_file, code_id=code_id
         )
 
-        if (
-            settings.ENABLE_DOWNLOAD_FROM_MICROSOFT
-            and symbol.lower().endswith(".pdb")
-            and filename.lower().endswith(".sym")
+    response = http.HttpResponseNotFound(
+        "Symbol Not Found Yet" if delayed_lookup else "Symbol Not Found"
+    )
+    if request._request_debug:
+        set_debug_time(response, downloader)
+    return response
+
+
+def _rewrite_minio_url(request, url):
+    # If doing local development, with Docker, you're most likely
+    # running minio as a fake S3 client. It runs on its own
+    # hostname that is only available from other Docker containers.
+    # But to make it really convenient, for testing symbol download
+    # we'll rewrite the URL to one that is possible to reach
+    # from the host.
+    if (
+        settings.DEBUG
+        and "http://minio:9000" in url
+        and request.get_host() == "localhost:8000"
+    ):  # pragma: no cover
+        return url.replace("minio:9000", "localhost:9000")
+    return url
+
+
+def _is_valid_batch_symbol(entry):
+    # A list of symbol, debugid and filename. Optionally followed by the
+    # code_file and code_id download_symbol() takes in its query string.
+    return (
+        isinstance(entry, list)
+        and len(entry) in (3, 5)
+        and all(isinstance(x, str) for x in entry)
+    )
+
+
+@csrf_exempt
+@metrics.timer_decorator("download_symbols")
+@set_request_debug
+@api_require_http_methods(["POST"])
+def download_symbols(request):
+    """Like download_symbol() but for many symbols in one request. The body
+    is a JSON dict with a list of lists of symbol, debugid and filename
+    (and optionally code_file and code_id) called 'symbols'. For example::
+
+        {"symbols": [["xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2", "xul.sym"]]}
+
+    The response is a JSON dict of "<symbol>/<debugid>/<filename>" to a
+    dict with the 'status' download_symbol() would respond with and,
+    if it was found, the 'url' it would redirect to."""
+    try:
+        body = json.loads(request.body.decode("utf-8"))
+    except ValueError:
+        return http.JsonResponse({"error": "Invalid JSON passed in"}, status=400)
+    symbols = body.get("symbols") if isinstance(body, dict) else None
+    if not isinstance(symbols, list) or not all(
+        _is_valid_batch_symbol(entry) for entry in symbols
+    ):
+        return http.JsonResponse(
+            {"error": "'symbols' must be a list of [symbol, debugid, filename]"},
+            status=400,
+        )
+    if len(symbols) > settings.DOWNLOAD_BATCH_MAX_SYMBOLS:
+        return http.JsonResponse(
+            {
+                "error": (
+                    f"No more than {settings.DOWNLOAD_BATCH_MAX_SYMBOLS} "
+                    f"symbols per request"
+                )
+            },
+            status=400,
+        )
+
+    refresh_cache = "_refresh" in request.GET
+
+    if "try" in request.GET or body.get("try"):
+        downloader = try_downloader
+    else:
+        downloader = normal_downloader
+
+    results = {}
+    lookups = []
+    for entry in symbols:
+        symbol, debugid, filename = entry[:3]
+        name = f"{symbol}/{debugid}/{filename}"
+        if invalid_key_name_characters(symbol + filename) or not debugid_regex.match(
+            debugid
         ):
-            # The log_symbol_get_404() function is protected by a cache
-            # that "guards" it with a memoize decorator. That memoize
-            # decorator makes sure the same arguments aren't allowed
-            # in more than once (per time interval the memoize cache
-            # is configured to).
-            # However, if it did run (and wasn't memoize blocked), it
-            # yields a hash to "describe" the missing symbol. That's
-            # useful to have when downloading from Microsoft.
-            # The function 'download_from_microsoft()' is will
-            # get or create one of those hashes no matter what. Here
-            # we're just doing a little optimization by passing that
-            # along to download_from_microsoft() to save it some effort.
-            if missing_symbol_hash and isinstance(missing_symbol_hash, bool):
-                missing_symbol_hash = None
-
-            # If we haven't already sent it to the 'download_microsoft_symbol'
-            # background task, do so.
-            download_from_microsoft(
+            results[name] = {"status": 400}
+        elif _ignore_symbol(symbol, debugid, filename):
+            results[name] = {"status": 404}
+        elif len(entry) == 5:
+            form = DownloadForm({"code_file": entry[3], "code_id": entry[4]})
+            if form.is_valid():
+                code_file = form.cleaned_data["code_file"]
+                code_id = form.cleaned_data["code_id"]
+                lookups.append((name, [symbol, debugid, filename, code_file, code_id]))
+            else:
+                results[name] = {"status": 400}
+        else:
+            lookups.append((name, entry))
+
+    metrics.histogram("download_symbols_count", len(lookups))
+    urls = downloader.get_symbol_urls(
+        [entry[:3] for _, entry in lookups], refresh_cache=refresh_cache
+    )
+    missing = []
+    for name, entry in lookups:
+        url = urls[tuple(entry[:3])]
+        if url:
+            results[name] = {"status": 302, "url": _rewrite_minio_url(request, url)}
+        else:
+            results[name] = {"status": 404}
+            missing.append((name, entry))
+
+    delayed_lookups = handle_missing_symbols([entry for _, entry in missing])
+    for (name, _), delayed_lookup in zip(missing, delayed_lookups):
+        if delayed_lookup:
+            # Like download_symbol()'s "Symbol Not Found Yet".
+            results[name]["delayed_lookup"] = True
+
+    response = http.JsonResponse(results)
+    if request._request_debug:
+        set_debug_time(response, downloader)
+    return response
+
+
+def handle_missing_symbol(symbol, debugid, filename, code_file="", code_id=""):
+    """Log that a symbol could not be found and, if it could be, start
+    downloading it from Microsoft. Return True if that was started (or
+    has been recently) so that it might be found later."""
+    missing_symbol_hash = log_symbol_get_404(
+        symbol, debugid, filename, code_file=code_file, code_id=code_id
+    )
+
+    if should_download_from_microsoft(symbol, filename):
+        # The log_symbol_get_404() function is protected by a cache
+        # that "guards" it with a memoize decorator. That memoize
+        # decorator makes sure the same arguments aren't allowed
+        # in more than once (per time interval the memoize cache
+        # is configured to).
+        # However, if it did run (and wasn't memoize blocked), it
+        # yields a hash to "describe" the missing symbol. That's
+        # useful to have when downloading from Microsoft.
+        # The function 'download_from_microsoft()' is will
+        # get or create one of those hashes no matter what. Here
+        # we're just doing a little optimization by passing that
+        # along to download_from_microsoft() to save it some effort.
+        if missing_symbol_hash and isinstance(missing_symbol_hash, bool):
+            missing_symbol_hash = None
+
+        # If we haven't already sent it to the 'download_microsoft_symbol'
+        # background task, do so.
+        download_from_microsoft(
+            symbol,
+            debugid,
+            code_file=code_file,
+            code_id=code_id,
+            missing_symbol_hash=missing_symbol_hash,
+        )
+
+        # The querying of Microsoft's server is potentially slow.
+        # That's why this call is down in a celery task.
+        # But there is hope! And the client ought to be informed
+        # that if they just try again in a couple of seconds/minutes
+        # it might just be there.
+        return True
+    return False
+
+
+def handle_missing_symbols(entries):
+    """Like handle_missing_symbol() but for many lists of symbol, debugid,
+    filename and, optionally, code_file and code_id at once. With one
+    cache lookup, one database query and one more cache lookup for the
+    downloads from Microsoft. Return a list of the same booleans
+    handle_missing_symbol() would, in the same order."""
+    entries = [(*entry, "", "")[:5] for entry in entries]
+    if not entries:
+        return []
+
+    # Same "guard" as the cache_memoize decorator of log_symbol_get_404().
+    guard_keys = {entry: make_log_symbol_get_404_key(*entry) for entry in entries}
+    guarded = cache.get_many(list(guard_keys.values()))
+    unguarded = [entry for entry, key in guard_keys.items() if key not in guarded]
+    missing_symbol_hashes = {}
+    if unguarded:
+        if settings.ENABLE_STORE_MISSING_SYMBOLS:
+            try:
+                missing_symbol_hashes = store_missing_symbols(unguarded)
+            except OperationalError:
+                # See log_symbol_get_404().
+                for symbol, debugid, filename, code_file, code_id in unguarded:
+                    store_missing_symbol_task.delay(
+                        symbol, debugid, filename, code_file=code_file, code_id=code_id
+                    )
+        cache.set_many(
+            {guard_keys[entry]: True for entry in unguarded},
+            settings.MEMOIZE_LOG_MISSING_SYMBOLS_SECONDS,
+        )
+
+    downloadable = {
+        entry: make_microsoft_download_key(entry[0], entry[1])
+        for entry in entries
+        if should_download_from_microsoft(entry[0], entry[2])
+    }
+    if downloadable:
+        downloading = cache.get_many(list(downloadable.values()))
+        started = {}
+        for entry, cache_key in downloadable.items():
+            if downloading.get(cache_key) or cache_key in started:
+                continue
+            symbol, debugid, _, code_file, code_id = entry
+            download_microsoft_symbol.delay(
                 symbol,
                 debugid,
                 code_file=code_file,
                 code_id=code_id,
-                missing_symbol_hash=missing_symbol_hash,
+                missing_symbol_hash=missing_symbol_hashes.get(entry),
             )
+            started[cache_key] = True
+        if started:
+            cache.set_many(started, settings.MICROSOFT_DOWNLOAD_CACHE_TTL_SECONDS)
+    return [entry in downloadable for entry in entries]
 
-            # The querying of Microsoft's server is potentially slow.
-            # That's why this call is down in a celery task.
-            # But there is hope! And the client ought to be informed
-            # that if they just try again in a couple of seconds/minutes
-            # it might just be there.
-            delayed_lookup = True
 
-    response = http.HttpResponseNotFound(
-        "Symbol Not Found Yet" if delayed_lookup else "Symbol Not Found"
-    )
-    if request._request_debug:
-        response["Debug-Time"] = downloader.time_took
-    return response
+def make_log_symbol_get_404_key(symbol, debugid, filename, code_file="", code_id=""):
+    parts = (symbol, debugid, filename, code_file or "", code_id or "")
+    return hashlib.md5(force_bytes("log_symbol_get_404:" + ":".join(parts))).hexdigest()
 
 
 @cache_memoize(
@@ -234,6 +444,7 @@ def download_symbol(request, symbol, debugid, filename, try_symbols=False):
     # When you just want this to be a "guard" that protects it from
     # executing more than once.
     store_result=False,
+    key_generator_callable=make_log_symbol_get_404_key,
 )
 @metrics.timer("download_log_symbol_get_404")
 def log_symbol_get_404(symbol, debugid, filename, code_file="", code_id=""):
@@ -56,6 +56,11 @@ class S3:
     # The client will likely get a 504 error and will retry soon again.
     S3_PUT_READ_TIMEOUT = values.IntegerValue(30)  # seconds
 
+    # How many connections each S3 client keeps in its pool. If not set,
+    # it's UPLOAD_FILE_UPLOAD_MAX_WORKERS, or botocore's default of 10 if
+    # that's more. See tecken.storage.get_max_pool_connections.
+    S3_MAX_POOL_CONNECTIONS = values.IntegerValue(default=None)
+
 
 class GCS:  # Google Cloud Storage
 
@@ -208,6 +213,53 @@ class Core(AWS, GCP, Celery, S3, GCS, Configuration):
     # guard and this defines how long it should cache that it memoized.
     MEMOIZE_LOG_MISSING_SYMBOLS_SECONDS = values.IntegerValue(60 * 60 * 24)
 
+    # Every web worker process keeps the most recently used symbol tables
+    # in memory so hot symbols don't need to be fetched from the Redis store
+    # for every symbolication request. This is the max. total size, in
+    # bytes, of all the tables kept in memory per process.
+    # Set to 0 to disable.
+    SYMBOLICATE_MEMORY_CACHE_MAX_BYTES = values.IntegerValue(256 * 1024 * 1024)
+
+    # Between the in-memory cache and the Redis store, symbol tables are
+    # also kept as memory-mapped files on the local disk. That way all
+    # web worker processes on the same node share them and they survive
+    # workers being recycled. This directory should be on a local disk
+    # and the max. total size, in bytes, of all the files in it.
+    # Off unless a directory is set. Set either to empty/0 to disable.
+    SYMBOLICATE_DISK_CACHE_DIRECTORY = values.Value("")
+    SYMBOLICATE_DISK_CACHE_MAX_BYTES = values.IntegerValue(2 * 1024 * 1024 * 1024)
+
+    # Symbol files that a symbolication request needs but that aren't in the
+    # Redis store are downloaded concurrently. This is the max. number of
+    # threads, per process, doing those downloads.
+    SYMBOLICATE_DOWNLOAD_MAX_WORKERS = values.IntegerValue(10)
+
+    # How long, in seconds, a symbolication request waits for the symbol
+    # files it needs to be downloaded and parsed. Any that take longer are
+    # reported as unknown but, if they've started, the downloads carry on
+    # in the background.
+    SYMBOLICATE_DOWNLOAD_TIMEOUT_SECONDS = values.FloatValue(20.0)
+
+    # When a web worker needs to download a symbol file, it first takes a
+    # lease, in the Redis store, on it so that other web workers that need
+    # the same symbol wait for it instead of downloading it too.
+    # This is how long, in seconds, that lease lasts if it's not released.
+    SYMBOLICATE_DOWNLOAD_LEASE_SECONDS = values.IntegerValue(60)
+
+    # Freshly downloaded symbol tables are written into the Redis store by
+    # a background thread, per process, after the symbolication request is
+    # done with them. This is the max. number of bytes of symbol tables that
+    # can be waiting for it. Beyond that, the request thread writes it itself.
+    SYMBOLICATE_STORE_WRITER_MAX_PENDING_BYTES = values.IntegerValue(256 * 1024 * 1024)
+
+    # This is only really meant for the sake of being overrideable by
+    # other setting classes; in particular the 'Test' class.
+    SYNCHRONOUS_SYMBOLICATE_DOWNLOADS = False
+
+    # This is only really meant for the sake of being overrideable by
+    # other setting classes; in particular the 'Test' class.
+    SYNCHRONOUS_SYMBOLICATE_STORE_WRITES = False
+
     # Whether or not benchmarking is enabled. It's only useful to have this
     # enabled in environments dedicated for testing and load testing.
     BENCHMARKING_ENABLED = values.BooleanValue(False)
@@ -286,6 +338,10 @@ class Base(Core):
 
     REDIS_URL = values.Value("redis://redis-cache:6379/0")
     REDIS_STORE_URL = values.Value("redis://redis-store:6379/0")
+    # Where the symbol tables of the SYMBOLICATE_PINNED_MODULES are kept.
+    # It should be a Redis instance configured to never evict anything.
+    # If it's not set, nothing is pinned.
+    REDIS_PINNED_URL = values.Value("")
 
     REDIS_SOCKET_CONNECT_TIMEOUT = values.IntegerValue(1)
     REDIS_SOCKET_TIMEOUT = values.IntegerValue(2)
@@ -306,7 +362,7 @@ class Base(Core):
 
     @property
     def CACHES(self):
-        return {
+        caches = {
             "default": {
                 "BACKEND": "django_redis.cache.RedisCache",
                 "LOCATION": self.REDIS_URL,
@@ -330,6 +386,17 @@ class Base(Core):
                 },
             },
         }
+        if self.REDIS_PINNED_URL:
+            caches["pinned"] = {
+                "BACKEND": "django_redis.cache.RedisCache",
+                "LOCATION": self.REDIS_PINNED_URL,
+                "KEY_PREFIX": "pinned",
+                "OPTIONS": {
+                    "SOCKET_CONNECT_TIMEOUT": self.REDIS_STORE_SOCKET_CONNECT_TIMEOUT,
+                    "SOCKET_TIMEOUT": self.REDIS_STORE_SOCKET_TIMEOUT,
+                },
+            }
+        return caches
 
     LOGGING_USE_JSON = values.BooleanValue(False)
 
@@ -503,6 +570,28 @@ class Base(Core):
     # they become really handy to open in a browser and view directly.
     MIME_OVERRIDES = values.DictValue({"sym": "text/plain"})
 
+    # When a .sym file is uploaded, also upload a much smaller "sidecar"
+    # file next to it that only contains what symbolication needs. And,
+    # when symbolicating, download that sidecar, if it exists, instead
+    # of the .sym file.
+    ENABLE_SYMBOL_SIDECARS = values.BooleanValue(False)
+
+    # When a .sym file is uploaded, parse it right away and store its
+    # symbol table in the Redis store, instead of just invalidating what's
+    # there. Then the first symbolication request that needs it doesn't
+    # have to download and parse it.
+    WARM_SYMBOLICATE_CACHE_ON_UPLOAD = values.BooleanValue(False)
+
+    # Patterns (e.g. "xul.pdb" or "*.dll") of module names whose symbol
+    # tables are also kept in the "pinned" cache so that they can't be
+    # evicted by the LRU of the Redis store. See REDIS_PINNED_URL.
+    SYMBOLICATE_PINNED_MODULES = values.ListValue([])
+    # How long a pinned symbol table is kept after it was last stored, or
+    # read, in the pinned cache. Every new build of a pinned module, e.g. a
+    # nightly xul.pdb, is another symbol table and that Redis never evicts
+    # anything.
+    SYMBOLICATE_PINNED_TTL_SECONDS = values.IntegerValue(60 * 60 * 24 * 28)
+
     # Number of seconds to wait for a symbol download. If this
     # trips, no error will be raised and we'll just skip using it
     # as a known symbol file.
@@ -532,6 +621,54 @@ class Base(Core):
     # that we end up uploading to S3 we also cache invalidate.
     SYMBOLDOWNLOAD_EXISTS_TTL_SECONDS = values.IntegerValue(60 * 60 * 6)
 
+    # Public symbol sources (the URLs with "access=public") are checked and
+    # downloaded from with one requests session per source, so that the
+    # connections are kept alive between requests. This is how many
+    # connections, per host, each of them keeps. It should be at least as
+    # many as the number of threads of a web worker plus
+    # SYMBOLICATE_DOWNLOAD_MAX_WORKERS.
+    SYMBOLDOWNLOAD_HTTP_POOL_MAXSIZE = values.IntegerValue(20)
+    # How many times, and with what backoff, to retry connection errors and
+    # 500, 502 and 504 responses from public symbol sources.
+    # See tecken.base.utils.requests_retry_session.
+    SYMBOLDOWNLOAD_HTTP_RETRIES = values.IntegerValue(2)
+    SYMBOLDOWNLOAD_HTTP_BACKOFF_FACTOR = values.FloatValue(0.1)
+
+    # By default, a symbol is looked for in one source (SYMBOL_URLS) after
+    # the other. With this on, it's looked for in all of them at the same
+    # time, but the first source that has it still wins. Lookups are done
+    # in a thread pool, per process, of this many threads.
+    SYMBOLDOWNLOAD_PARALLEL_PROBING = values.BooleanValue(False)
+    SYMBOLDOWNLOAD_PROBE_MAX_WORKERS = values.IntegerValue(20)
+    # With SYMBOLDOWNLOAD_PARALLEL_PROBING, a lookup that takes longer than
+    # this percentile of the recent lookups of the same source is started
+    # again, and whichever of the two finishes first counts. 0 to disable.
+    SYMBOLDOWNLOAD_HEDGE_PERCENTILE = values.IntegerValue(95)
+    # Without SYMBOLDOWNLOAD_PARALLEL_PROBING, look first in the sources
+    # that have most often had the symbols. The first source, in order,
+    # that has a symbol still wins.
+    SYMBOLDOWNLOAD_ADAPTIVE_ORDERING = values.BooleanValue(False)
+
+    # How long presigned URLs, of symbols in private buckets, are valid.
+    # And for what fraction of that the same URL is handed out again, and
+    # the redirect to it can be cached (Cache-Control). 0 to not cache and
+    # never more than 0.9.
+    SYMBOLDOWNLOAD_PRESIGNED_URL_EXPIRES_SECONDS = values.IntegerValue(3600)
+    SYMBOLDOWNLOAD_PRESIGNED_URL_CACHE_FRACTION = values.FloatValue(0.5)
+
+    # The max number of symbols that can be looked up in one request to
+    # the batch download endpoint.
+    DOWNLOAD_BATCH_MAX_SYMBOLS = values.IntegerValue(1000)
+
+    # Whether to use the Bloom filters of the keys of every source (see
+    # tecken.base.symbolindex) to not look in sources that definitely
+    # don't have a symbol. They're built with the build-symbol-index
+    # management command, to have room for at least SYMBOL_INDEX_CAPACITY
+    # keys with a false positive rate of SYMBOL_INDEX_ERROR_RATE.
+    SYMBOL_INDEX_ENABLED = values.BooleanValue(False)
+    SYMBOL_INDEX_CAPACITY = values.IntegerValue(1_000_000)
+    SYMBOL_INDEX_ERROR_RATE = values.FloatValue(0.01)
+
     # Whether to start a background task to search for symbols
     # on Microsoft's server is protected by an in-memory cache.
     # This is quite important. Don't make it too long or else clients
@@ -675,6 +812,12 @@ class Test(Localdev):
     # entirely synchronous.
     SYNCHRONOUS_UPLOAD_FILE_UPLOAD = True
 
+    # Same thing but for downloading symbol files when symbolicating.
+    SYNCHRONOUS_SYMBOLICATE_DOWNLOADS = True
+
+    # And for writing symbol tables into the Redis store.
+    SYNCHRONOUS_SYMBOLICATE_STORE_WRITES = True
+
     # We might not enable it in certain environments but we definitely
     # want to test the code we have.
     ENABLE_TOKENS_AUTHENTICATION = True
@@ -687,6 +830,15 @@ class Test(Localdev):
     # that enable it deliberately.
     ENABLE_STORE_MISSING_SYMBOLS = False
 
+    # The in-memory cache of symbol tables is always off when testing
+    # except the tests that enable it deliberately. Otherwise it would
+    # survive the 'clear_redis_store' fixture.
+    SYMBOLICATE_MEMORY_CACHE_MAX_BYTES = 0
+
+    # Same for the on-disk symbol tables. Otherwise they would survive
+    # between tests, and test runs.
+    SYMBOLICATE_DISK_CACHE_DIRECTORY = ""
+
     # Disable the Auth0 in all tests. THere are some specific tests
     # that switch it back on to test the Auth0 blocked middleware.
     ENABLE_AUTH0_BLOCKED_CHECK = False
@@ -722,6 +874,12 @@ class Test(Localdev):
         "*@peterbe.com": "https://storage.googleapis.example.com/peterbe-com"
     }
 
+    @property
+    def REDIS_PINNED_URL(self):
+        # There's no Redis that never evicts when testing. The Redis store,
+        # with the "pinned" key prefix, stands in for it.
+        return self.REDIS_STORE_URL
+
     @property
     def CACHES(self):
         parent = super(Test, self).CACHES
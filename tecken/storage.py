@@ -3,6 +3,7 @@
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
 import re
+import threading
 from urllib.parse import urlparse, urlunparse
 
 from google.cloud import storage
@@ -11,6 +12,8 @@ from botocore.config import Config
 
 from django.conf import settings
 
+from tecken.base.utils import requests_retry_session
+
 
 ALL_POSSIBLE_S3_REGIONS = tuple(boto3.session.Session().get_available_regions("s3"))
 
@@ -104,6 +107,20 @@ class StorageBucket:
             )
         return self._client
 
+    @property
+    def session(self):
+        """return a requests session, for public HTTP access, that keeps
+        its connections alive between requests"""
+        if not getattr(self, "_session", None):
+            self._session = requests_retry_session(
+                retries=settings.SYMBOLDOWNLOAD_HTTP_RETRIES,
+                backoff_factor=settings.SYMBOLDOWNLOAD_HTTP_BACKOFF_FACTOR,
+                pool_maxsize=settings.SYMBOLDOWNLOAD_HTTP_POOL_MAXSIZE,
+                # A 5xx response is what the caller gets, like any other.
+                raise_on_status=False,
+            )
+        return self._session
+
     def get_storage_client(self, **config_params):
         """return a boto3 session client with different config parameters"""
         return get_storage_client(
@@ -120,24 +137,83 @@ class StorageBucket:
         return self._bucket
 
 
+# botocore's own default of the max number of connections a client keeps
+# in its pool.
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+
+def get_max_pool_connections():
+    """Return how many connections each S3 client should keep in its pool.
+    The same client is used by all the threads that upload the files of a
+    symbols archive so, unless S3_MAX_POOL_CONNECTIONS is set, it's at least
+    as many as UPLOAD_FILE_UPLOAD_MAX_WORKERS."""
+    if settings.S3_MAX_POOL_CONNECTIONS:
+        return settings.S3_MAX_POOL_CONNECTIONS
+    return max(
+        DEFAULT_MAX_POOL_CONNECTIONS, settings.UPLOAD_FILE_UPLOAD_MAX_WORKERS or 0
+    )
+
+
+class StorageClients:
+    """Every storage client ever made in this process, by everything it
+    was made with. Making a client, and finding its credentials, is slow
+    and every client has its own pool of connections. So they're made once
+    and shared by all requests and threads. Both boto3 clients and
+    google-cloud-storage clients are thread-safe.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, make):
+        """Return the client of this key. If there isn't one yet, it's
+        made by calling 'make()'."""
+        try:
+            return self._clients[key]
+        except KeyError:
+            pass
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = make()
+            return self._clients[key]
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+
+
+storage_clients = StorageClients()
+
+
 def get_storage_client(
     endpoint_url=None, region_name=None, is_google_cloud_storage=False, **config_params
 ):
+    """Return a shared client (see StorageClients) for this configuration."""
     if is_google_cloud_storage:
-        client = storage.Client.from_service_account_json(
-            settings.GOOGLE_APPLICATION_CREDENTIALS
+        return storage_clients.get(
+            ("gcs", settings.GOOGLE_APPLICATION_CREDENTIALS),
+            lambda: storage.Client.from_service_account_json(
+                settings.GOOGLE_APPLICATION_CREDENTIALS
+            ),
         )
-        return client
-    else:
-        options = {"config": Config(**config_params)}
-        if endpoint_url:
-            # By default, if you don't specify an endpoint_url
-            # boto3 will automatically assume AWS's S3.
-            # For local development we are running a local S3
-            # fake service with minio. Then we need to
-            # specify the endpoint_url.
-            options["endpoint_url"] = endpoint_url
-        if region_name:
-            options["region_name"] = region_name
-        session = boto3.session.Session()
-        return session.client("s3", **options)
+    config_params.setdefault("max_pool_connections", get_max_pool_connections())
+    key = ("s3", endpoint_url, region_name, tuple(sorted(config_params.items())))
+    return storage_clients.get(
+        key, lambda: _make_s3_client(endpoint_url, region_name, config_params)
+    )
+
+
+def _make_s3_client(endpoint_url, region_name, config_params):
+    options = {"config": Config(**config_params)}
+    if endpoint_url:
+        # By default, if you don't specify an endpoint_url
+        # boto3 will automatically assume AWS's S3.
+        # For local development we are running a local S3
+        # fake service with minio. Then we need to
+        # specify the endpoint_url.
+        options["endpoint_url"] = endpoint_url
+    if region_name:
+        options["region_name"] = region_name
+    session = boto3.session.Session()
+    return session.client("s3", **options)
@@ -0,0 +1,240 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Every node runs several web worker processes and each one keeps its own
+in-memory cache of symbol tables (see tecken.symbolicate.memorycache).
+A hot symbol like xul.pdb would then be held once per process. And it's
+all gone every time a web worker is recycled.
+
+So, between the in-memory cache and the Redis store, there's a tier of
+packed symbol tables in files on the local disk. They're written once,
+atomically, and never changed. Every process memory-maps them so they
+all share the same pages in the OS page cache.
+
+Each file starts with the invalidation generation (see
+tecken.symbolicate.memorycache) it was fetched in. Whoever opens a file
+has to check, with the Redis store, that its cache key hasn't been
+invalidated since that generation before trusting it.
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+import markus
+
+from django.conf import settings
+
+from .memorycache import (
+    GENERATION_MEMBER,
+    INVALIDATIONS_KEY,
+    MAX_INVALIDATION_GENERATIONS,
+)
+from .symboltable import SymbolTable, InvalidSymbolTable
+
+
+logger = logging.getLogger("tecken")
+metrics = markus.get_metrics("tecken")
+
+_HEADER = struct.Struct("<Q")  # generation
+
+_TEMPORARY_PREFIX = ".tmp-"
+
+# When the files take up more than 'max_bytes', the least recently used are
+# deleted until they take up no more than this fraction of it. So the
+# directory isn't scanned again on the very next write.
+EVICT_TO_FRACTION = 0.9
+
+
+class SymbolTableDiskCache:
+    """A directory of memory-mapped symbol table files, bounded by the total
+    size of all the files in it.
+
+    That total is counted as files are written and deleted. The directory
+    is only scanned, to know what the other processes have written, the
+    first time and when that count crosses 'max_bytes'.
+
+    If 'directory' or 'max_bytes' aren't set, the
+    SYMBOLICATE_DISK_CACHE_DIRECTORY and SYMBOLICATE_DISK_CACHE_MAX_BYTES
+    settings are used.
+    """
+
+    def __init__(self, directory=None, max_bytes=None):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        # None until the directory has been scanned.
+        self.total_bytes = None
+        self._lock = threading.Lock()
+
+    @property
+    def directory(self):
+        if self._directory is None:
+            return settings.SYMBOLICATE_DISK_CACHE_DIRECTORY
+        return self._directory
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is None:
+            return settings.SYMBOLICATE_DISK_CACHE_MAX_BYTES
+        return self._max_bytes
+
+    @property
+    def enabled(self):
+        return bool(self.directory and self.max_bytes)
+
+    @staticmethod
+    def queue_invalidations_check(pipeline, keys):
+        """Add the commands needed to find out if the files of these cache
+        keys can still be trusted to a Redis pipeline. The results of those
+        commands are what is_valid() expects, in the same order."""
+        pipeline.zscore(INVALIDATIONS_KEY, GENERATION_MEMBER)
+        for key in keys:
+            pipeline.zscore(INVALIDATIONS_KEY, key)
+
+    @staticmethod
+    def is_valid(file_generation, generation, invalidated_generation):
+        """Return true if the file, fetched in 'file_generation', can be
+        trusted given the current generation and the generation its cache
+        key was last invalidated in (None if it hasn't been recently)."""
+        generation = int(generation or 0)
+        if file_generation > generation:
+            # The sorted set of invalidations has been evicted from the
+            # Redis store so there's no way of knowing.
+            return False
+        if generation - file_generation > MAX_INVALIDATION_GENERATIONS:
+            # Too old. It might have been invalidated and then trimmed
+            # from the sorted set. Or the sorted set has been evicted, and
+            # created again, since.
+            return False
+        if invalidated_generation is None:
+            return True
+        return int(invalidated_generation) <= file_generation
+
+    def _path(self, key):
+        filename = hashlib.md5(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, filename)
+
+    def get(self, key):
+        """Return a tuple of (generation, SymbolTable) or None if there's
+        no (readable) file for this cache key."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Eviction is by modification time. So this makes it the
+            # most recently used.
+            os.utime(path)
+        except (OSError, ValueError):
+            # E.g. FileNotFoundError or, if the file is empty, which it
+            # should never be, ValueError.
+            return None
+        try:
+            generation, = _HEADER.unpack_from(buffer)
+            header_end = _HEADER.size
+            symbol_table = SymbolTable(memoryview(buffer)[header_end:])
+        except (struct.error, InvalidSymbolTable) as exception:
+            logger.warning(f"Unable to read symbol table from {path} ({exception})")
+            self.delete(key)
+            return None
+        return generation, symbol_table
+
+    def set(self, key, generation, buffer):
+        """Write the packed symbol table bytes, which were fetched in this
+        invalidation generation, to a file."""
+        if _HEADER.size + len(buffer) > self.max_bytes:
+            return
+        directory = self.directory
+        path = self._path(key)
+        temporary_path = None
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, temporary_path = tempfile.mkstemp(
+                dir=directory, prefix=_TEMPORARY_PREFIX
+            )
+            with os.fdopen(fd, "wb") as f:
+                f.write(_HEADER.pack(generation))
+                f.write(buffer)
+            replaced_size = self._get_size(path)
+            # The rename is atomic so no other process can ever open a
+            # half-written file.
+            os.replace(temporary_path, path)
+        except OSError as exception:
+            logger.warning(f"Unable to write symbol table to disk ({exception})")
+            if temporary_path:
+                try:
+                    os.remove(temporary_path)
+                except FileNotFoundError:
+                    pass
+            return
+        if self._add_bytes(_HEADER.size + len(buffer) - replaced_size):
+            self.evict()
+
+    def delete(self, key):
+        path = self._path(key)
+        size = self._get_size(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        self._add_bytes(-size)
+        return True
+
+    @staticmethod
+    def _get_size(path):
+        try:
+            return os.stat(path).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _add_bytes(self, size):
+        """Count 'size' more bytes of files and return true if the total
+        is now unknown, or more than 'max_bytes', and it's time to evict."""
+        with self._lock:
+            if self.total_bytes is None:
+                return True
+            self.total_bytes += size
+            total_bytes = self.total_bytes
+        metrics.gauge("symbolicate_disk_cache_bytes", total_bytes)
+        return total_bytes > self.max_bytes
+
+    def evict(self):
+        """Scan the directory and, if the total size of all the files in it
+        is more than 'max_bytes', delete the least recently used ones until
+        it's no more than EVICT_TO_FRACTION of it."""
+        max_bytes = self.max_bytes
+        files = []
+        total_bytes = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(_TEMPORARY_PREFIX):
+                # Some other process is writing it.
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total_bytes += stat.st_size
+        if total_bytes > max_bytes:
+            files.sort()
+            for _, size, path in files:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    # Some other process evicted it first.
+                    pass
+                total_bytes -= size
+                metrics.incr("symbolicate_disk_cache_evict", 1)
+                if total_bytes <= max_bytes * EVICT_TO_FRACTION:
+                    break
+        with self._lock:
+            self.total_bytes = total_bytes
+        metrics.gauge("symbolicate_disk_cache_bytes", total_bytes)
+
+
+symbol_table_disk_cache = SymbolTableDiskCache()
@@ -0,0 +1,217 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Every web worker process keeps its own little LRU cache of SymbolTable
+instances so that hot symbols (e.g. xul.pdb) don't have to be fetched
+from the Redis store for every single symbolication request.
+
+The problem with a per-process cache is invalidation. When a symbol is
+uploaded, invalidate_symbolicate_cache() deletes its keys from the Redis
+store but it can't reach into every web worker's memory. So it also
+writes down, in the Redis store, what it invalidated. All of that goes
+into one single sorted set:
+
+    * The member '__generation__' is a counter that is incremented
+      every time something is invalidated.
+    * Every other member is a cache key that was invalidated and its
+      score is the generation it was invalidated in.
+
+Each process remembers the last generation it has seen so, with one
+ZSCORE and one ZRANGEBYSCORE (pipelined together with the MGET of whatever
+isn't in memory), it can figure out exactly which cache keys it needs to
+drop. Keeping it all in one key means that if the Redis store's LRU
+evicts it, it's all gone at once. The generation then drops back to
+nothing, which is treated as "drop everything". And when the sorted set is
+created again, its generation starts from the current time shifted by
+GENERATION_EPOCH_BITS, far ahead of any generation of the evicted one, so
+whoever was on the evicted one is "too far behind" and drops everything
+too. Even if it never saw the generation drop.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import markus
+
+from django.conf import settings
+
+
+metrics = markus.get_metrics("tecken")
+
+INVALIDATIONS_KEY = "symbolicate:invalidations"
+GENERATION_MEMBER = "__generation__"
+
+# The sorted set of invalidated cache keys is trimmed so it doesn't grow
+# forever. Any process that is more than this many generations behind
+# has to drop everything it has in memory.
+MAX_INVALIDATION_GENERATIONS = 10000
+
+# The first generation of a new sorted set is the current UNIX time shifted
+# this many bits. That's still exact as a sorted set score (a double) and
+# leaves room for a million invalidations a second.
+GENERATION_EPOCH_BITS = 20
+
+
+def get_first_generation():
+    return int(time.time()) << GENERATION_EPOCH_BITS
+
+
+def get_generation(redis_store_connection):
+    """Return the current generation. 0 if there is none."""
+    return int(redis_store_connection.zscore(INVALIDATIONS_KEY, GENERATION_MEMBER) or 0)
+
+
+def record_invalidations(redis_store_connection, keys, delete=()):
+    """Write down in the Redis store that these cache keys have been
+    invalidated and return the new generation. See the module docstring.
+
+    The generation is incremented and the keys are added in one
+    transaction so nobody ever sees the new generation without its keys.
+    The raw Redis keys in 'delete' are deleted in the same transaction.
+    So whoever only writes a key if it hasn't been invalidated (see
+    tecken.symbolicate.utils.store_symbol_table) either writes it before
+    it's deleted or knows it's been invalidated.
+    """
+    if not keys:
+        return None
+    generations = []
+
+    def increment(pipeline):
+        generation = pipeline.zscore(INVALIDATIONS_KEY, GENERATION_MEMBER)
+        if generation is None:
+            generation = get_first_generation()
+        generation = int(generation) + 1
+        generations.append(generation)
+        pipeline.multi()
+        if delete:
+            pipeline.delete(*delete)
+        members = {key: generation for key in keys}
+        members[GENERATION_MEMBER] = generation
+        pipeline.zadd(INVALIDATIONS_KEY, members)
+        pipeline.zremrangebyscore(
+            INVALIDATIONS_KEY, "-inf", generation - MAX_INVALIDATION_GENERATIONS
+        )
+
+    # Retried, from the ZSCORE, if someone else changes the sorted set
+    # between the ZSCORE and the EXEC.
+    redis_store_connection.transaction(increment, INVALIDATIONS_KEY)
+    return generations[-1]
+
+
+class SymbolTableCache:
+    """LRU cache of SymbolTable instances, bounded by the total number of
+    bytes of all the tables in it rather than by the number of tables.
+
+    It's thread-safe since the same process might symbolicate in
+    multiple threads.
+    If 'max_bytes' isn't set, the SYMBOLICATE_MEMORY_CACHE_MAX_BYTES setting
+    is used.
+    """
+
+    def __init__(self, max_bytes=None):
+        self._max_bytes = max_bytes
+        self.total_bytes = 0
+        self.generation = None
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is None:
+            return settings.SYMBOLICATE_MEMORY_CACHE_MAX_BYTES
+        return self._max_bytes
+
+    def __len__(self):
+        return len(self._tables)
+
+    def __contains__(self, key):
+        return key in self._tables
+
+    def get(self, key):
+        with self._lock:
+            symbol_table = self._tables.get(key)
+            if symbol_table is not None:
+                self._tables.move_to_end(key)
+            return symbol_table
+
+    def set(self, key, symbol_table):
+        max_bytes = self.max_bytes
+        if symbol_table.nbytes > max_bytes:
+            # No point evicting everything to make room for something
+            # that won't fit anyway.
+            return
+        with self._lock:
+            previous = self._tables.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous.nbytes
+            self._tables[key] = symbol_table
+            self.total_bytes += symbol_table.nbytes
+            while self.total_bytes > max_bytes:
+                _, evicted = self._tables.popitem(last=False)
+                self.total_bytes -= evicted.nbytes
+                metrics.incr("symbolicate_memory_cache_evict", 1)
+        metrics.gauge("symbolicate_memory_cache_bytes", self.total_bytes)
+
+    def delete(self, key):
+        with self._lock:
+            symbol_table = self._tables.pop(key, None)
+            if symbol_table is not None:
+                self.total_bytes -= symbol_table.nbytes
+                return True
+        return False
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+            self.total_bytes = 0
+            self.generation = None
+
+    @staticmethod
+    def queue_invalidations_check(pipeline, generation):
+        """Add the commands needed to find out what's been invalidated since
+        'generation' to a Redis pipeline. The result of those two commands
+        is what apply_invalidations() expects."""
+        pipeline.zscore(INVALIDATIONS_KEY, GENERATION_MEMBER)
+        pipeline.zrangebyscore(INVALIDATIONS_KEY, "({}".format(generation or 0), "+inf")
+
+    def apply_invalidations(self, generation, invalidated, known_generation):
+        """Drop everything that has been invalidated since 'known_generation'
+        and return a set of the cache keys that were dropped.
+
+        If it's impossible to know exactly what has been invalidated, e.g.
+        because this process is too far behind or because the sorted set
+        has been evicted from the Redis store, everything is dropped.
+        """
+        generation = int(generation or 0)
+        dropped = set()
+        with self._lock:
+            if self.generation != known_generation:
+                # Some other thread has already moved on.
+                return dropped
+            if self.generation is None:
+                # Never checked before. Then there's nothing in memory
+                # that could be out of date.
+                pass
+            elif (
+                generation < self.generation
+                or generation - self.generation > MAX_INVALIDATION_GENERATIONS
+            ):
+                dropped.update(self._tables)
+                self._tables.clear()
+                self.total_bytes = 0
+            else:
+                for key in invalidated:
+                    if isinstance(key, bytes):
+                        key = key.decode("utf-8")
+                    symbol_table = self._tables.pop(key, None)
+                    if symbol_table is not None:
+                        self.total_bytes -= symbol_table.nbytes
+                        dropped.add(key)
+            self.generation = generation
+        return dropped
+
+
+symbol_table_cache = SymbolTableCache()
@@ -0,0 +1,93 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+The Redis store is an LRU. A burst of lookups of rarely used symbols can
+evict the symbol table of something like xul.pdb, which is needed by
+almost every symbolication request and takes seconds to download again.
+
+So the symbol tables of the modules that match one of the
+SYMBOLICATE_PINNED_MODULES patterns are also written into the "pinned"
+cache. That's a separate Redis instance (REDIS_PINNED_URL) configured to
+never evict anything. If it's not set, nothing is pinned (and that's logged
+as a warning) since a copy in the Redis store would be just as evictable.
+
+The pinned copy is only read if the symbol table isn't in the Redis store.
+It expires SYMBOLICATE_PINNED_TTL_SECONDS after it was last stored, or read,
+since every new build of a pinned module is another symbol table.
+"""
+
+import fnmatch
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+from django_redis import get_redis_connection
+
+from .symboltable import make_symbol_table_cache_key
+
+
+logger = logging.getLogger("tecken")
+
+# How many keys to ask for, per SCAN command, when listing everything
+# that is pinned.
+SCAN_COUNT = 1000
+
+
+_warned_disabled = False
+
+
+def is_enabled():
+    """Return true if there is a pinned Redis (REDIS_PINNED_URL)."""
+    return bool(settings.REDIS_PINNED_URL)
+
+
+def is_pinned(symbol_key):
+    """Return true if the module name of this symbol key, e.g.
+    ('xul.pdb', 'HEX'), matches any of the SYMBOLICATE_PINNED_MODULES
+    patterns. Always false if there's no pinned Redis."""
+    global _warned_disabled
+    if not settings.SYMBOLICATE_PINNED_MODULES:
+        return False
+    if not is_enabled():
+        if not _warned_disabled:
+            logger.warning(
+                "SYMBOLICATE_PINNED_MODULES is set but REDIS_PINNED_URL isn't. "
+                "Nothing is pinned."
+            )
+            _warned_disabled = True
+        return False
+    module_name = symbol_key[0].lower()
+    return any(
+        fnmatch.fnmatchcase(module_name, pattern.lower())
+        for pattern in settings.SYMBOLICATE_PINNED_MODULES
+    )
+
+
+def make_pinned_key(cache_key):
+    """Return the raw Redis key of the pinned symbol table of this cache
+    key (see tecken.symbolicate.utils.make_symbol_key_cache_key)."""
+    return caches["pinned"].make_key(make_symbol_table_cache_key(cache_key))
+
+
+def get_pinned_symbol_tables():
+    """Return a list of dicts of the symbol ("module/debugid") and the size,
+    in bytes, of every pinned symbol table. Sorted by size, biggest first."""
+    if not is_enabled():
+        return []
+    connection = get_redis_connection("pinned")
+    pattern = make_pinned_key("symbol:*")
+    keys = list(connection.scan_iter(match=pattern, count=SCAN_COUNT))
+    pipeline = connection.pipeline(transaction=False)
+    for key in keys:
+        pipeline.strlen(key)
+    sizes = pipeline.execute() if keys else []
+    # The key looks like this:
+    #  'pinned:1:symbol:abcde:xul.pdb/44E4EC8C2F41492B9369D6B9A059577C2:packed'
+    found = []
+    for key, size in zip(keys, sizes):
+        symbol = key.decode("utf-8").rsplit(":", 2)[-2]
+        found.append({"symbol": symbol, "size": size})
+    found.sort(key=lambda x: (-x["size"], x["symbol"]))
+    return found
@@ -0,0 +1,75 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Every symbolication response has a Server-Timing header
+(https://www.w3.org/TR/server-timing/) with how long each phase of it
+took. Unlike the debug output, that doesn't have to be asked for, so
+it ends up in the load balancer logs for every request.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import markus
+
+
+metrics = markus.get_metrics("tecken")
+
+# Symbol sizes, in bytes, are tagged as the first of these buckets that
+# they're smaller than.
+SIZE_BUCKETS = (
+    (1024 * 1024, "lt1mb"),
+    (10 * 1024 * 1024, "lt10mb"),
+    (100 * 1024 * 1024, "lt100mb"),
+)
+
+
+def get_size_tag(size):
+    """Return the markus tag of the bucket of a symbol of this many
+    bytes."""
+    for limit, name in SIZE_BUCKETS:
+        if size < limit:
+            return f"size:{name}"
+    return "size:gte100mb"
+
+
+class ServerTiming:
+    """The total time, in seconds, of each phase of one request.
+
+    Phases can be timed from more than one thread at the same time (e.g.
+    when downloading symbols concurrently). Then their times add up.
+    """
+
+    def __init__(self):
+        self.timings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def time(self, phase):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - t0)
+
+    def get_header(self):
+        """Return the value of the Server-Timing header. The durations are
+        in milliseconds."""
+        return ", ".join(
+            f"{phase};dur={seconds * 1000:.1f}"
+            for phase, seconds in self.timings.items()
+        )
+
+    def send_metrics(self):
+        for phase, seconds in self.timings.items():
+            metrics.histogram(
+                "symbolicate_phase_time", seconds * 1000, tags=[f"phase:{phase}"]
+            )
@@ -0,0 +1,133 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Writing a freshly downloaded symbol table into the Redis store can take
+a while for big symbols. The symbolication request that downloaded it
+doesn't need to wait for that since it already has the table in memory.
+So the writes are handed to one background thread per process instead.
+
+The queue of pending writes is bounded by the total number of bytes
+waiting to be written. If there's no room left, the write is done right
+away in the thread that asked for it. That's slower for that one
+request but it means a burst of downloads can't eat all the memory.
+"""
+
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import markus
+
+
+logger = logging.getLogger("tecken")
+metrics = markus.get_metrics("tecken")
+
+# When the process exits, wait this many seconds, at most, for the pending
+# writes to finish.
+SHUTDOWN_FLUSH_TIMEOUT = 10
+
+
+class StoreWriter:
+    """Calls 'write' in a background thread with the arguments that
+    are submitted.
+
+    Pending writes are deduplicated by key. If a write is submitted for
+    a key that is already pending, only the latest arguments are written
+    but all the 'after' callbacks are called once it's done.
+
+    At most 'max_pending_bytes' (the sum of the 'nbytes' of every submitted
+    write) are pending at any time. If it's 0, everything is written right
+    away, in the thread that submits it.
+    """
+
+    def __init__(self, write, max_pending_bytes):
+        self.write = write
+        self.max_pending_bytes = max_pending_bytes
+        self.pending_bytes = 0
+        self._pending = OrderedDict()
+        self._writing = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, key, *args, nbytes=0, after=None):
+        """Write 'args', that take up 'nbytes' in memory, for this key,
+        sooner or later. If 'after' is set, it's called, without any
+        arguments, once the write is done. Even if the write failed."""
+        callbacks = []
+        with self._condition:
+            if key in self._pending:
+                _, previous_nbytes, callbacks = self._pending.pop(key)
+                self.pending_bytes -= previous_nbytes
+                metrics.incr("symbolicate_store_writer_deduplicated", 1)
+            if after is not None:
+                callbacks.append(after)
+            if self.max_pending_bytes and (
+                self.pending_bytes + nbytes <= self.max_pending_bytes
+            ):
+                self._pending[key] = (args, nbytes, callbacks)
+                self.pending_bytes += nbytes
+                self._start()
+                self._condition.notify_all()
+                return
+        if self.max_pending_bytes:
+            metrics.incr("symbolicate_store_writer_full", 1)
+        self._write(key, args, callbacks)
+
+    def flush(self, timeout=None):
+        """Wait until all pending writes are done. Return False if that
+        didn't happen within 'timeout' seconds."""
+        deadline = timeout is not None and time.monotonic() + timeout
+        with self._condition:
+            while self._pending or self._writing:
+                remaining = None
+                if deadline:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                self._condition.wait(remaining)
+        return True
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="symbolicate-store-writer", daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.flush, SHUTDOWN_FLUSH_TIMEOUT)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                key, (args, nbytes, callbacks) = self._pending.popitem(last=False)
+                self.pending_bytes -= nbytes
+                self._writing += 1
+            try:
+                self._write(key, args, callbacks)
+            finally:
+                with self._condition:
+                    self._writing -= 1
+                    self._condition.notify_all()
+
+    def _write(self, key, args, callbacks):
+        try:
+            with metrics.timer("symbolicate_store_symbol_table"):
+                self.write(*args)
+        except Exception:
+            logger.exception(f"Unable to write {key} to the store")
+        finally:
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception(f"Callback after writing {key} failed")
+            metrics.gauge("symbolicate_store_writer_pending", len(self._pending))
+            metrics.gauge("symbolicate_store_writer_pending_bytes", self.pending_bytes)
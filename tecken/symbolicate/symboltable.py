@@ -0,0 +1,211 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import struct
+import sys
+from array import array
+from bisect import bisect
+from itertools import accumulate
+
+
+# Every packed symbol table starts with this header. The "magic" is there
+# so we can tell a packed table apart from anything else that might be
+# stored under the same key (e.g. a msgpack'ed value from django_redis).
+# The version is there so that, if we ever change the layout, old tables
+# can be recognized and ignored.
+MAGIC = b"TSYM"
+VERSION = 1
+_HEADER = struct.Struct("<4sIQ")  # magic, version, count (16 bytes total)
+
+# Packed tables are always little-endian.
+_NATIVE_LITTLE_ENDIAN = sys.byteorder == "little"
+
+# When a .sym file is uploaded, its packed symbol table is uploaded next to
+# it, with this appended to its name. Then symbolication can download that
+# instead of downloading, and parsing, the whole .sym file.
+SIDECAR_SUFFIX = ".packed"
+
+
+def make_symbol_table_cache_key(cache_key):
+    """return the string key under which the packed symbol table is stored
+    for a cache key made by
+    tecken.symbolicate.utils.make_symbol_key_cache_key()."""
+    return cache_key + ":packed"
+
+
+class InvalidSymbolTable(ValueError):
+    """When the bytes can't be understood as a packed symbol table."""
+
+
+def pack_symbol_map(symbol_map):
+    """Return a bytes object that represents a dict of offset->name.
+    See pack_symbol_table()."""
+    offsets = array("Q", sorted(symbol_map))
+    return pack_symbol_table(
+        offsets, [symbol_map[offset].encode("utf-8") for offset in offsets]
+    )
+
+
+def pack_symbol_table(offsets, names):
+    """Return a bytes object that represents a list of sorted offsets and
+    a list of their UTF-8 encoded names.
+
+    The layout is:
+
+        header   (magic, version, count)
+        offsets  count * uint64, sorted ascending
+        index    (count + 1) * uint32, where each name starts in the blob
+        names    all names, UTF-8 encoded, back to back
+
+    Since the offsets are sorted, anybody holding the bytes can bisect
+    directly on the packed buffer without first turning it into a
+    Python list.
+    """
+    index = array("I", [0])
+    index.extend(accumulate(len(name) for name in names))
+    return pack_symbol_table_from_index(offsets, index, b"".join(names))
+
+
+def pack_symbol_table_from_index(offsets, index, names):
+    """Same as pack_symbol_table() but for names that are already all in
+    one bytes-like object, where the n-th one is names[index[n]:index[n + 1]],
+    and 'index' is an `array('I')`."""
+    if not isinstance(offsets, array) or offsets.typecode != "Q":
+        offsets = array("Q", offsets)
+    if not _NATIVE_LITTLE_ENDIAN:  # pragma: no cover
+        offsets = array("Q", offsets)  # don't byteswap the caller's array
+        offsets.byteswap()
+        index = array("I", index)
+        index.byteswap()
+    return b"".join(
+        [_HEADER.pack(MAGIC, VERSION, len(offsets)), offsets.tobytes(), index, names]
+    )
+
+
+class SymbolTable:
+    """Read-only wrapper around the bytes made by `pack_symbol_map()`.
+
+    Nothing is copied or decoded when it's created. The offsets and the
+    name index are memoryviews straight into the buffer and a name is only
+    decoded when it's looked up.
+
+    Usage::
+
+        >>> table = SymbolTable(pack_symbol_map({10: 'foo', 20: 'bar'}))
+        >>> len(table)
+        2
+        >>> table.lookup(25)
+        (20, 'bar')
+        >>> table.lookup(10)
+        (10, 'foo')
+    """
+
+    __slots__ = ("offsets", "_index", "_names", "nbytes")
+
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        if len(view) < _HEADER.size:
+            raise InvalidSymbolTable("Too short to be a symbol table")
+        magic, version, count = _HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise InvalidSymbolTable("Not a symbol table")
+        if version != VERSION:
+            raise InvalidSymbolTable(f"Unrecognized symbol table version {version}")
+        offsets_end = _HEADER.size + count * 8
+        index_end = offsets_end + (count + 1) * 4
+        if len(view) < index_end:
+            raise InvalidSymbolTable("Truncated symbol table")
+        header_end = _HEADER.size
+        offsets = view[header_end:offsets_end].cast("Q")
+        index = view[offsets_end:index_end].cast("I")
+        if not _NATIVE_LITTLE_ENDIAN:  # pragma: no cover
+            offsets = array("Q", offsets)
+            offsets.byteswap()
+            index = array("I", index)
+            index.byteswap()
+        if len(view) != index_end + index[count]:
+            raise InvalidSymbolTable("Truncated symbol table")
+        self.offsets = offsets
+        self._index = index
+        self._names = view[index_end:]
+        self.nbytes = len(view)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {len(self):,} offsets>"
+
+    def get_name(self, i):
+        """Return the name of the i-th function in the table."""
+        start, end = self._index[i], self._index[i + 1]
+        # Symbol files are supposed to be UTF-8 but we don't want one
+        # bad byte to break the whole symbolication.
+        return str(self._names[start:end], "utf-8", "replace")
+
+    def lookup(self, offset):
+        """Return a tuple of (function_start, name) for the function that
+        contains this offset. Or None if the table is empty.
+
+        The origin of this is that we look for offsets in a stack as these
+        are kinda like lines of code. Imagine this C++ program::
+
+            10) ...
+            11) void some_function() {
+            12)     ...
+            13)     ...
+            14)     ...
+            15) }
+            17) void other_function() {
+            18)     ...
+            19) }
+            20) ...
+
+        Here, the offsets are going to be [11, 17]. The offsets where the
+        functions are.
+        Suppose the 'offset' we're being asked to look up is 13, meaning
+        the interesting thing happened on "line" 13. The nearest "function
+        definition line" is 11. That's where the function was defined.
+        To find 11, we bisect the list of all offsets and subtract 1.
+        I.e. bisect([11, 17], 13) == p == 1
+        And [11, 17][p - 1] == 11
+
+        Note that if the offset is smaller than the first offset, p - 1 is
+        -1 which, like a Python list, means the last function.
+        """
+        count = len(self.offsets)
+        if not count:
+            return None
+        i = bisect(self.offsets, offset) - 1
+        if i < 0:
+            i += count
+        return self.offsets[i], self.get_name(i)
+
+    def lookup_many(self, offsets):
+        """Return a dict of offset -> (function_start, name), like
+        lookup(), for every distinct offset in this iterable of offsets.
+        An empty dict if the table is empty.
+
+        This is much cheaper than calling lookup() for each one when there
+        are lots of offsets (e.g. a profile can have tens of thousands of
+        frames in the same module). Duplicate offsets are only looked up
+        once. The rest are looked up in ascending order so every bisect
+        can start where the previous one left off. And every name is only
+        decoded once, no matter how many offsets are in that function.
+        """
+        found = {}
+        count = len(self.offsets)
+        if not count:
+            return found
+        table_offsets = self.offsets
+        names = {}
+        i = 0
+        for offset in sorted(set(offsets)):
+            i = bisect(table_offsets, offset, i)
+            function = i - 1 if i else count - 1
+            name = names.get(function)
+            if name is None:
+                name = names[function] = self.get_name(function)
+            found[offset] = (table_offsets[function], name)
+        return found
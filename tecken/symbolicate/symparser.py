@@ -0,0 +1,241 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+A parser for Breakpad .sym files that only cares about the FUNC and PUBLIC
+records. See
+https://chromium.googlesource.com/breakpad/breakpad/+/master/docs/symbol_files.md
+
+Most of a .sym file is FILE, LINE (the lines that are just numbers),
+INLINE and STACK records. For symbolication we don't need any of those.
+So instead of decoding and splitting every line, big chunks of bytes are
+searched for the lines that start with "FUNC " or "PUBLIC " and only those
+lines are split. Only the function names of those lines are ever
+copied out and they're never decoded. They're kept as UTF-8 bytes
+because that's how they're stored in the packed symbol table anyway.
+
+A big .sym file has hundreds of thousands of names. Keeping each of them
+as its own bytes object costs more memory than the names themselves. So
+they're appended to one bytearray, with an array of where each one ends,
+and close_index() copies them, in order, into the one buffer of names of
+the packed symbol table.
+"""
+
+from array import array
+from itertools import accumulate, chain, compress, islice, repeat
+from operator import and_, lshift, ne, or_, rshift, sub
+
+
+# A FUNC record looks like this:
+#
+#   FUNC [m] address size parameter_size name
+#
+# and a PUBLIC record looks like this:
+#
+#   PUBLIC [m] address parameter_size name
+#
+# The "m" is special. It's an extra *optional* prefix which we currently
+# omit.
+# Origin: https://bugs.chromium.org/p/google-breakpad/issues/detail?id=751
+# Note, as pointed out in
+# https://github.com/mozilla-services/tecken/issues/924#issuecomment-399130860
+# some day we might actually extract and use the presence of this 'm'
+# as a potential factor of the symbolication.
+# As of June 2018, we deliberately omit it.
+#
+# The values are how many fields to split the rest of the line into.
+# The last one is always the name, which might contain spaces.
+_RECORDS = ((b"FUNC ", 4), (b"PUBLIC ", 3))
+
+# How many names close_index() copies at a time. Each one is copied into a
+# short-lived object so this caps how many of those there are at once.
+_COPY_BATCH_SIZE = 8192
+
+# The lower 32 bits of the sort key of a record (see
+# SymbolFileParser._finish()) are its position.
+_POSITION_MASK = 0xFFFFFFFF
+
+
+class _Records:
+    """The offsets and names of all the records of one kind (FUNC or
+    PUBLIC) in the order they were found."""
+
+    __slots__ = ("offsets", "names", "ends")
+
+    def __init__(self):
+        self.offsets = array("Q")
+        # All the names back to back. The n-th name ends at ends[n].
+        self.names = bytearray()
+        self.ends = array("I")
+
+
+class SymbolFileParser:
+    """Feed it chunks of bytes, of any size, from a .sym file and, when
+    done, call `close()` to get the sorted offsets and their names. Or
+    `close_index()` to get them ready for packing into a symbol table.
+
+    Usage::
+
+        >>> parser = SymbolFileParser()
+        >>> parser.feed(b"MODULE windows x86 ABC xul.pdb\\nFUNC 1a 2 0 f")
+        >>> parser.feed(b"oo()\\n1a 1 10 1\\nPUBLIC 10 0 bar\\n")
+        >>> parser.close()
+        (array('Q', [16, 26]), [b'bar', b'foo()'])
+    """
+
+    def __init__(self):
+        self.size = 0
+        self._funcs = _Records()
+        self._publics = _Records()
+        # Whatever comes after the last newline of the last chunk fed.
+        self._pending = b""
+
+    def feed(self, chunk):
+        """Parse every complete line in this chunk of bytes. An incomplete
+        last line is remembered until the next chunk, or close(), completes
+        it.
+
+        The chunk can be anything bytes-like that has a find() and a
+        rfind() method (e.g. bytes, bytearray or mmap.mmap). A memoryview
+        is copied to bytes first.
+        """
+        if isinstance(chunk, memoryview):
+            chunk = chunk.tobytes()
+        self.size += len(chunk)
+        last_newline = chunk.rfind(b"\n")
+        if last_newline == -1:
+            self._pending += chunk
+            return
+        start = 0
+        if self._pending:
+            first_newline = chunk.find(b"\n")
+            self._parse(self._pending + chunk[:first_newline])
+            start = first_newline + 1
+        self._parse(chunk, start, last_newline)
+        rest = last_newline + 1
+        self._pending = bytes(chunk[rest:])
+
+    def close(self):
+        """Return a tuple of (offsets, names) where the offsets are an
+        `array('Q')` sorted in ascending order and the names are a list
+        of the UTF-8 encoded names of each offset.
+
+        If a PUBLIC and a FUNC record have the same address, the PUBLIC
+        name wins.
+        """
+        offsets, starts, ends, names = self._finish()
+        return offsets, [bytes(names[start:end]) for start, end in zip(starts, ends)]
+
+    def close_index(self):
+        """Return a tuple of (offsets, index, names) for
+        tecken.symbolicate.symboltable.pack_symbol_table_from_index().
+        Same as what close() returns, but the names are all in one
+        bytearray, and the n-th one is names[index[n]:index[n + 1]].
+
+        That never makes a bytes object, and a list, of every name.
+        """
+        offsets, starts, ends, names = self._finish()
+        index = array("I", [0])
+        index.extend(accumulate(map(sub, ends, starts)))
+        packed_names = bytearray()
+        for i in range(0, len(offsets), _COPY_BATCH_SIZE):
+            batch = slice(i, i + _COPY_BATCH_SIZE)
+            slices = map(slice, starts[batch], ends[batch])
+            packed_names += b"".join(map(names.__getitem__, slices))
+        return offsets, index, packed_names
+
+    def _finish(self):
+        """Parse whatever is left and return a tuple of (offsets, starts,
+        ends, names). The offsets are sorted and the name of offsets[n] is
+        names[starts[n]:ends[n]]."""
+        if self._pending:
+            self._parse(self._pending)
+            self._pending = b""
+        funcs = self._funcs
+        publics = self._publics
+        self._funcs = _Records()
+        self._publics = _Records()
+        func_count = len(funcs.offsets)
+        count = func_count + len(publics.offsets)
+        # Every name of both kinds goes into one buffer, FUNC names first.
+        names = funcs.names
+        func_names_size = len(names)
+        names += publics.names
+        del publics.names[:]
+        all_ends = funcs.ends
+        all_ends.extend(end + func_names_size for end in publics.ends)
+        all_starts = array("I", [0])
+        all_starts.extend(all_ends[:-1])
+        # Sort the records by one int per record, made of the offset and the
+        # position of the record in all_ends, instead of a dict or a list
+        # of tuples. Then there's only one small object per record. Of
+        # all the records with the same offset, the last one wins. Since
+        # the PUBLIC records come after the FUNC ones, PUBLIC wins.
+        all_offsets = chain(funcs.offsets, publics.offsets)
+        keys = sorted(map(or_, map(lshift, all_offsets, repeat(32)), range(count)))
+        offsets = array("Q", map(rshift, keys, repeat(32)))
+        last = bytes(chain(map(ne, offsets, islice(offsets, 1, None)), (True,)))
+        positions = array("I", map(and_, compress(keys, last), repeat(_POSITION_MASK)))
+        del keys
+        offsets = array("Q", compress(offsets, last))
+        starts = array("I", map(all_starts.__getitem__, positions))
+        ends = array("I", map(all_ends.__getitem__, positions))
+        return offsets, starts, ends, names
+
+    def _parse(self, data, pos=0, endpos=None):
+        """Find all FUNC and PUBLIC lines in data[pos:endpos], which has to
+        start at the beginning of a line.
+
+        Searching for b"\nFUNC " with bytes.find() is done in C and is
+        much faster than looking at every line in Python. Or even than
+        a regular expression anchored to the start of every line.
+        """
+        if endpos is None:
+            endpos = len(data)
+        find = data.find
+        for prefix, maxsplit in _RECORDS:
+            records = self._funcs if prefix == b"FUNC " else self._publics
+            add_offset = records.offsets.append
+            add_name = records.names.extend
+            add_end = records.ends.append
+            marker = b"\n" + prefix
+            skip = len(prefix)
+            if data.startswith(prefix, pos):
+                start = pos
+            else:
+                start = find(marker, pos, endpos)
+                if start != -1:
+                    start += 1
+            while start != -1:
+                end = find(b"\n", start, endpos)
+                if end == -1:
+                    end = endpos
+                rest = data[start + skip : end]  # noqa
+                if rest.startswith(b"m "):
+                    rest = rest[2:]
+                fields = rest.split(None, maxsplit - 1)
+                if len(fields) == maxsplit:
+                    try:
+                        offset = int(fields[0], 16)
+                    except ValueError:
+                        pass
+                    else:
+                        name = fields[-1].rstrip()
+                        if name:
+                            add_offset(offset)
+                            add_name(name)
+                            add_end(len(records.names))
+                start = find(marker, end, endpos)
+                if start != -1:
+                    start += 1
+
+
+def parse_symbol_file(chunks):
+    """Return a tuple of (offsets, names, size) for an iterable of chunks of
+    bytes of a whole .sym file. See SymbolFileParser.close()."""
+    parser = SymbolFileParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    offsets, names = parser.close()
+    return offsets, names, parser.size
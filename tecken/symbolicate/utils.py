@@ -3,9 +3,29 @@
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
 import hashlib
+import uuid
+
+import markus
 
 from django.core.cache import caches
 from django.conf import settings
+from django_redis import get_redis_connection
+
+from .memorycache import INVALIDATIONS_KEY, record_invalidations, symbol_table_cache
+from .pinned import is_enabled as is_pinning_enabled, is_pinned, make_pinned_key
+from .symboltable import make_symbol_table_cache_key
+
+
+metrics = markus.get_metrics("tecken")
+store = caches["store"]
+
+# When writing a packed symbol table into the Redis store, anything bigger
+# than this is sent in chunks. See queue_set_buffer().
+STORE_CHUNK_SIZE = 5 * 1024 * 1024
+
+# How long, in seconds, the temporary key of a chunked write is kept if the
+# write never finishes.
+TEMPORARY_KEY_TIMEOUT = 60 * 10
 
 
 def make_symbol_key_cache_key_default_prefix():
@@ -44,14 +64,140 @@ def invalidate_symbolicate_cache(symbol_keys, prefix=None):
     """Makes sure all symbolication caching stored for this list of
     symbol keys is removed from the Redis store."""
     all_keys = []
+    cache_keys = []
     for symbol_key in symbol_keys:
-        # Every symbol, for the sake of symbolication, is stored in two
-        # ways:
+        # Every symbol, for the sake of symbolication, is stored as one
+        # packed symbol table. But it might also still be stored in the
+        # legacy layout:
         # 1) symbol_key + ':keys'  (plain SET)
         # 2) symbol_key (as hashmap)
         cache_key = make_symbol_key_cache_key(symbol_key, prefix=prefix)
-        all_keys.append(cache_key)  # the hashmap
-        all_keys.append(cache_key + ":keys")  # the list of all offsets
+        cache_keys.append(cache_key)
+        all_keys.append(make_symbol_table_cache_key(cache_key))
+        all_keys.append(cache_key)  # the legacy hashmap
+        all_keys.append(cache_key + ":keys")  # the legacy list of all offsets
+
+    # Whatever is pinned has to go too. Otherwise it would be used as soon
+    # as the symbol table isn't in the Redis store.
+    if is_pinning_enabled():
+        caches["pinned"].delete_many(
+            [make_symbol_table_cache_key(cache_key) for cache_key in cache_keys]
+        )
+
+    # Every web worker might also have the symbol table in memory.
+    # Tell them all about it. In the same go as it's deleted from the
+    # Redis store.
+    record_invalidations(
+        get_redis_connection("store"),
+        cache_keys,
+        delete=[store.make_key(key) for key in all_keys],
+    )
+    for cache_key in cache_keys:
+        symbol_table_cache.delete(cache_key)
+
+
+def store_symbol_table(
+    cache_key, buffer, timeout=None, pinned=False, generation=None, pipeline=None
+):
+    """Write the packed symbol table bytes into the Redis store. And,
+    if 'pinned', into the pinned cache too (see
+    tecken.symbolicate.pinned).
+
+    All the commands for the Redis store are sent in one pipeline,
+    i.e. one round trip. If a 'pipeline' is passed in, the commands are
+    only added to it and it's up to the caller to execute it.
+
+    If 'generation' is set, nothing is written if the cache key has been
+    invalidated since that generation (see
+    tecken.symbolicate.memorycache.get_generation). Then it was
+    downloaded before whatever replaced it was uploaded.
+    """
+    table_key = store.make_key(make_symbol_table_cache_key(cache_key))
+    if generation is not None:
+        assert pipeline is None
+        if not _store_unless_invalidated(
+            cache_key, table_key, buffer, timeout, generation
+        ):
+            metrics.incr("symbolicate_store_invalidated", 1)
+            return
+    else:
+        execute = pipeline is None
+        if execute:
+            pipeline = get_redis_connection("store").pipeline(transaction=False)
+        queue_set_buffer(pipeline, table_key, buffer, timeout)
+        if execute:
+            pipeline.execute()
+    if pinned:
+        pinned_pipeline = get_redis_connection("pinned").pipeline(transaction=False)
+        queue_set_buffer(
+            pinned_pipeline,
+            make_pinned_key(cache_key),
+            buffer,
+            settings.SYMBOLICATE_PINNED_TTL_SECONDS,
+        )
+        pinned_pipeline.execute()
+        metrics.incr("symbolicate_pinned_store", 1)
+
+
+def queue_set_buffer(pipeline, key, buffer, timeout=None):
+    """Add the commands that SET the key to these bytes to the pipeline.
+
+    A really big value sent in one command might be too large
+    and if it is too large redis-py will throw a ConnectionError with
+    something like 'Errno 104' because Redis simply shuts down the
+    socket. Empirically we found that happens at around 9MB.
+    To avoid that, the bytes are appended in chunks to a temporary
+    key which is then renamed. The rename is atomic so nobody
+    can ever GET a half-written table. Every write has its own
+    temporary key, so two writes of the same key at the same time
+    don't append to the same one. And it expires, in case the write
+    never gets to the rename.
+    """
+    if len(buffer) <= STORE_CHUNK_SIZE:
+        pipeline.set(key, buffer, ex=timeout)
+    else:
+        temporary_key = "{}:tmp:{}".format(key, uuid.uuid4().hex)
+        for start in range(0, len(buffer), STORE_CHUNK_SIZE):
+            end = start + STORE_CHUNK_SIZE
+            pipeline.append(temporary_key, buffer[start:end])
+            if not start:
+                pipeline.expire(temporary_key, TEMPORARY_KEY_TIMEOUT)
+        pipeline.rename(temporary_key, key)
+        # The rename keeps the expiry of the temporary key.
+        if timeout:
+            pipeline.expire(key, timeout)
+        else:
+            pipeline.persist(key)
+
+
+def _store_unless_invalidated(cache_key, table_key, buffer, timeout, generation):
+    """Return true if the buffer was written because the cache key hasn't
+    been invalidated since this generation."""
+    stored = {}
+
+    def store_buffer(pipeline):
+        stored["value"] = False
+        invalidated = pipeline.zscore(INVALIDATIONS_KEY, cache_key)
+        if invalidated is not None and invalidated > generation:
+            return
+        pipeline.multi()
+        queue_set_buffer(pipeline, table_key, buffer, timeout)
+        stored["value"] = True
+
+    # Retried, from the ZSCORE, if anything is invalidated before the EXEC.
+    get_redis_connection("store").transaction(store_buffer, INVALIDATIONS_KEY)
+    return stored["value"]
+
 
-    store = caches["store"]
-    store.delete_many(all_keys)
+@metrics.timer_decorator("symbolicate_warm_cache")
+def warm_symbolicate_cache(symbol_key, buffer):
+    """Replace whatever is cached for this symbol key with this packed
+    symbol table. For when a symbol has just been uploaded and it's
+    better to parse it right away than to let the first symbolication
+    request that needs it download it again."""
+    # This has to happen before the symbol table is stored. Otherwise it
+    # would delete it again.
+    invalidate_symbolicate_cache([symbol_key])
+    cache_key = make_symbol_key_cache_key(symbol_key)
+    store_symbol_table(cache_key, buffer, pinned=is_pinned(symbol_key))
+    metrics.incr("symbolicate_warm_cache_bytes", len(buffer))
@@ -5,14 +5,18 @@
 import datetime
 import time
 import logging
-from bisect import bisect
-from functools import wraps
+import threading
+import uuid
+import concurrent.futures
+from functools import partial, wraps
 from collections import defaultdict
 
 import markus
+import msgpack
 import ujson as json
 import requests
 import botocore
+from encore.concurrent.futures.synchronous import SynchronousExecutor
 
 from django_redis import get_redis_connection
 
@@ -24,18 +28,89 @@ from django.views.decorators.csrf import csrf_exempt
 
 from tecken.base.symboldownloader import SymbolDownloader, SymbolNotFound
 from tecken.base.decorators import set_request_debug, set_cors_headers
-from .utils import make_symbol_key_cache_key
+from .diskcache import symbol_table_disk_cache
+from .memorycache import get_generation, symbol_table_cache
+from .pinned import is_pinned, make_pinned_key
+from .servertiming import ServerTiming, get_size_tag
+from .storewriter import StoreWriter
+from .symboltable import (
+    SIDECAR_SUFFIX,
+    SymbolTable,
+    InvalidSymbolTable,
+    pack_symbol_map,
+    pack_symbol_table_from_index,
+)
+from .symparser import SymbolFileParser
+from .utils import (
+    make_symbol_key_cache_key,
+    make_symbol_table_cache_key,
+    store_symbol_table,
+)
 
 
 logger = logging.getLogger("tecken")
 metrics = markus.get_metrics("tecken")
 store = caches["store"]
 
+# How often to check if the symbol table has shown up in the Redis store
+# while some other web worker holds the lease to download it.
+# See SymbolicateJSON.load_and_store_symbol().
+LEASE_POLL_INTERVAL = 0.1
+
+# Deletes the lease only if it still holds our token. That way a worker
+# whose lease has already expired can't delete a lease that some other
+# worker has acquired since.
+RELEASE_LEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
 downloader = SymbolDownloader(
     settings.SYMBOL_URLS + [settings.UPLOAD_TRY_SYMBOLS_URL],
     file_prefix=settings.SYMBOL_FILE_PREFIX,
 )
 
+_download_executor = None
+_download_executor_lock = threading.Lock()
+
+_store_writer = None
+_store_writer_lock = threading.Lock()
+
+
+def get_download_executor():
+    """Return the thread pool, shared by all symbolication requests in this
+    process, that symbol files get downloaded in."""
+    global _download_executor
+    if settings.SYNCHRONOUS_SYMBOLICATE_DOWNLOADS:
+        # This is only applicable when running unit tests
+        return SynchronousExecutor()
+    with _download_executor_lock:
+        if _download_executor is None:
+            _download_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=settings.SYMBOLICATE_DOWNLOAD_MAX_WORKERS,
+                thread_name_prefix="symbolicate-download",
+            )
+    return _download_executor
+
+
+def get_store_writer():
+    """Return the StoreWriter, shared by all symbolication requests in this
+    process, that writes symbol tables into the Redis store."""
+    global _store_writer
+    if settings.SYNCHRONOUS_SYMBOLICATE_STORE_WRITES:
+        # This is only applicable when running unit tests
+        return StoreWriter(store_symbol_table, max_pending_bytes=0)
+    with _store_writer_lock:
+        if _store_writer is None:
+            _store_writer = StoreWriter(
+                store_symbol_table,
+                max_pending_bytes=settings.SYMBOLICATE_STORE_WRITER_MAX_PENDING_BYTES,
+            )
+    return _store_writer
+
+
 # The way Firefox serializes its CombinedStacks object, a negative module index
 # indicates that the stack frame's program counter was not found in any known
 # module. In this case, no symbolication occurs, but we support this case as a
@@ -50,6 +125,10 @@ downloader = SymbolDownloader(
 # test for this string to detect this condition 100% reliably.
 UNKNOWN_MODULE = "<unknown>"
 
+# Clients that send their symbolication request with this content type get
+# the response in it too.
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+
 # This lists all the possible exceptions that the SymbolDownloader
 # might raise that we swallow in runtime.
 # Any failure to download a symbol from S3, that is considered operational,
@@ -90,6 +169,14 @@ class JsonResponse(HttpResponse):
         super().__init__(content=data, **kwargs)
 
 
+class MsgpackResponse(HttpResponse):
+    """Like JsonResponse but the data is serialized with msgpack."""
+
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault("content_type", MSGPACK_CONTENT_TYPE)
+        super().__init__(content=msgpack.dumps(data, use_bin_type=True), **kwargs)
+
+
 def get_symbolication_count_key(prefix, dateobj):
     date = dateobj.strftime("%Y%m%d")
     return f"symbolicationcount:{prefix}:{date}"
@@ -104,123 +191,94 @@ def increment_symbolication_count(prefix):
 
 
 class SymbolicateJSON:
-    def __init__(self, downloader, debug=False):
+    def __init__(self, downloader, debug=False, server_timing=None):
         self.downloader = downloader
         self.debug = debug
+        # How long each phase took. See tecken.symbolicate.servertiming.
+        self.server_timing = server_timing or ServerTiming()
 
-        # These dicts fill up as we either query the Redis store or
+        # This dict fills up as we either query the Redis store or
         # download from S3.
-        # By keeping them as class instance attributes, they stay
+        # By keeping it as a class instance attribute, it stays
         # around between multiple symbolication requests.
-        self.all_symbol_offsets = {}
-        self.all_symbol_maps = {}
-
-    def add_to_symbols_offsets(self, key, offsets, symbol_map=None):
-        self.all_symbol_offsets[key] = sorted(offsets)
-
-        # IF we had to download the symbol file, and parse it, let's
-        # keep it around. This is an optimization technique.
-        # Normally, a download from the Internet results in us stuffing
-        # the Redis store with with all its values, then we actually
-        # doing the symbolication process we query the Redis store for
-        # each symbol key and offset. But if we already have it all
-        # here in memory (because of the download), let's keep it and
-        # save some Redis store queries.
-        if symbol_map:
-            self.all_symbol_maps[key] = symbol_map
+        self.all_symbol_tables = {}
+        # Same thing for whether each symbol was found. None means
+        # we don't know (e.g. the download timed out).
+        self.known_modules = {}
 
     def symbolicate(self, stacks, memory_map):
-        # the result we will populate
-        result = {"symbolicatedStacks": [], "knownModules": [None] * len(memory_map)}
+        """Return the result of symbolicating one job.
+        See symbolicate_jobs()."""
+        result, = self.symbolicate_jobs([(stacks, memory_map)])
+        return result
+
+    def symbolicate_jobs(self, jobs):
+        """Return a list of results, one for each (stacks, memory_map)
+        tuple in 'jobs'.
+
+        Jobs sent together tend to share most of their modules. So,
+        first, every symbol needed by any of the jobs is looked up, and
+        downloaded if need be, in one go. Then all the offsets needed
+        from each symbol, across all the jobs, are resolved in one
+        batched lookup per symbol and fanned back out to each job.
 
+        If self.debug, the time it took to get the symbols, and how it
+        went, is all in the debug of the first job.
+        """
         # Record the total time it took to symbolicate
         t0 = time.time()
 
-        cache_lookup_times = []
-        download_times = []
-        download_sizes = []
-        modules_lookups = {}
-
         # First look up all symbols that we're going to need so that
-        # when it's time to really loop over `self.stacks` the
-        # 'self.all_symbol_offsets' should be fully populated as well as it
+        # when it's time to really loop over the stacks the
+        # 'self.all_symbol_tables' should be fully populated as well as it
         # can be.
-        needs_to_be_downloaded = set()
-        for stack in stacks:
-            for module_index, module_offset in stack:
-                if module_index < 0:
-                    continue
-                filename, debug_id = memory_map[module_index]
-                symbol_key = (filename, debug_id)
-                # Keep a dict of the symbol keys and each's module index
-                modules_lookups[symbol_key] = module_index
-
-        # get_symbol_offsets() takes a list of symbol keys, returns a
-        # dict that contains a dict called 'symbols'. Each key, in it,
-        # is the symbol key and the values is the complete list of
-        # ALL keys we have for that symbol key.
-        # E.g. `informations['symbols'][('xul.pdb', 'HEX')] == [45110, 130109]`
-        # If, for a particular symbol key we didn't have anything in the
-        # Redis store, the value is None.
-        needed_modules_lookups = {
-            key: modules_lookups[key]
-            for key in modules_lookups
-            if key not in self.all_symbol_offsets
-        }
-
-        if needed_modules_lookups:
-            informations = self.get_symbol_offsets(needed_modules_lookups)
+        # At the same time, gather up all the offsets needed from each
+        # symbol. Rather than looking up every frame on its own, they're
+        # then all looked up in one go. A profile, or a bunch of crash
+        # pings, can have tens of thousands of frames in the same module,
+        # often with the same offsets.
+        offsets_per_symbol = defaultdict(list)
+        for stacks, memory_map in jobs:
+            for stack in stacks:
+                for module_index, module_offset in stack:
+                    if module_index < 0:
+                        continue
+                    symbol_key = tuple(memory_map[module_index])
+                    offsets_per_symbol[symbol_key].append(module_offset)
+
+        load_debug = self.load_symbol_tables(list(offsets_per_symbol))
+
+        t0_resolve = time.time()
+        nearest_per_symbol = {}
+        for symbol_key, module_offsets in offsets_per_symbol.items():
+            symbol_table = self.all_symbol_tables.get(symbol_key)
+            # If there was no table, the symbol could ultimately not
+            # be found, at all. There's no point trying to figure out
+            # what the signature is.
+            # Even if our module offset isn't in the table, there is still
+            # hope to be able to find the nearest signature.
+            nearest_per_symbol[symbol_key] = (
+                symbol_table.lookup_many(module_offsets) if symbol_table else {}
+            )
 
-            # Hit or miss, there was a cache (Redis store) lookup.
+        results = []
+        for stacks, memory_map in jobs:
+            results.append(
+                self._make_result(stacks, memory_map, nearest_per_symbol, t0)
+            )
             if self.debug:
-                cache_lookup_times.extend(informations["cache_lookup_times"])
-
-            # Now loop over every symbol looked up from get_symbol_offsets()
-            # Expect that, for every symbol, there is something. Even
-            # though it might be empty. If it's empty (i.e. no 'symbol_map'
-            # key) it means we looked in the cache but it not in the cache.
-            for symbol_key in informations["symbols"]:
-                module_index = modules_lookups[symbol_key]
-                information = informations["symbols"][symbol_key]
-                if "symbol_offsets" in information:
-                    # We were able to look it up from cache.
-                    symbol_offsets = information["symbol_offsets"]
-                    # But even though it was in cache it might have just
-                    # been cached temporarily because it has previously
-                    # failed.
-                    found = information["found"]
-
-                    # If it was successfully fetched from cache,
-                    # these metrics will be available.
-                    result["knownModules"][module_index] = found
-                    self.add_to_symbols_offsets(symbol_key, symbol_offsets)
-                else:
-                    # These are the symbols that we're going to have to
-                    # download from the Internet.
-                    needs_to_be_downloaded.add((symbol_key, module_index))
+                results[-1]["debug"].update(load_debug)
+                # Every job after the first only gets the zeros.
+                load_debug = self._make_load_debug()
+            t0 = time.time()
+        self.server_timing.add("resolve", time.time() - t0_resolve)
+        return results
 
-            # Now let's go ahead and download the symbols that need to be
-            # fetch from the Internet.
-            if needs_to_be_downloaded:
-                # The self.load_symbols() method can cope
-                # with 'needs_to_be_downloaded' being an empty list, as
-                # there is simply nothing to do.
-                # But we avoid the call since it has a timer on it. Otherwise
-                # we get many timer timings that are unrealistically small
-                # which makes it hard to see how long it takes.
-                downloaded = self.load_symbols(needs_to_be_downloaded)
-                for symbol_key, information, module_index in downloaded:
-                    symbol_offsets = information["symbol_map"].keys()
-                    self.add_to_symbols_offsets(
-                        symbol_key, symbol_offsets, symbol_map=information["symbol_map"]
-                    )
-                    if self.debug:
-                        if "download_time" in information:
-                            download_times.append(information["download_time"])
-                        if "download_size" in information:
-                            download_sizes.append(information["download_size"])
-                    found = information["found"]
-                    result["knownModules"][module_index] = found
+    def _make_result(self, stacks, memory_map, nearest_per_symbol, t0):
+        """Return the result of one job from the already looked up
+        offsets of every symbol."""
+        # the result we will populate
+        result = {"symbolicatedStacks": [], "knownModules": [None] * len(memory_map)}
 
         # Initialize counters of how many stacks we do symbolication on.
         # Some stacks are malformed so we can't symbolicate them
@@ -234,74 +292,7 @@ class SymbolicateJSON:
         # symbol).
         stacks_per_module = defaultdict(int)
 
-        # Before we loop over the stack, loop over it once just to
-        # figure out which HGET commands we're going to need to send.
-        lookups = defaultdict(list)
-
-        # We'll use the module_index repeatedly to figure out what the
-        # of all symbol offsets are. To avoid repeating that logic
-        # too much we'll just a little dict as a cache.
-        _symbol_offset_list_cache = {}
-
-        for stack in stacks:
-            for module_index, module_offset in stack:
-                if module_index < 0:
-                    continue
-                symbol_offset_list = _symbol_offset_list_cache.get(module_index)
-
-                # First time we encounter this module_index?
-                if symbol_offset_list is None:
-                    symbol_filename, debug_id = memory_map[module_index]
-                    symbol_key = (symbol_filename, debug_id)
-
-                    symbol_offset_list = self.all_symbol_offsets.get(symbol_key)
-                    _symbol_offset_list_cache[module_index] = symbol_offset_list
-
-                if symbol_offset_list:
-                    # There exists a list of offsets for this module!
-
-                    symbol_key = tuple(memory_map[module_index])
-                    nearest = self._get_nearest(symbol_offset_list, module_offset)
-                    if nearest not in lookups[symbol_key]:
-                        lookups[symbol_key].append(nearest)
-
-        # Now we know which lookups we need to do. I.e. Redis store queries.
-        # Actually look them up.
-        signatures = {}
-        redis_store_connection = get_redis_connection("store")
-
-        for symbol_key, keys in lookups.items():
-            signatures[symbol_key] = {}
-            if symbol_key in self.all_symbol_maps:
-                # 'all_symbol_maps' is a dict of *every* offset and signature
-                # for this symbol key.
-                # The reason we have this (and thus won't need to query Redis)
-                # is because the symbol has had to be downloaded from the
-                # Internet and parsed into a dict (for the sake of
-                # storing it in Redis) already. Let's not waste this
-                # opportunity. Basically only possible the first time you
-                # depend on a module for symbolication.
-                for key in keys:
-                    signatures[symbol_key][key] = self.all_symbol_maps[symbol_key][key]
-            else:
-                cache_key = self._make_cache_key(symbol_key)
-                t0 = time.time()
-                values = redis_store_connection.hmget(store.make_key(cache_key), keys)
-                t1 = time.time()
-                cache_lookup_times.append(t1 - t0)
-
-                for i, key in enumerate(keys):
-                    # The list 'values' is a list of byte strings.
-                    value = values[i]
-                    if value is not None:
-                        value = value.decode("utf-8")
-                    signatures[symbol_key][key] = value
-
-        _symbol_offset_list_cache = {}  # reset the cache
-
-        # All the downloads (if there were any) *and* all the Redis store
-        # lookups have been done. Now, let's focus on making the struct
-        # that is going to be the output.
+        # Now, let's focus on making the struct that is going to be the output.
         for stack in stacks:
             response_stack = []
             for j, (module_index, module_offset) in enumerate(stack):
@@ -320,42 +311,24 @@ class SymbolicateJSON:
 
                 real_stacks += 1
 
-                symbol_filename, debug_id = memory_map[module_index]
-
-                symbol_offset_list = _symbol_offset_list_cache.get(module_index)
-                if symbol_offset_list is None:
-                    symbol_key = (symbol_filename, debug_id)
-
-                    # This 'stacks_per_module' will only be used in the debug
-                    # output. So give it a string key instead of a tuple.
-                    stacks_per_module["{}/{}".format(*symbol_key)] += 1
-
-                    symbol_offset_list = self.all_symbol_offsets.get(symbol_key)
-                    _symbol_offset_list_cache[module_index] = symbol_offset_list
-
-                # If there was no list, the symbol could ultimately not
-                # be found, at all. There's no point trying to figure out
-                # what the signature is.
-                function = None
-                if symbol_offset_list:
-                    symbol_key = tuple(memory_map[module_index])
-                    # Even if our module offset isn't in that list,
-                    # there is still hope to be able to find the
-                    # nearest signature.
-                    function_start = self._get_nearest(
-                        symbol_offset_list, module_offset
-                    )
-                    function_offset = module_offset - function_start
-                    function = signatures[symbol_key][function_start]
+                symbol_key = tuple(memory_map[module_index])
+                # This 'stacks_per_module' will only be used in the debug
+                # output. So give it a string key instead of a tuple.
+                stacks_per_module["{}/{}".format(*symbol_key)] += 1
+                result["knownModules"][module_index] = self.known_modules.get(
+                    symbol_key
+                )
 
                 frame = {
                     "module_offset": module_offset,
-                    "module": symbol_filename,
+                    "module": symbol_key[0],
                     "frame": j,
                 }
-                if function is not None:
+                nearest = nearest_per_symbol[symbol_key].get(module_offset)
+                if nearest is not None:
+                    function_start, function = nearest
                     frame["function"] = function
-                    frame["function_offset"] = function_offset
+                    frame["function_offset"] = module_offset - function_start
 
                 response_stack.append(frame)
 
@@ -374,184 +347,355 @@ class SymbolicateJSON:
                 "time": t1 - t0,
                 "stacks": {"count": total_stacks, "real": real_stacks},
                 "modules": {
-                    "count": len(modules_lookups),
+                    "count": len(stacks_per_module),
                     "stacks_per_module": stacks_per_module,
                 },
-                "cache_lookups": {
-                    "count": len(cache_lookup_times),
-                    "time": float(sum(cache_lookup_times)),
-                },
-                "downloads": {
-                    "count": len(download_times),
-                    "time": float(sum(download_times)),
-                    "size": float(sum(download_sizes)),
-                },
             }
 
         return result
 
     @staticmethod
-    def _get_nearest(offset_list, offset):
-        """return the item in the list to the left nearst point.
-        For example, if the 'offset_list' is: [10, 20, 30]
-        and 'offset' is 25, the return 20.
-        This function assumes that the 'offset_list' is sorted.
-        This function also assumes that 'offset' is *not* in
-        'offset_list'.
-
-        The origin of this function is that we look for offsets in
-        a stack as these are kinda like lines of code. Imagine this
-        C++ program::
-
-            10) ...
-            11) void some_function() {
-            12)     ...
-            13)     ...
-            14)     ...
-            15) }
-            17) void other_function() {
-            18)     ...
-            19) }
-            20) ...
-
-        Here, the 'offset_list' is going to be [11, 17]. The offsets
-        where the functions are.
-        Suppose the 'offset' we're being asked to look up is 13, meaning
-        the interesting thing happened on "line" 13. The nearest "function
-        definition line" is 11. That's where the function was defined.
-        To find 11, we bisect the list of all offsets and subtract 1.
-        I.e. bisect([11, 17], 13) == p == 1
-        And [11, 17][p - 1] == 11
+    def _make_load_debug(
+        cache_lookup_times=(),
+        cache_round_trips=None,
+        memory_cache_hits=0,
+        disk_cache_hits=0,
+        download_times=(),
+        download_sizes=(),
+        download_wall_time=0.0,
+        download_timeouts=0,
+        download_coalesced=0,
+    ):
+        """Return the debug output of load_symbol_tables()."""
+        return {
+            "cache_lookups": {
+                "count": len(cache_lookup_times),
+                "time": float(sum(cache_lookup_times)),
+                "memory_hits": memory_cache_hits,
+                "disk_hits": disk_cache_hits,
+                # Each phase is one Redis pipeline, no matter how many
+                # modules there are.
+                "phases": {
+                    phase: {"count": len(times), "time": float(sum(times))}
+                    for phase, times in (cache_round_trips or {}).items()
+                },
+            },
+            "downloads": {
+                "count": len(download_times),
+                "time": float(sum(download_times)),
+                "size": float(sum(download_sizes)),
+                # Since the downloads happen concurrently, this is
+                # less than 'time' if more than one was needed.
+                "wall_time": download_wall_time,
+                "timeouts": download_timeouts,
+                # Symbols some other web worker downloaded while we
+                # waited for it.
+                "coalesced": download_coalesced,
+            },
+        }
+
+    def load_symbol_tables(self, symbol_keys):
+        """Make sure 'self.all_symbol_tables' and 'self.known_modules' have
+        something for every one of these symbol keys. Either from the Redis
+        store (or this node's own caches) or by downloading them.
+
+        Return a dict of the debug output of how that went.
         """
-        return offset_list[bisect(offset_list, offset) - 1]
+        cache_lookup_times = []
+        cache_round_trips = defaultdict(list)
+        memory_cache_hits = 0
+        disk_cache_hits = 0
+        download_times = []
+        download_sizes = []
+        download_wall_time = 0.0
+        download_timeouts = 0
+        download_coalesced = 0
+
+        # get_symbol_tables() takes a list of symbol keys, returns a
+        # dict that contains a dict called 'symbols'. Each key, in it,
+        # is the symbol key and the value is a dict with the SymbolTable
+        # we have for that symbol key.
+        # If, for a particular symbol key we didn't have anything in the
+        # Redis store, the value is an empty dict.
+        needed_symbol_keys = [
+            key for key in symbol_keys if key not in self.all_symbol_tables
+        ]
+
+        if needed_symbol_keys:
+            with self.server_timing.time("lookup"):
+                informations = self.get_symbol_tables(needed_symbol_keys)
+
+            # Hit or miss, there was a cache (Redis store) lookup.
+            if self.debug:
+                cache_lookup_times.extend(informations["cache_lookup_times"])
+                for phase, times in informations["cache_round_trips"].items():
+                    cache_round_trips[phase].extend(times)
+                memory_cache_hits += informations["memory_cache_hits"]
+                disk_cache_hits += informations["disk_cache_hits"]
+
+            # Now loop over every symbol looked up from get_symbol_tables()
+            # Expect that, for every symbol, there is something. Even
+            # though it might be empty. If it's empty (i.e. no 'symbol_table'
+            # key) it means we looked in the cache but it not in the cache.
+            needs_to_be_downloaded = set()
+            for symbol_key in informations["symbols"]:
+                information = informations["symbols"][symbol_key]
+                if "symbol_table" in information:
+                    # We were able to look it up from cache.
+                    # But even though it was in cache it might have just
+                    # been cached temporarily because it has previously
+                    # failed.
+                    self.known_modules[symbol_key] = information["found"]
+                    self.all_symbol_tables[symbol_key] = information["symbol_table"]
+                else:
+                    # These are the symbols that we're going to have to
+                    # download from the Internet.
+                    needs_to_be_downloaded.add(symbol_key)
+
+            # Now let's go ahead and download the symbols that need to be
+            # fetch from the Internet.
+            if needs_to_be_downloaded:
+                # The self.load_symbols() method can cope
+                # with 'needs_to_be_downloaded' being an empty list, as
+                # there is simply nothing to do.
+                # But we avoid the call since it has a timer on it. Otherwise
+                # we get many timer timings that are unrealistically small
+                # which makes it hard to see how long it takes.
+                t0_downloads = time.time()
+                downloaded = self.load_symbols(needs_to_be_downloaded)
+                for symbol_key, information in downloaded:
+                    self.all_symbol_tables[symbol_key] = information["symbol_table"]
+                    if self.debug:
+                        if "download_time" in information:
+                            download_times.append(information["download_time"])
+                        if "download_size" in information:
+                            download_sizes.append(information["download_size"])
+                        if information.get("timed_out"):
+                            download_timeouts += 1
+                        if "lease_wait_time" in information:
+                            download_coalesced += 1
+                    self.known_modules[symbol_key] = information["found"]
+                download_wall_time = time.time() - t0_downloads
+                # Note that this includes the time it took to parse them.
+                self.server_timing.add("download", download_wall_time)
+
+        if not self.debug:
+            return {}
+        return self._make_load_debug(
+            cache_lookup_times=cache_lookup_times,
+            cache_round_trips=cache_round_trips,
+            memory_cache_hits=memory_cache_hits,
+            disk_cache_hits=disk_cache_hits,
+            download_times=download_times,
+            download_sizes=download_sizes,
+            download_wall_time=download_wall_time,
+            download_timeouts=download_timeouts,
+            download_coalesced=download_coalesced,
+        )
 
     @staticmethod
     def _make_cache_key(symbol_key):
         return make_symbol_key_cache_key(symbol_key)
 
+    @staticmethod
+    def _execute_pipeline(pipeline, phase, round_trips):
+        """Return the result of executing the Redis pipeline and add how
+        long that round trip took to the list of round trips of that
+        phase."""
+        t0 = time.time()
+        try:
+            return pipeline.execute()
+        finally:
+            round_trips[phase].append(time.time() - t0)
+
     @metrics.timer_decorator("symbolicate_get_symbol_maps")
-    def get_symbol_offsets(self, symbol_keys):
+    def get_symbol_tables(self, symbol_keys):
         """Return a dict that contains the following keys:
             * 'symbols'
             * 'cache_lookup_times' (only present if self.debug==True)
+            * 'cache_round_trips' (only present if self.debug==True)
+            * 'memory_cache_hits' (only present if self.debug==True)
+            * 'disk_cache_hits' (only present if self.debug==True)
 
         The 'symbols' key contains a dict that looks like this::
 
             {
-                "xul.pdb/HEX": {
+                ("xul.pdb", "HEX"): {
                     "found": True,
-                    "symbol_offsets": [1235, 4577, 6412, 7800]
+                    "symbol_table": <SymbolTable 312,487 offsets>
                 },
-                "win32.dll/HEX": {
+                ("win32.dll", "HEX"): {
                     "found": False,
-                    "symbol_offsets": None  # Means it wasn't found in Redis
-                }
+                    "symbol_table": <SymbolTable 0 offsets>
+                },
+                ("other.pdb", "HEX"): {}  # Means it wasn't found in Redis
             }
 
-        To optimize the Redis lookups everything that can be queried
-        "in batch" is done so. So multiple lookup keys get turned into
-        a list just so we can do things like MGET Redis queries.
+        Every symbol key is stored as one single packed bytes value
+        (see tecken.symbolicate.symboltable) so all the symbol keys can
+        be looked up with one single MGET.
+        Symbol tables this process already has in memory (see
+        tecken.symbolicate.memorycache), or that are on the local disk (see
+        tecken.symbolicate.diskcache), aren't fetched at all.
+
+        No matter how many symbol keys there are, every phase is one
+        single Redis pipeline. I.e. one round trip:
+
+            * 'lookup' - the MGET, and whether anything in memory or on
+              disk has been invalidated
+            * 'pinned' - only if something that is pinned (see
+              tecken.symbolicate.pinned) was missing; MGET of that from
+              the pinned cache
+            * 'recheck' - only if something was invalidated or missing;
+              MGET of what was invalidated and whether what was missing
+              is stored in the legacy layout
+            * 'migrate' - only if something is stored in the legacy
+              layout; see _migrate_legacy_symbol_maps()
+
+        The 'cache_round_trips' key is a dict of phase -> list of the
+        time each round trip of that phase took.
         """
         cache_keys = {self._make_cache_key(x): x for x in symbol_keys}
         redis_store_connection = get_redis_connection("store")
-        cache_lookup_times = []
+        round_trips = defaultdict(list)
 
         # This is the dict we're going to build up. Each key is a
-        # symbol key's cache key. Each value is a list of offsets.
+        # symbol key's cache key. Each value is a SymbolTable instance.
         many = {}
 
-        # Build up a list of the names of ALL keys that contains the
-        # the keys.
-        cache_keys_keys = []
-        for cache_key in cache_keys:
-            cache_keys_keys.append(cache_key + ":keys")
-        t0 = time.time()
-        # store.get_many() returns an OrderedDict() object that
-        # maps each *available* key to their list of ALL hash map keys.
-        all_keys = store.get_many(cache_keys_keys)
-        t1 = time.time()
-        cache_lookup_times.append(t1 - t0)
-
-        # Important! Why aren't using Redis HKEYS?
-        # tl;dr It's too slow.
-        #
-        # You *could* do this:
-        #   > HSET foo key1 valueX
-        #   > HSET foo key2 valueY
-        #   > HSET foo key3 valueZ
-        # ...and to get that list of [key1, key2, key3] you can do:
-        #   > HKEYS foo
-        #   1) key1
-        #   2) key2
-        #   3) key3
-        #
-        # But that's very slow. HKEYS is O(N).
-        #
-        # Instead, we do one extra simple SET for a list of all keys.
-        # So like this:
-        #   > HSET foo key1 valueX
-        #   > HSET foo key2 valueY
-        #   > HSET foo key3 valueZ
-        #   > SET foo:keys "[key1, key2, key3]"
-        #
-        # Now, instead of HKEYS we use simple GET:
-        #   > GET foo
-        #   1) "[key1, key2, key3]"
-        #
-        # That list gets serialized (and compressed) by django_redis
-        # so we don't have to worry about turning it back into a pure
-        # Python list.
-        #
-        # The caveat is that we now have 2 "top level keys" (foo the
-        # hash map and foo:keys the plain key/value).
-        #
-        # What *can* happen is that since the Redis store is configured
-        # as a LRU cache, one of these might get evicted.
-        # If the plain key/value "foo:keys" gets evicted, we plainly
-        # assume it has never existed and we "start over" download
-        # it from the Internet. Just as if we've never ever encounted
-        # it before.
-        # Alternatively, the hash map "foo" might have been evicted.
-        # It's impossible to know so we have to make a HLEN query to
-        # check if the hash map is still there.
-
-        # If there are no offsets at all, it means there are no
-        # hash maps of this symbol key. But perhaps we've previously
-        # attempted to download the symbols file from the Internet
-        # and failed. In that case, we don't want to repeatedly try
-        # to download it again (and fail repeatedly).
-        # All "failed" attempts are stored as regular keys with an
-        # empty dict.
-        # The reason for using a list is so that we can do an MGET
-        # later.
-        maybes = []
-
-        for cache_key in cache_keys:
-            keys = all_keys.get(cache_key + ":keys")
-            if keys:
-                # Cool! The list of all hash map keys exists in Redis.
-                # But, what if the LRU kicked out the hash map??
-                # The quickest way to find out is to ask to the length
-                # of the hash map.
-                t0 = time.time()
-                length = redis_store_connection.hlen(store.make_key(cache_key))
-                t1 = time.time()
-                cache_lookup_times.append(t1 - t0)
-                if not length:
-                    # The list of keys existed but not the hashmap :(
-                    keys = []
-            if keys:
-                many[cache_key] = keys
-            else:
-                maybes.append(cache_key)
-        if maybes:
-            t0 = time.time()
-            empties = store.get_many(maybes)
-            t1 = time.time()
-            cache_lookup_times.append(t1 - t0)
-            many.update(empties)
-
-        t1 = time.time()
+        # If this process already has some of the symbol tables in memory
+        # they don't need to be fetched. But we still need to check that
+        # they haven't been invalidated since. That check is pipelined
+        # together with the MGET of everything else so it's still just
+        # one single round trip.
+        use_memory_cache = bool(symbol_table_cache.max_bytes)
+        if use_memory_cache:
+            for cache_key in cache_keys:
+                symbol_table = symbol_table_cache.get(cache_key)
+                if symbol_table is not None:
+                    many[cache_key] = symbol_table
+
+        # Same thing for what some process on this node has already
+        # written to disk (see tecken.symbolicate.diskcache).
+        on_disk = {}
+        use_disk_cache = symbol_table_disk_cache.enabled
+        if use_disk_cache:
+            for cache_key in cache_keys:
+                if cache_key not in many:
+                    found = symbol_table_disk_cache.get(cache_key)
+                    if found is not None:
+                        on_disk[cache_key] = found
+        fetch = [x for x in cache_keys if x not in many and x not in on_disk]
+
+        def add_fetched(fetched, values):
+            """Put whatever could be read into 'many' and return a list of
+            the cache keys that couldn't."""
+            missing = []
+            for cache_key, value in zip(fetched, values):
+                symbol_table = None
+                if value is not None:
+                    try:
+                        symbol_table = SymbolTable(value)
+                    except InvalidSymbolTable as exception:
+                        logger.warning(
+                            f"Unable to read symbol table for {cache_key} "
+                            f"({exception})"
+                        )
+                if symbol_table is None:
+                    missing.append(cache_key)
+                    continue
+                if symbol_table and use_disk_cache:
+                    symbol_table_disk_cache.set(cache_key, generation, value)
+                    # If it could be written, use the memory-mapped file
+                    # instead so this process doesn't hold its own copy.
+                    found = symbol_table_disk_cache.get(cache_key)
+                    if found is not None:
+                        symbol_table = found[1]
+                if symbol_table and use_memory_cache:
+                    symbol_table_cache.set(cache_key, symbol_table)
+                many[cache_key] = symbol_table
+            return missing
+
+        pipeline = redis_store_connection.pipeline(transaction=False)
+        if use_memory_cache:
+            known_generation = symbol_table_cache.generation
+            symbol_table_cache.queue_invalidations_check(pipeline, known_generation)
+        if use_disk_cache:
+            symbol_table_disk_cache.queue_invalidations_check(pipeline, on_disk)
+        if fetch:
+            pipeline.mget(
+                [store.make_key(make_symbol_table_cache_key(x)) for x in fetch]
+            )
+        responses = self._execute_pipeline(pipeline, "lookup", round_trips)
+
+        values = responses.pop() if fetch else []
+        refetch = []
+        if use_disk_cache:
+            invalidated_generations = [responses.pop() for _ in on_disk][::-1]
+            generation = responses.pop()
+            for cache_key, invalidated_generation in zip(
+                on_disk, invalidated_generations
+            ):
+                file_generation, symbol_table = on_disk[cache_key]
+                if symbol_table_disk_cache.is_valid(
+                    file_generation, generation, invalidated_generation
+                ):
+                    many[cache_key] = symbol_table
+                else:
+                    symbol_table_disk_cache.delete(cache_key)
+                    refetch.append(cache_key)
+            generation = int(generation or 0)
+        disk_cache_hits = {x for x in on_disk if x in many}
+        memory_cache_hits = {x for x in many if x not in on_disk}
+        if use_memory_cache:
+            invalidated = symbol_table_cache.apply_invalidations(
+                *responses, known_generation=known_generation
+            )
+            for cache_key in memory_cache_hits & invalidated:
+                del many[cache_key]
+                refetch.append(cache_key)
+            memory_cache_hits -= invalidated
+            for cache_key in disk_cache_hits:
+                symbol_table_cache.set(cache_key, many[cache_key])
+        missing = add_fetched(fetch, values)
+
+        pinned_hits = set()
+        pinned_missing = [x for x in missing if is_pinned(cache_keys[x])]
+        if pinned_missing:
+            pipeline = get_redis_connection("pinned").pipeline(transaction=False)
+            pinned_keys = [make_pinned_key(x) for x in pinned_missing]
+            pipeline.mget(pinned_keys)
+            # Whatever is still used is kept for longer.
+            for pinned_key in pinned_keys:
+                pipeline.expire(pinned_key, settings.SYMBOLICATE_PINNED_TTL_SECONDS)
+            values, *_ = self._execute_pipeline(pipeline, "pinned", round_trips)
+            still_missing = add_fetched(pinned_missing, values)
+            pinned_hits = set(pinned_missing) - set(still_missing)
+            missing = [x for x in missing if x not in pinned_hits]
+
+        if refetch or missing:
+            pipeline = redis_store_connection.pipeline(transaction=False)
+            if refetch:
+                pipeline.mget(
+                    [store.make_key(make_symbol_table_cache_key(x)) for x in refetch]
+                )
+            for cache_key in missing:
+                # The ':keys' list might still be there even if the LRU
+                # kicked out the hashmap. Then it's just as if we never
+                # had it. So only the hashmap matters.
+                pipeline.hlen(store.make_key(cache_key))
+            responses = self._execute_pipeline(pipeline, "recheck", round_trips)
+            if refetch:
+                # Invalidating a symbol deletes its legacy keys too so
+                # there's no point checking for those.
+                add_fetched(refetch, responses.pop(0))
+            legacy = [cache_key for cache_key, size in zip(missing, responses) if size]
+            if legacy:
+                migrated = self._migrate_legacy_symbol_maps(legacy, round_trips)
+                if use_memory_cache:
+                    for cache_key, symbol_table in migrated.items():
+                        symbol_table_cache.set(cache_key, symbol_table)
+                many.update(migrated)
 
         # All Redis queries that can be done have been done.
         # Time to "package it up".
@@ -561,221 +705,391 @@ class SymbolicateJSON:
             symbol_key = cache_keys[cache_key]
             information = {}
 
-            symbol_offsets = many.get(cache_key)
-            if symbol_offsets is None:  # not existant in cache
+            symbol_table = many.get(cache_key)
+            if symbol_table is None:  # not existant in cache
                 # Need to download this from the Internet.
                 metrics.incr("symbolicate_symbol_key", tags=["cache:miss"])
                 # If the symbols weren't in the cache, this will be dealt
                 # with later by this method's caller.
                 # XXX I don't like this! That would can be done here instead.
+            elif not symbol_table:  # e.g. an empty table
+                # It was cached but empty. That means it was logged that
+                # it was previously attempted but failed.
+                # The reason it's cached is to avoid it being looked up
+                # again and again when it's just going to continue to fail.
+                information["symbol_table"] = symbol_table
+                information["found"] = False
+            elif cache_key in memory_cache_hits:
+                metrics.incr("symbolicate_symbol_key", tags=["cache:memory"])
+                information["symbol_table"] = symbol_table
+                information["found"] = True
+            elif cache_key in disk_cache_hits:
+                metrics.incr("symbolicate_symbol_key", tags=["cache:disk"])
+                information["symbol_table"] = symbol_table
+                information["found"] = True
+            elif cache_key in pinned_hits:
+                metrics.incr("symbolicate_symbol_key", tags=["cache:pinned"])
+                information["symbol_table"] = symbol_table
+                information["found"] = True
             else:
-                # We *used* store the whole symbol map as a dict.
-                # Both if it actually existed and both if it was not found
-                # in S3.
-                # This makes things complicated for upgrading existing
-                # systems. So let's make a fix for that.
-                if isinstance(symbol_offsets, dict):  # pragma: no cover
-                    symbol_offsets = []
-
-                assert isinstance(symbol_offsets, list), type(symbol_offsets)
-                if not symbol_offsets:  # e.g. an empty list
-                    # It was cached but empty. That means it was logged that
-                    # it was previously attempted but failed.
-                    # The reason it's cached is to avoid it being looked up
-                    # again and again when it's just going to continue to fail.
-                    information["symbol_offsets"] = []
-                    information["found"] = False
-                else:
-                    metrics.incr("symbolicate_symbol_key", tags=["cache:hit"])
-                    # If it was in cache, that means it was originally found.
-                    information["symbol_offsets"] = symbol_offsets
-                    information["found"] = True
+                metrics.incr("symbolicate_symbol_key", tags=["cache:hit"])
+                # If it was in cache, that means it was originally found.
+                information["symbol_table"] = symbol_table
+                information["found"] = True
             informations["symbols"][symbol_key] = information
 
+        for phase, times in round_trips.items():
+            metrics.incr(
+                "symbolicate_redis_round_trips", len(times), tags=[f"phase:{phase}"]
+            )
         if self.debug:
-            informations["cache_lookup_times"] = cache_lookup_times
+            informations["cache_lookup_times"] = [
+                x for times in round_trips.values() for x in times
+            ]
+            informations["cache_round_trips"] = round_trips
+            informations["memory_cache_hits"] = len(memory_cache_hits)
+            informations["disk_cache_hits"] = len(disk_cache_hits)
         return informations
 
-    def load_symbols(self, requirements):
-        """return a list that contains items of 3-tuples of
-        (symbol_key, information, module_index)
+    def _migrate_legacy_symbol_maps(self, cache_keys, round_trips):
+        """Return a dict of cache key -> SymbolTable for every cache key
+        that is still stored in the old Redis layout.
+
+        We used to store every symbol key in two ways:
+        1) cache_key + ':keys'  (plain SET of a msgpack list of ALL offsets)
+        2) cache_key (as hashmap of offset -> signature)
+
+        If we find one of those, convert it to a packed symbol table,
+        store that and delete the old keys. That way an existing Redis
+        store doesn't need to be flushed (and re-downloaded from S3) when
+        deploying the new layout.
+        Reading all the hashmaps is one round trip and storing all the
+        symbol tables and deleting the old keys is another one.
+        This can be removed once no Redis store has the old layout any more.
         """
+        converted = {}
         redis_store_connection = get_redis_connection("store")
-        # This could be done concurrently, but from experience we see that
-        # the LRU cache does a very good job staying warm and containing
-        # lots of objects so it's rare that we need to download more things
-        # from S3 via the network. If we do it's very often just 1 more
-        # so there's little point in making that parallel.
-        for symbol_key, module_index in requirements:
-            cache_key = self._make_cache_key(symbol_key)
-            information = {}
+        pipeline = redis_store_connection.pipeline(transaction=False)
+        for cache_key in cache_keys:
+            pipeline.hgetall(store.make_key(cache_key))
+        responses = self._execute_pipeline(pipeline, "migrate", round_trips)
+
+        pipeline = redis_store_connection.pipeline(transaction=False)
+        for cache_key, hashmap in zip(cache_keys, responses):
+            symbol_map = {
+                int(key): value.decode("utf-8") for key, value in hashmap.items()
+            }
+            if symbol_map:
+                buffer = pack_symbol_map(symbol_map)
+                store_symbol_table(cache_key, buffer, pipeline=pipeline)
+                converted[cache_key] = SymbolTable(buffer)
+                metrics.incr("symbolicate_migrate_legacy_symbol_map", 1)
+            pipeline.delete(
+                store.make_key(cache_key), store.make_key(cache_key + ":keys")
+            )
+        self._execute_pipeline(pipeline, "migrate", round_trips)
+        return converted
+
+    def load_symbols(self, symbol_keys):
+        """Yield 2-tuples of (symbol_key, information) for each symbol key.
+
+        All the symbols are downloaded concurrently. Those that aren't done
+        within settings.SYMBOLICATE_DOWNLOAD_TIMEOUT_SECONDS (counted from
+        when they were all submitted) are yielded as "unknown" with an empty
+        symbol table. Even if they're still waiting for a thread of the
+        download pool, which other requests' downloads might be hogging.
+        Those are cancelled. Downloads that have started aren't aborted
+        though. They will finish and be stored in the background so the
+        next request that needs them can find them in the Redis store.
+        """
+        executor = get_download_executor()
+        timeout = settings.SYMBOLICATE_DOWNLOAD_TIMEOUT_SECONDS
+        deadline = time.time() + timeout
+        future_to_symbol_key = {
+            executor.submit(self.load_and_store_symbol, symbol_key): symbol_key
+            for symbol_key in symbol_keys
+        }
+        pending = set(future_to_symbol_key)
+        while pending:
+            wait_time = deadline - time.time()
+            if wait_time <= 0:
+                break
+            done, pending = concurrent.futures.wait(
+                pending,
+                timeout=wait_time,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                yield (future_to_symbol_key[future], future.result())
+
+        for future in pending:
+            symbol_key = future_to_symbol_key[future]
+            if future.cancel():
+                metrics.incr("symbolicate_download_cancelled", 1)
+            logger.warning(
+                "Gave up waiting for {} after {:.1f}s".format(
+                    "/".join(symbol_key), timeout
+                )
+            )
+            metrics.incr("symbolicate_download_timeout", 1)
+            information = {
+                "symbol_table": SymbolTable(pack_symbol_map({})),
+                # Not False, because we don't know.
+                "found": None,
+                "timed_out": True,
+            }
+            yield (symbol_key, information)
+
+    def load_and_store_symbol(self, symbol_key):
+        """Download and parse one symbol and store the symbol table in the
+        Redis store. Return a dict of information about it.
+
+        When lots of web workers miss the same symbol at the same time
+        (e.g. right after a release) only one of them should download it.
+        So, first, try to take a short lease on the symbol in the Redis
+        store. Whoever gets it downloads. Everybody else waits for the
+        symbol table to show up in the Redis store and uses that.
+        Only if the lease expires, or is released, without a symbol table
+        having been stored, do the waiters download it themselves.
+
+        The symbol table is written into the Redis store in the background
+        (see tecken.symbolicate.storewriter) so the lease is only released
+        once that's done.
+        """
+        cache_key = self._make_cache_key(symbol_key)
+        redis_store_connection = get_redis_connection("store")
+        lease_key = store.make_key(cache_key + ":lease")
+        token = uuid.uuid4().hex
+        lease_milliseconds = settings.SYMBOLICATE_DOWNLOAD_LEASE_SECONDS * 1000
+        if redis_store_connection.set(lease_key, token, nx=True, px=lease_milliseconds):
+
+            def release_lease():
+                release = redis_store_connection.register_script(RELEASE_LEASE_SCRIPT)
+                release(keys=[lease_key], args=[token])
+
             try:
-                information.update(self.load_symbol(*symbol_key))
-                if not information["download_size"]:
-                    raise SymbolFileEmpty()
-                assert isinstance(information["symbol_map"], dict)
-
-                with metrics.timer("symbolicate_store_hashmap"):
-                    t0 = time.time()
-                    # This big dict we're about to send to Redis with HMSET
-                    # might be too large to fit and if it is too large
-                    # redis-py will throw a ConnectionError with something
-                    # like 'Errno 104' because Redis simply shuts down the
-                    # socket.
-                    # To avoid that, set this monster dict in batches.
-                    # Empirically we found the ConnectionError happens when
-                    # the dict, converted to a string, is around 9MB.
-                    # Also empirically, the *average* value is 90 bytes and the
-                    # average key is 8 bytes. So if each key+value is about
-                    # 100 bytes, to make a batch of the dict into copies that
-                    # are no larger than 5MB you have to read about 50,000
-                    # keys at a time.
-                    count = 0
-                    buffer = {}
-                    hmset_key = store.make_key(cache_key)
-                    all_keys = []
-                    for key in information["symbol_map"]:
-                        all_keys.append(key)
-                        buffer[key] = information["symbol_map"][key]
-                        count += 1
-                        if count > 50000:
-                            redis_store_connection.hmset(hmset_key, buffer)
-                            count = 0
-                            buffer = {}
-                    if count:
-                        redis_store_connection.hmset(hmset_key, buffer)
-
-                    store.set(cache_key + ":keys", all_keys, timeout=None)
-                    t1 = time.time()
-
-                store_time = t1 - t0
-
-                logger.info(
-                    "Storing hash map for {} ({} keys). "
-                    "Took {:.2f}s to download. "
-                    "Took {:.2f}s to store in LRU."
-                    "".format(
-                        "/".join(symbol_key),
-                        format(len(all_keys), ","),
-                        information["download_time"],
-                        store_time,
-                    )
+                return self._download_and_store_symbol(
+                    symbol_key, cache_key, after_store=release_lease
                 )
-                information["found"] = True
+            except Exception:
+                release_lease()
+                raise
 
-            except (SymbolNotFound, SymbolFileEmpty):
-                # If it can't be downloaded, cache it as an empty result
-                # so we don't need to do this every time we're asked to
-                # look up this symbol.
-                metrics.incr("symbolicate_download_fail", 1)
-
-                store.set(cache_key, [], settings.DEBUG and 6 or 60)
-                # If nothing could be downloaded, keep it anyway but
-                # to avoid having to check if 'symbol_map' is None, just
-                # turn it into a dict.
-                information["symbol_map"] = {}  # override
-                information["found"] = False
-            yield (symbol_key, information, module_index)
+        information = self._wait_for_symbol_table(cache_key, lease_key)
+        if information is None:
+            logger.warning(
+                "Lease on {} ended without a symbol table".format("/".join(symbol_key))
+            )
+            metrics.incr("symbolicate_download_lease_expired", 1)
+            information = self._download_and_store_symbol(symbol_key, cache_key)
+        return information
 
-    @metrics.timer_decorator("symbolicate_load_symbol")
-    def load_symbol(self, filename, debug_id):
-        t0 = time.time()
-        stream = self.get_download_symbol_stream(filename, debug_id)
-
-        # We are only interested in lines start with "FUNC" or "PUBLIC" or
-        # "PUBLIC m.
-        # The "m" special. It's an extra *optional* prefix which,
-        # we currently omit.
-        # Origin: https://bugs.chromium.org/p/google-breakpad/issues/detail?id=751
-        # Note, as pointed out in
-        # https://github.com/mozilla-services/tecken/issues/924#issuecomment-399130860
-        # some day we might actually extract and use the presence of this 'm'
-        # as a potential factor of the symbolication.
-        # As of June 2018, we deliberately omit it.
-
-        # Need to parse it by line and make a dict of of offset->function
-        public_symbols = {}
-        func_symbols = {}
-        line_number = 0
-        total_size = 0
+    @staticmethod
+    def _wait_for_symbol_table(cache_key, lease_key):
+        """Wait for as long as somebody else holds the lease for the symbol
+        table to show up in the Redis store. Return a dict of information
+        about it or None if the lease went away without it.
+        """
+        redis_store_connection = get_redis_connection("store")
+        table_key = store.make_key(make_symbol_table_cache_key(cache_key))
         t0 = time.time()
-        url = next(stream)
-        for line in stream:
-            total_size += len(line)
-            line_number += 1
-
-            # Using `str1 in str2` is empirically the fastest operator there
-            # is.
-            # See
-            # https://github.com/mozilla-services/tecken/issues/983#issuecomment-412142517
-            # But it's inaccurate so we use this fast operator as a first
-            # step. Then later, do we check that it really is a valid prefix.
-            if "FUNC " in line or "PUBLIC " in line:
-                prefix, rest = line.split(None, 1)
-                # Perhaps the line was "Bbla bla FUNC bla bla"
-                # and not "FUNC bla bla".
-                if prefix not in ("FUNC", "PUBLIC"):
-                    continue
-                if rest.startswith("m "):
-                    rest = rest[2:]
-            else:
-                continue
-
-            if prefix == "PUBLIC":
-                fields = rest.strip().split(None, 2)
-                if len(fields) != 3:
-                    logger.warning(
-                        "PUBLIC line {} in {} has too few fields".format(
-                            line_number, url
-                        )
-                    )
-                    continue
-                address = int(fields[0], 16)
-                symbol = fields[2]
-                public_symbols[address] = symbol
-            elif prefix == "FUNC":
-                fields = rest.strip().split(None, 3)
-                if len(fields) != 4:
+        while True:
+            pipeline = redis_store_connection.pipeline(transaction=False)
+            pipeline.get(table_key)
+            pipeline.exists(lease_key)
+            value, leased = pipeline.execute()
+            if value is not None:
+                try:
+                    symbol_table = SymbolTable(value)
+                except InvalidSymbolTable as exception:
                     logger.warning(
-                        "FUNC line {} in {} has too few fields".format(line_number, url)
+                        f"Unable to read symbol table for {cache_key} ({exception})"
                     )
-                    continue
-                address = int(fields[0], 16)
-                symbol = fields[3]
-                func_symbols[address] = symbol
+                    return None
+                metrics.incr("symbolicate_download_coalesced", 1)
+                if symbol_table and symbol_table_cache.max_bytes:
+                    symbol_table_cache.set(cache_key, symbol_table)
+                return {
+                    "symbol_table": symbol_table,
+                    "found": bool(symbol_table),
+                    "lease_wait_time": time.time() - t0,
+                }
+            if not leased:
+                return None
+            time.sleep(LEASE_POLL_INTERVAL)
+
+    def _download_and_store_symbol(self, symbol_key, cache_key, after_store=None):
+        """Download and parse one symbol and hand its symbol table over to
+        the store writer. Return a dict of information about it.
+
+        The symbol table is used, and kept in memory, right away but it
+        might not have been written into the Redis store by the time this
+        returns. If 'after_store' is set, it's called once it has been.
+        Unless it's been invalidated, e.g. uploaded again, since it was
+        downloaded. Then it's not written at all.
+        """
+        generation = get_generation(get_redis_connection("store"))
+        information = {}
+        try:
+            information.update(self.load_symbol(*symbol_key))
+            if not information["download_size"]:
+                raise SymbolFileEmpty()
+            buffer = information.pop("buffer")
+            information["symbol_table"] = SymbolTable(buffer)
+
+            logger.info(
+                "Storing symbol table for {} ({} keys, {} bytes). "
+                "Took {:.2f}s to download."
+                "".format(
+                    "/".join(symbol_key),
+                    format(len(information["symbol_table"]), ","),
+                    format(len(buffer), ","),
+                    information["download_time"],
+                )
+            )
+            information["found"] = True
+            if symbol_table_cache.max_bytes:
+                symbol_table_cache.set(cache_key, information["symbol_table"])
+            timeout = None
+
+        except (SymbolNotFound, SymbolFileEmpty):
+            # If it can't be downloaded, cache it as an empty result
+            # so we don't need to do this every time we're asked to
+            # look up this symbol.
+            metrics.incr("symbolicate_download_fail", 1)
+
+            buffer = pack_symbol_map({})
+            timeout = settings.DEBUG and 6 or 60
+            # If nothing could be downloaded, keep it anyway but
+            # to avoid having to check if 'symbol_table' is None, just
+            # make it an empty table.
+            information.pop("buffer", None)
+            information["symbol_table"] = SymbolTable(buffer)
+            information["found"] = False
+
+        pinned = information["found"] and is_pinned(symbol_key)
+        t0 = time.time()
+        get_store_writer().submit(
+            cache_key,
+            cache_key,
+            buffer,
+            timeout,
+            pinned,
+            generation,
+            nbytes=len(buffer),
+            after=after_store,
+        )
+        # Unless the store writer is busy, or there isn't one, this takes
+        # no time at all.
+        store_time = time.time() - t0
+        self.server_timing.add("store", store_time)
+        metrics.histogram(
+            "symbolicate_store_time",
+            store_time * 1000,
+            tags=[get_size_tag(information.get("download_size", 0))],
+        )
+        return information
+
+    @metrics.timer_decorator("symbolicate_load_symbol")
+    def load_symbol(self, filename, debug_id):
+        """Return a dict with the packed symbol table ('buffer') of this
+        symbol and how long it took, and how many bytes, to download it.
+        Raise SymbolNotFound if the symbol can't be found at all.
 
-        # Prioritize PUBLIC symbols over FUNC symbols # XXX why?
-        func_symbols.update(public_symbols)
+        If there's a sidecar (see tecken.upload.utils.upload_symbol_sidecar)
+        that's used. Otherwise the whole symbol file is downloaded and
+        parsed.
+        """
+        t0 = time.time()
+        buffer = None
+        total_size = 0
+        parse_time = 0.0
+        if settings.ENABLE_SYMBOL_SIDECARS:
+            buffer = self.load_symbol_sidecar(filename, debug_id)
+        if buffer is not None:
+            total_size = len(buffer)
+            metrics.incr("symbolicate_load_symbol_sidecar", 1)
+        else:
+            chunks = self.get_download_symbol_chunks(filename, debug_id)
+            url = next(chunks)
+            logger.debug(f"Parsing symbol file {url}")
+            # We are only interested in lines start with "FUNC" or "PUBLIC".
+            # See tecken.symbolicate.symparser for the details.
+            # The chunks are parsed as they're downloaded. Only the time
+            # spent parsing, not waiting for the next chunk, is counted
+            # as parse time.
+            parser = SymbolFileParser()
+            for chunk in chunks:
+                t0_parse = time.time()
+                parser.feed(chunk)
+                parse_time += time.time() - t0_parse
+            t0_parse = time.time()
+            offsets, index, names = parser.close_index()
+            total_size = parser.size
+            if total_size:
+                buffer = pack_symbol_table_from_index(offsets, index, names)
+            parse_time += time.time() - t0_parse
         t1 = time.time()
+        self.server_timing.add("parse", parse_time)
+        size_tag = get_size_tag(total_size)
+        metrics.histogram(
+            "symbolicate_download_time", (t1 - t0 - parse_time) * 1000, tags=[size_tag]
+        )
+        metrics.histogram("symbolicate_parse_time", parse_time * 1000, tags=[size_tag])
         if not total_size:
             logger.warning(
                 "Downloaded content empty ({!r}, {!r})".format(filename, debug_id)
             )
         information = {}
-        information["symbol_map"] = func_symbols
+        information["buffer"] = buffer
         information["download_time"] = t1 - t0
         information["download_size"] = total_size
         return information
 
-    def get_download_symbol_stream(self, lib_filename, debug_id):
+    def load_symbol_sidecar(self, filename, debug_id):
+        """Return the packed symbol table bytes of the sidecar of this symbol
+        or None if it doesn't have one (or it can't be read)."""
+        try:
+            chunks = self.get_download_symbol_chunks(
+                filename, debug_id, suffix=SIDECAR_SUFFIX
+            )
+            url = next(chunks)
+        except SymbolNotFound:
+            return None
+        buffer = b"".join(chunks)
+        try:
+            SymbolTable(buffer)
+        except InvalidSymbolTable as exception:
+            logger.warning(f"Unable to read symbol table from {url} ({exception})")
+            return None
+        return buffer
+
+    def get_download_symbol_chunks(self, lib_filename, debug_id, suffix=""):
         """
-        Return a requests.response stream or raise SymbolNotFound
-        if the symbol can't be found at all.
+        Return a generator of the symbol file in chunks of bytes or
+        raise SymbolNotFound if the symbol can't be found at all.
         """
         if lib_filename.endswith(".pdb"):
             symbol_filename = lib_filename[:-4] + ".sym"
         else:
             symbol_filename = lib_filename + ".sym"
 
-        stream = self.downloader.get_symbol_stream(
-            lib_filename, debug_id, symbol_filename
+        return self.downloader.get_symbol_chunks(
+            lib_filename, debug_id, symbol_filename + suffix
         )
-        return stream
 
 
-def json_post(view_function):
+def json_post(view_function=None, accept_msgpack=False):
     """The minimum for posting a symbolication request is that you use
-    POST and that you have a valid JSON payload in the body."""
+    POST and that you have a valid JSON payload in the body.
+
+    With 'accept_msgpack', if the request's content type is
+    MSGPACK_CONTENT_TYPE, the body is expected to be msgpack instead. Then
+    `request._msgpack` is true and the view is expected to answer in msgpack
+    too.
+    """
+    if view_function is None:
+        return partial(json_post, accept_msgpack=accept_msgpack)
 
     @wraps(view_function)
     def inner(request):
@@ -784,14 +1098,33 @@ def json_post(view_function):
         if request.method != "POST":
             return JsonResponse({"error": "Must use HTTP POST"}, status=405)
 
+        # The view times the rest of its phases into this too.
+        request._server_timing = server_timing = ServerTiming()
+        request._msgpack = (
+            accept_msgpack and request.content_type == MSGPACK_CONTENT_TYPE
+        )
         try:
-            json_body = json.loads(request.body.decode("utf-8"))
+            if request._msgpack:
+                with server_timing.time("msgpack"):
+                    json_body = msgpack.loads(request.body, raw=False)
+            else:
+                with server_timing.time("json"):
+                    json_body = json.loads(request.body.decode("utf-8"))
+        except (ValueError, msgpack.UnpackException):
+            if request._msgpack:
+                error = "Invalid msgpack passed in"
+            else:
+                error = "Invalid JSON passed in"
+            response = JsonResponse({"error": error}, status=400)
+        else:
             if not isinstance(json_body, dict):
-                return JsonResponse({"error": "Not a dict"}, status=400)
-        except ValueError:
-            return JsonResponse({"error": "Invalid JSON passed in"}, status=400)
+                response = JsonResponse({"error": "Not a dict"}, status=400)
+            else:
+                response = view_function(request, json_body)
 
-        return view_function(request, json_body)
+        response["Server-Timing"] = server_timing.get_header()
+        server_timing.send_metrics()
+        return response
 
     return inner
 
@@ -844,22 +1177,25 @@ def validate_memory_map(memory_map):
 @metrics.timer_decorator("symbolicate_json", tags=["version:v4"])
 @json_post
 def symbolicate_v4_json(request, json_body):
-
+    server_timing = request._server_timing
     try:
-        stacks = json_body["stacks"]
-        try:
-            validate_stacks(stacks)
-        except InvalidStacks as exception:
-            return JsonResponse({"error": str(exception)}, status=400)
-        memory_map = json_body["memoryMap"]
-        if json_body.get("version") != 4:
-            return JsonResponse({"error": "Expect version==4"}, status=400)
+        with server_timing.time("validate"):
+            stacks = json_body["stacks"]
+            try:
+                validate_stacks(stacks)
+            except InvalidStacks as exception:
+                return JsonResponse({"error": str(exception)}, status=400)
+            memory_map = json_body["memoryMap"]
+            if json_body.get("version") != 4:
+                return JsonResponse({"error": "Expect version==4"}, status=400)
     except KeyError as exception:
         return JsonResponse(
             {"error": 'Missing key JSON "{}"'.format(exception)}, status=400
         )
 
-    symbolicator = SymbolicateJSON(downloader, debug=request._request_debug)
+    symbolicator = SymbolicateJSON(
+        downloader, debug=request._request_debug, server_timing=server_timing
+    )
     try:
         result = symbolicator.symbolicate(stacks, memory_map)
     except operational_exceptions as exception:
@@ -884,16 +1220,17 @@ def symbolicate_v4_json(request, json_body):
     increment_symbolication_count("v4")
     metrics.incr("symbolicate_symbolication", tags=["version:v4"])
 
-    for i, stack in enumerate(result["symbolicatedStacks"]):
-        result["symbolicatedStacks"][i] = [rewrite_dict_to_list(x) for x in stack]
-    return JsonResponse(result)
+    with server_timing.time("serialize"):
+        for i, stack in enumerate(result["symbolicatedStacks"]):
+            result["symbolicatedStacks"][i] = [rewrite_dict_to_list(x) for x in stack]
+        return JsonResponse(result)
 
 
 @set_cors_headers(origin="*", methods=["OPTIONS", "POST"])
 @csrf_exempt
 @set_request_debug
 @metrics.timer_decorator("symbolicate_json", tags=["version:v5"])
-@json_post
+@json_post(accept_msgpack=True)
 def symbolicate_v5_json(request, json_body):
     """The sent in JSON body is expected to be a dict that looks like this:
 
@@ -924,6 +1261,10 @@ def symbolicate_v5_json(request, json_body):
 
     However, for convenience, if the JSON is only 'STACK-N' and not a
     dictionary with key "stacks", we'll just wrap it for you.
+
+    If the request is sent as msgpack (see json_post()), the response is
+    msgpack too and the 'module_offset' and 'function_offset' of every
+    frame are integers rather than hex strings.
     """
     if "stacks" in json_body and "memoryMap" in json_body:
         # Allow this to be passed in for convenience but "force"
@@ -932,29 +1273,40 @@ def symbolicate_v5_json(request, json_body):
         # But note! Even if you do this, you'll always get a dict with
         # a *list* of stacks.
 
-    # Before we actually unpack it, loop over it to make sure all things
-    # are there.
-    try:
-        if not json_body["jobs"]:
-            # Key is there but either None, False or []
-            return JsonResponse({"error": "Jobs list empty"}, status=400)
-        for i, stack in enumerate(json_body["jobs"]):
-            if not isinstance(stack["memoryMap"], list):
-                raise TypeError(f"Stack number {i + 1} is 'memoryMap' not a list")
-            # Should be a list of two items.
-            if not isinstance(stack["stacks"], list):
-                raise TypeError(f"Stack number {i + 1} is 'stacks' not a list")
-    except KeyError as exception:
-        return JsonResponse({"error": f"Missing key in JSON ({exception})"}, status=400)
-    except TypeError as exception:
-        return JsonResponse({"error": f"Wrong type of value ({exception})"}, status=400)
+    server_timing = request._server_timing
+    with server_timing.time("validate"):
+        # Before we actually unpack it, loop over it to make sure all things
+        # are there.
+        try:
+            if not json_body["jobs"]:
+                # Key is there but either None, False or []
+                return JsonResponse({"error": "Jobs list empty"}, status=400)
+            for i, stack in enumerate(json_body["jobs"]):
+                if not isinstance(stack["memoryMap"], list):
+                    raise TypeError(f"Stack number {i + 1} is 'memoryMap' not a list")
+                # Should be a list of two items.
+                if not isinstance(stack["stacks"], list):
+                    raise TypeError(f"Stack number {i + 1} is 'stacks' not a list")
+        except KeyError as exception:
+            return JsonResponse(
+                {"error": f"Missing key in JSON ({exception})"}, status=400
+            )
+        except TypeError as exception:
+            return JsonResponse(
+                {"error": f"Wrong type of value ({exception})"}, status=400
+            )
 
     # By creating 1 instance per multiple jobs, we can benefit from
     # re-used downloads of memory maps.
-    symbolicator = SymbolicateJSON(downloader, debug=request._request_debug)
+    symbolicator = SymbolicateJSON(
+        downloader, debug=request._request_debug, server_timing=server_timing
+    )
     results = {"results": []}
 
     def serialize_frames(frames):
+        if request._msgpack:
+            # There's no need to turn them into strings.
+            return frames
         for frame in frames:
             try:
                 frame["module_offset"] = hex(frame["module_offset"])
@@ -972,7 +1324,7 @@ def symbolicate_v5_json(request, json_body):
         "symbolicate_symbolication_jobs", len(json_body["jobs"]), tags=["version:v5"]
     )
 
-    try:
+    with server_timing.time("validate"):
         for job in json_body["jobs"]:
             try:
                 validate_stacks(job["stacks"])
@@ -983,7 +1335,18 @@ def symbolicate_v5_json(request, json_body):
             except InvalidMemoryMap as exception:
                 return JsonResponse({"error": str(exception)}, status=400)
 
-            result = symbolicator.symbolicate(job["stacks"], job["memoryMap"])
+    try:
+        # All the jobs are symbolicated together so that every symbol
+        # they need is only looked up once, and every offset in it only
+        # resolved once, no matter how many jobs need it.
+        job_results = symbolicator.symbolicate_jobs(
+            [(job["stacks"], job["memoryMap"]) for job in json_body["jobs"]]
+        )
+    except operational_exceptions as exception:
+        return http.HttpResponse(str(exception), status=503)
+
+    with server_timing.time("serialize"):
+        for job, result in zip(json_body["jobs"], job_results):
             found_modules = {}
             for i, module in enumerate(job["memoryMap"]):
                 found_modules["/".join(module)] = result["knownModules"][i]
@@ -995,6 +1358,6 @@ def symbolicate_v5_json(request, json_body):
             if "debug" in result:
                 job_result["debug"] = result["debug"]
             results["results"].append(job_result)
+        if request._msgpack:
+            return MsgpackResponse(results)
         return JsonResponse(results)
-    except operational_exceptions as exception:
-        return http.HttpResponse(str(exception), status=503)
@@ -20,7 +20,12 @@ from django.conf import settings
 from django.utils import timezone
 
 from tecken.upload.models import FileUpload
-from tecken.base.symboldownloader import SymbolDownloader
+from tecken.base.symboldownloader import SymbolDownloader, ITER_CHUNK_SIZE
+from tecken.base.symbolindex import symbol_index
+from tecken.symbolicate.symboltable import SIDECAR_SUFFIX, pack_symbol_table_from_index
+from tecken.symbolicate.symparser import SymbolFileParser
+from tecken.symbolicate.utils import invalidate_symbolicate_cache
+from tecken.symbolicate.utils import warm_symbolicate_cache
 
 
 logger = logging.getLogger("tecken")
@@ -155,6 +160,57 @@ def get_key_content_type(key_name):
     return settings.MIME_OVERRIDES.get(key_extension)
 
 
+def should_upload_sidecar(key_name):
+    """Return true if, based on this key name, a sidecar with the packed
+    symbol table should be uploaded next to it."""
+    return settings.ENABLE_SYMBOL_SIDECARS and key_name.lower().endswith(".sym")
+
+
+def should_warm_symbolicate_cache(key_name):
+    """Return true if, based on this key name, the symbol table should be
+    stored for symbolication right after it's been uploaded."""
+    return settings.WARM_SYMBOLICATE_CACHE_ON_UPLOAD and key_name.lower().endswith(
+        ".sym"
+    )
+
+
+@metrics.timer_decorator("upload_pack_symbol_file")
+def pack_symbol_file(file_path):
+    """Return the packed symbol table (see tecken.symbolicate.symboltable)
+    of this local .sym file."""
+    parser = SymbolFileParser()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(ITER_CHUNK_SIZE), b""):
+            parser.feed(chunk)
+    return pack_symbol_table_from_index(*parser.close_index())
+
+
+@metrics.timer_decorator("upload_symbol_sidecar")
+def upload_symbol_sidecar(client, bucket_name, key_name, symbol_table):
+    """Upload the packed symbol table of a .sym file next to it. It only
+    contains the FUNC and PUBLIC records, which is all symbolication
+    needs, so it's much smaller than the .sym file and doesn't need to
+    be parsed. Return its key name."""
+    body = gzip.compress(symbol_table)
+    sidecar_key_name = key_name + SIDECAR_SUFFIX
+    logger.debug(f"Uploading sidecar {sidecar_key_name!r} into {bucket_name!r}")
+    if isinstance(client, google_Bucket):
+        blob = client.blob(sidecar_key_name)
+        blob.content_encoding = "gzip"
+        blob.content_type = "application/octet-stream"
+        blob.upload_from_string(body)
+    else:
+        client.put_object(
+            Bucket=bucket_name,
+            Key=sidecar_key_name,
+            Body=body,
+            ContentEncoding="gzip",
+            ContentType="application/octet-stream",
+        )
+    metrics.incr("upload_symbol_sidecar_bytes", len(body))
+    return sidecar_key_name
+
+
 @metrics.timer_decorator("upload_file_upload")
 def upload_file_upload(
     client,
@@ -164,6 +220,7 @@ def upload_file_upload(
     upload=None,
     microsoft_download=False,
     client_lookup=None,
+    symbol_key=None,
 ):
     # The reason you might want to pass a different client for
     # looking up existing sizes is because you perhaps want to use
@@ -189,6 +246,7 @@ def upload_file_upload(
 
     metadata = {}
     compressed = False
+    original_file_path = file_path
 
     if should_compressed_key(key_name):
         compressed = True
@@ -287,6 +345,29 @@ def upload_file_upload(
     logger.info(f"Uploaded key {key_name}")
     metrics.incr("upload_file_upload_upload", 1)
 
+    key_names = [key_name]
+    upload_sidecar = should_upload_sidecar(key_name)
+    warm = symbol_key is not None and should_warm_symbolicate_cache(key_name)
+    if upload_sidecar or warm:
+        # It's not the end of the world if any of this fails. Symbolication
+        # then just has to download the .sym file instead.
+        try:
+            symbol_table = pack_symbol_file(original_file_path)
+            if upload_sidecar:
+                key_names.append(
+                    upload_symbol_sidecar(client, bucket_name, key_name, symbol_table)
+                )
+            if warm:
+                warm_symbolicate_cache(symbol_key, symbol_table)
+                warm = False
+        except Exception:  # pragma: no cover
+            if settings.DEBUG:
+                raise
+            logger.error(f"Unable to pack symbol table of {key_name}", exc_info=True)
+        if warm:
+            # Whoever uploaded it expects it to be invalidated, at least.
+            invalidate_symbolicate_cache([symbol_key])
+
     # If we managed to upload a file, different or not,
     # cache invalidate the key_existing_size() lookup.
     try:
@@ -296,18 +377,28 @@ def upload_file_upload(
             raise
         logger.error(f"Unable to invalidate key size {key_name}", exc_info=True)
 
-    # Take this opportunity to inform possible caches that the file,
-    # if before wasn't the case, is now stored in S3.
-    symbol, debugid, filename = key_name.split(settings.SYMBOL_FILE_PREFIX + "/")[
-        1
-    ].split("/")
+    # Any filter of the keys in this bucket has to know it's there now.
     try:
-        downloader.invalidate_cache(symbol, debugid, filename)
+        symbol_index.add(bucket_name, key_names)
     except Exception:  # pragma: no cover
         if settings.DEBUG:
             raise
-        logger.error(
-            f"Unable to invalidate symbol {symbol}/{debugid}/{filename}", exc_info=True
-        )
+        logger.error(f"Unable to add {key_name} to the symbol index", exc_info=True)
+
+    # Take this opportunity to inform possible caches that the file (and
+    # its sidecar), if before wasn't the case, is now stored in S3.
+    for uploaded_key_name in key_names:
+        symbol, debugid, filename = uploaded_key_name.split(
+            settings.SYMBOL_FILE_PREFIX + "/"
+        )[1].split("/")
+        try:
+            downloader.invalidate_cache(symbol, debugid, filename)
+        except Exception:  # pragma: no cover
+            if settings.DEBUG:
+                raise
+            logger.error(
+                f"Unable to invalidate symbol {symbol}/{debugid}/{filename}",
+                exc_info=True,
+            )
 
     return file_upload
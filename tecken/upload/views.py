@@ -34,6 +34,7 @@ from tecken.upload.utils import (
     dump_and_extract,
     UnrecognizedArchiveFileExtension,
     DuplicateFileDifferentSize,
+    should_warm_symbolicate_cache,
     upload_file_upload,
 )
 from tecken.symbolicate.tasks import invalidate_symbolicate_cache_task
@@ -398,6 +399,7 @@ def upload_archive(request, upload_dir):
                     member.path,
                     upload=upload_obj,
                     client_lookup=bucket or lookup_client,
+                    symbol_key=symbol_key,
                 )
             ] = key_name
         # Now lets wait for them all to finish and we'll see which ones
@@ -406,7 +408,10 @@ def upload_archive(request, upload_dir):
             file_upload = future.result()
             if file_upload:
                 file_uploads_created += 1
-                uploaded_symbol_keys.append(key_to_symbol_keys[file_upload.key])
+                if not should_warm_symbolicate_cache(file_upload.key):
+                    # Otherwise upload_file_upload() has already replaced
+                    # whatever was cached.
+                    uploaded_symbol_keys.append(key_to_symbol_keys[file_upload.key])
             else:
                 skipped_keys.append(future_to_key[future])
                 metrics.incr("upload_file_upload_skip", 1)
@@ -415,7 +420,8 @@ def upload_archive(request, upload_dir):
         logger.info(f"Created {file_uploads_created} FileUpload objects")
         # If there were some file uploads, there will be some symbol keys
         # that we can send to a background task to invalidate.
-        invalidate_symbolicate_cache_task.delay(uploaded_symbol_keys)
+        if uploaded_symbol_keys:
+            invalidate_symbolicate_cache_task.delay(uploaded_symbol_keys)
     else:
         logger.info(f"No file uploads created for {upload_obj!r}")
 
@@ -14,17 +14,34 @@ from markus.testing import MetricsMock
 from django.core.cache import caches
 from django.contrib.auth.models import User
 
+from tecken.base.sourcestats import source_stats
+from tecken.base.symbolindex import symbol_index
+from tecken.storage import storage_clients
+from tecken.symbolicate.memorycache import symbol_table_cache
+
 pytest_plugins = ["blockade"]
 
 
 @pytest.fixture
 def clear_redis_store():
     caches["store"].clear()
+    # Anything cached in memory came from the Redis store.
+    symbol_table_cache.clear()
 
 
 @pytest.fixture(autouse=True)
 def clear_cache():
     caches["default"].clear()
+    # What's in memory was read from, or is to be added to, the cache.
+    source_stats.clear()
+    symbol_index.clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_storage_clients():
+    # Clients are shared by the whole process. But a test might mock how
+    # they're made.
+    storage_clients.clear()
 
 
 @pytest.fixture
@@ -125,6 +125,99 @@ def test_client_happy_path_s3(client, botomock, metricsmock, settings):
         assert response["Access-Control-Allow-Methods"] == "GET"
 
 
+def test_client_presigned_url_cached(client, botomock, metricsmock, settings):
+    settings.SYMBOLDOWNLOAD_PRESIGNED_URL_EXPIRES_SECONDS = 3600
+    settings.SYMBOLDOWNLOAD_PRESIGNED_URL_CACHE_FRACTION = 0.5
+    reload_downloaders("https://s3.example.com/private/prefix/")
+
+    def mock_api_call(self, operation_name, api_params):
+        assert operation_name == "ListObjectsV2"
+        return {"Contents": [{"Key": api_params["Prefix"]}]}
+
+    url = reverse(
+        "download:download_symbol",
+        args=("xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2", "xul.sym"),
+    )
+    with botomock(mock_api_call), mock.patch("time.time") as mocked_time:
+        mocked_time.return_value = 1_000_000
+        response = client.get(url)
+        assert response.status_code == 302
+        assert response["Cache-Control"] == "max-age=1800"
+        location = response["location"]
+        assert "Expires=1003600" in location
+        assert not metricsmock.filter_records(
+            INCR, "tecken.symboldownloader_presigned_url_cache_hit"
+        )
+
+        # The same URL, for as long as it's left in the cache.
+        mocked_time.return_value = 1_000_600
+        response = client.get(url)
+        assert response["location"] == location
+        assert response["Cache-Control"] == "max-age=1200"
+        assert metricsmock.filter_records(
+            INCR, "tecken.symboldownloader_presigned_url_cache_hit"
+        )
+
+        # Unless the cache is refreshed.
+        response = client.get(url, {"_refresh": 1})
+        assert response["location"] != location
+        assert response["Cache-Control"] == "max-age=1800"
+
+        # Without caching, there's no Cache-Control either.
+        settings.SYMBOLDOWNLOAD_PRESIGNED_URL_CACHE_FRACTION = 0
+        response = client.get(url)
+        assert response.status_code == 302
+        assert not response.has_header("Cache-Control")
+
+        # A URL is never handed out for all of the time it's valid.
+        settings.SYMBOLDOWNLOAD_PRESIGNED_URL_CACHE_FRACTION = 2
+        response = client.get(url, {"_refresh": 1})
+        assert response["Cache-Control"] == "max-age=3240"
+
+
+@pytest.mark.django_db
+def test_client_download_symbols_presigned_url_cached(
+    client, botomock, metricsmock, settings
+):
+    reload_downloaders("https://s3.example.com/private/prefix/")
+
+    def mock_api_call(self, operation_name, api_params):
+        assert operation_name == "ListObjectsV2"
+        return {"Contents": [{"Key": api_params["Prefix"]}]}
+
+    url = reverse("download:download_symbols")
+    symbols = [
+        ["xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2", "xul.sym"],
+        ["nss3.pdb", "9354378E7F4E4322A83EA57C483671962", "nss3.sym"],
+    ]
+    with botomock(mock_api_call):
+        response = client.post(
+            url, {"symbols": symbols}, content_type="application/json"
+        )
+        assert response.status_code == 200
+        results = response.json()
+        assert not metricsmock.filter_records(
+            INCR, "tecken.symboldownloader_presigned_url_cache_hit"
+        )
+
+        # Both URLs are read from the cache in one go.
+        response = client.post(
+            url, {"symbols": symbols}, content_type="application/json"
+        )
+        assert response.json() == results
+        record, = metricsmock.filter_records(
+            INCR, "tecken.symboldownloader_presigned_url_cache_hit"
+        )
+        assert record[2] == 2
+
+        # And the single symbol download hands out the same URL.
+        response = client.get(reverse("download:download_symbol", args=symbols[0]))
+        assert (
+            response["location"]
+            == results["xul.pdb/44E4EC8C2F41492B9369D6B9A059577C2/xul.sym"]["url"]
+        )
+
+
 def test_client_legacy_product_prefix(client, gcsmock, metricsmock):
     reload_downloaders("https://storage.googleapis.example.com/private/prefix/")
 
@@ -231,6 +324,10 @@ def test_client_try_download(client, gcsmock, settings):
     response = client.get(try_url, HTTP_DEBUG="true")
     assert response.status_code == 302
     assert float(response["debug-time"]) > 0
+    # And how long each source took.
+    source_timing, = response["debug-time-sources"].split(", ")
+    assert source_timing.startswith("private/trying/v0;dur=")
+    assert source_timing.endswith(";hit")
 
     # You can also use the regular URL but add ?try to the URL
     response = client.get(url, {"try": True})
@@ -571,6 +668,109 @@ def test_client_404_logged_bad_code_file(client, botomock, clear_redis_store, se
         assert not MissingSymbol.objects.all().exists()
 
 
+@pytest.mark.django_db
+def test_client_download_symbols(client, botomock, settings):
+    reload_downloaders(
+        [
+            "https://s3.example.com/private/prefix/",
+            "https://s3.example.com/other/prefix/",
+        ]
+    )
+    settings.ENABLE_STORE_MISSING_SYMBOLS = True
+    mock_calls = []
+
+    def mock_api_call(self, operation_name, api_params):
+        assert operation_name == "ListObjectsV2"
+        mock_calls.append((api_params["Bucket"], api_params["Prefix"]))
+        if api_params["Prefix"].endswith("xxx.sym"):
+            return {}
+        if api_params["Bucket"] == "private" and "nss3" in api_params["Prefix"]:
+            return {}
+        return {"Contents": [{"Key": api_params["Prefix"]}]}
+
+    url = reverse("download:download_symbols")
+    symbols = [
+        ["xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2", "xul.sym"],
+        ["nss3.pdb", "9354378E7F4E4322A83EA57C483671962", "nss3.sym"],
+        ["xxx.pdb", "44E4EC8C2F41492B9369D6B9A059577C2", "xxx.sym", "xxx.dll", "X"],
+        ["cxinjime.pdb", "342D9B0A3AE64812A2388C055C9F6C321", "file.ptr"],
+        ["x{y.pdb", "44E4EC8C2F41492B9369D6B9A059577C2", "x{y.sym"],
+    ]
+    with botomock(mock_api_call):
+        response = client.post(
+            url, {"symbols": symbols}, content_type="application/json"
+        )
+        assert response.status_code == 200
+        results = response.json()
+        xul = results["xul.pdb/44E4EC8C2F41492B9369D6B9A059577C2/xul.sym"]
+        assert xul["status"] == 302
+        assert urlparse(xul["url"]).path == (
+            "/private/prefix/v0/xul.pdb/44E4EC8C2F41492B9369D6B9A059577C2/xul.sym"
+        )
+        nss3 = results["nss3.pdb/9354378E7F4E4322A83EA57C483671962/nss3.sym"]
+        assert nss3["status"] == 302
+        assert urlparse(nss3["url"]).path.startswith("/other/prefix/")
+        assert results["xxx.pdb/44E4EC8C2F41492B9369D6B9A059577C2/xxx.sym"] == {
+            "status": 404
+        }
+        assert results["cxinjime.pdb/342D9B0A3AE64812A2388C055C9F6C321/file.ptr"] == {
+            "status": 404
+        }
+        assert results["x{y.pdb/44E4EC8C2F41492B9369D6B9A059577C2/x{y.sym"] == {
+            "status": 400
+        }
+        # xul.sym was only looked for in the first source.
+        assert len(mock_calls) == 5
+        missing, = MissingSymbol.objects.all()
+        assert missing.symbol == "xxx.pdb"
+        assert missing.code_file == "xxx.dll"
+        assert missing.code_id == "X"
+        assert missing.count == 1
+
+        # Now it's all in the cache.
+        response = client.post(
+            url, {"symbols": symbols}, content_type="application/json"
+        )
+        assert response.status_code == 200
+        assert {k: v["status"] for k, v in response.json().items()} == {
+            k: v["status"] for k, v in results.items()
+        }
+        assert len(mock_calls) == 5
+        # It's only logged as missing once in a while.
+        missing.refresh_from_db()
+        assert missing.count == 1
+
+        # Unless the cache is refreshed.
+        response = client.post(
+            url + "?_refresh", {"symbols": symbols[:1]}, content_type="application/json"
+        )
+        assert response.status_code == 200
+        assert len(mock_calls) == 6
+
+    # And the same for the single symbol download.
+    single_url = reverse("download:download_symbol", args=symbols[1])
+    with botomock(mock_api_call):
+        response = client.get(single_url)
+        assert response.status_code == 302
+        assert len(mock_calls) == 6
+
+
+def test_client_download_symbols_bad_request(client, settings):
+    url = reverse("download:download_symbols")
+    assert client.get(url).status_code == 405
+    response = client.post(url, "{not json", content_type="application/json")
+    assert response.status_code == 400
+    assert response.json()["error"] == "Invalid JSON passed in"
+    for body in ({}, {"symbols": "xul.pdb"}, {"symbols": [["xul.pdb", "ABC"]]}):
+        response = client.post(url, body, content_type="application/json")
+        assert response.status_code == 400
+    settings.DOWNLOAD_BATCH_MAX_SYMBOLS = 1
+    symbols = [["xul.pdb", "ABC", "xul.sym"], ["nss3.pdb", "ABC", "nss3.sym"]]
+    response = client.post(url, {"symbols": symbols}, content_type="application/json")
+    assert response.status_code == 400
+    assert response.json()["error"] == "No more than 1 symbols per request"
+
+
 def test_log_symbol_get_404_metrics(metricsmock):
     views.log_symbol_get_404(
         "xul.pdb",
@@ -699,6 +899,54 @@ def test_get_microsoft_symbol_client(client, botomock, settings):
             assert len(task_arguments) == 1
 
 
+@pytest.mark.django_db
+def test_get_microsoft_symbols_client(client, botomock, settings):
+    settings.ENABLE_DOWNLOAD_FROM_MICROSOFT = True
+    settings.ENABLE_STORE_MISSING_SYMBOLS = True
+    reload_downloaders("https://s3.example.com/private/prefix/")
+
+    def mock_api_call(self, operation_name, api_params):
+        assert operation_name == "ListObjectsV2"
+        return {}
+
+    url = reverse("download:download_symbols")
+    symbols = [
+        ["foo.pdb", "44E4EC8C2F41492B9369D6B9A059577C2", "foo.sym"],
+        ["foo.pdb", "44E4EC8C2F41492B9369D6B9A059577C2", "foo.sym", "foo.dll", "X"],
+        ["bar.so", "44E4EC8C2F41492B9369D6B9A059577C2", "bar.sym"],
+    ]
+    task_arguments = []
+
+    def fake_task(symbol, debugid, **kwargs):
+        task_arguments.append((symbol, debugid, kwargs))
+
+    _mock_function = "tecken.download.views.download_microsoft_symbol.delay"
+    with mock.patch(_mock_function, new=fake_task):
+        with botomock(mock_api_call):
+            response = client.post(
+                url, {"symbols": symbols}, content_type="application/json"
+            )
+            assert response.status_code == 200
+            results = response.json()
+            assert results["foo.pdb/44E4EC8C2F41492B9369D6B9A059577C2/foo.sym"] == {
+                "status": 404,
+                "delayed_lookup": True,
+            }
+            assert results["bar.so/44E4EC8C2F41492B9369D6B9A059577C2/bar.sym"] == {
+                "status": 404
+            }
+            # Once, however many times it was asked for.
+            task_argument, = task_arguments
+            assert task_argument[0] == "foo.pdb"
+            assert MissingSymbol.objects.count() == 3
+
+            response = client.post(
+                url, {"symbols": symbols}, content_type="application/json"
+            )
+            assert response.status_code == 200
+            assert len(task_arguments) == 1
+
+
 @pytest.mark.django_db
 def test_store_missing_symbol_task_happy_path():
     store_missing_symbol_task("foo.pdb", "HEX", "foo.sym", code_file="file")
@@ -79,6 +79,29 @@ def test_StorageBucket_client():
         assert client_kwargs_calls[-1]["region_name"] == ("eu-west-2")
 
 
+def test_storage_clients_shared(settings):
+    settings.UPLOAD_FILE_UPLOAD_MAX_WORKERS = 25
+    bucket = StorageBucket("http://s3.example.com/buck/prefix")
+    client = bucket.client
+    # Another bucket with the same configuration gets the same client.
+    assert StorageBucket("http://s3.example.com/other/prefix").client is client
+    assert client.meta.config.max_pool_connections == 25
+
+    put_client = bucket.get_storage_client(read_timeout=30, connect_timeout=10)
+    assert put_client is not client
+    assert put_client.meta.config.read_timeout == 30
+    assert bucket.get_storage_client(read_timeout=30, connect_timeout=10) is (
+        put_client
+    )
+
+    other_client = StorageBucket("http://s3.example.net/buck/prefix").client
+    assert other_client is not client
+
+    settings.S3_MAX_POOL_CONNECTIONS = 50
+    client = StorageBucket("http://s3.example.com/buck/prefix").get_storage_client()
+    assert client.meta.config.max_pool_connections == 50
+
+
 def test_region_checking():
     bucket = StorageBucket("https://s3.amazonaws.com/some-bucket")
     assert bucket.region is None
@@ -112,3 +135,16 @@ def test_scrub_credentials():
     result = scrub_credentials("http://storage.example.com/foo/bar?hey=ho")
     # Exactly the same
     assert result == "http://storage.example.com/foo/bar?hey=ho"
+
+
+def test_session(settings):
+    settings.SYMBOLDOWNLOAD_HTTP_POOL_MAXSIZE = 7
+    settings.SYMBOLDOWNLOAD_HTTP_RETRIES = 1
+    bucket = StorageBucket("https://s3.example.com/bucket/?access=public")
+    session = bucket.session
+    # Always the same session, so the same pool of connections.
+    assert bucket.session is session
+    adapter = session.get_adapter("https://s3.example.com/bucket/")
+    assert adapter._pool_maxsize == 7
+    assert adapter.max_retries.total == 1
+    assert not adapter.max_retries.raise_on_status
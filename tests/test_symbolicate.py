@@ -2,23 +2,62 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
+import concurrent.futures
 import copy
+import gzip
+import os
+import threading
+import time
 from io import BytesIO
 
 import botocore
+import mock
+import msgpack
 import requests
 import pytest
-from markus import INCR, GAUGE
+from markus import INCR, GAUGE, HISTOGRAM
 from botocore.exceptions import ClientError
 
 from django.urls import reverse
 from django.core.cache import caches, cache
 from django.utils import timezone
+from django_redis import get_redis_connection
 
 from tecken.base.symboldownloader import SymbolDownloader, SymbolDownloadError
 from tecken.symbolicate import views
 from tecken.symbolicate.views import UNKNOWN_MODULE
 from tecken.symbolicate.tasks import invalidate_symbolicate_cache
+from tecken.symbolicate.diskcache import SymbolTableDiskCache
+from tecken.symbolicate.servertiming import get_size_tag
+from tecken.symbolicate.pinned import (
+    get_pinned_symbol_tables,
+    is_pinned,
+    make_pinned_key,
+)
+from tecken.symbolicate.memorycache import (
+    GENERATION_MEMBER,
+    INVALIDATIONS_KEY,
+    MAX_INVALIDATION_GENERATIONS,
+    SymbolTableCache,
+    get_generation,
+    record_invalidations,
+    symbol_table_cache,
+)
+from tecken.symbolicate.storewriter import StoreWriter
+from tecken.symbolicate.symboltable import (
+    SymbolTable,
+    InvalidSymbolTable,
+    pack_symbol_map,
+    pack_symbol_table,
+    pack_symbol_table_from_index,
+)
+from tecken.symbolicate.symparser import SymbolFileParser, parse_symbol_file
+from tecken.symbolicate.utils import (
+    make_symbol_key_cache_key,
+    make_symbol_table_cache_key,
+    queue_set_buffer,
+    store_symbol_table,
+)
 
 
 SAMPLE_SYMBOL_CONTENT = {
@@ -474,6 +513,58 @@ def test_client_happy_path_v5_with_m_prefix(
     assert stack2["function"] == "KiUserCallbackDispatcher"
 
 
+def test_symbolicate_v5_json_sidecar(
+    json_poster, clear_redis_store, botomock, settings
+):
+    """If there's a sidecar with the packed symbol table next to the .sym
+    file, that's downloaded instead. If there isn't, the .sym file is."""
+    settings.ENABLE_SYMBOL_SIDECARS = True
+    reload_downloader("https://s3.example.com/public/prefix/")
+
+    offsets, names, _ = parse_symbol_file(
+        [SAMPLE_SYMBOL_CONTENT["xul.sym"].encode("utf-8")]
+    )
+    packed = gzip.compress(pack_symbol_table(offsets, names))
+    downloaded = []
+
+    def mock_api_call(self, operation_name, api_params):
+        if operation_name == "GetObject":
+            filename = api_params["Key"].split("/")[-1]
+            downloaded.append(filename)
+            if filename == "xul.sym.packed":
+                return {"Body": BytesIO(packed), "ContentEncoding": "gzip"}
+            if filename == "wntdll.sym.packed":
+                parsed_response = {
+                    "Error": {"Code": "NoSuchKey", "Message": "Not found"}
+                }
+                raise ClientError(parsed_response, operation_name)
+            if filename in SAMPLE_SYMBOL_CONTENT:
+                return {
+                    "Body": BytesIO(SAMPLE_SYMBOL_CONTENT[filename].encode("utf-8"))
+                }
+            raise NotImplementedError(api_params)
+
+        raise NotImplementedError(operation_name)
+
+    url = reverse("symbolicate:symbolicate_v5_json")
+    with botomock(mock_api_call):
+        job = {
+            "stacks": [[[0, 11_723_767], [1, 65802]]],
+            "memoryMap": [
+                ["xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2"],
+                ["wntdll.pdb", "D74F79EB1F8D4A45ABCD2F476CCABACC2"],
+            ],
+        }
+        response = json_poster(url, {"jobs": [job]})
+    result = response.json()
+    result1, = result["results"]
+    assert list(result1["found_modules"].values()) == [True, True]
+    stack1, stack2 = result1["stacks"][0]
+    assert stack1["function"] == "XREMain::XRE_mainRun()"
+    assert stack2["function"] == "KiUserCallbackDispatcher"
+    assert sorted(downloaded) == ["wntdll.sym", "wntdll.sym.packed", "xul.sym.packed"]
+
+
 def test_v5_first_download_address_missing(
     json_poster, clear_redis_store, botomock, metricsmock
 ):
@@ -730,7 +821,7 @@ def test_symbolicate_v4_json_lru_causing_mischief(
 ):
     """Warning! This test is quite fragile.
     It runs the symbolication twice. After the first run, the test
-    manually goes in and deletes the hash map.
+    manually goes in and deletes the packed symbol table.
     This requires "direct access" to the Redis store but it's to
     simulate what the LRU naturally does but without waiting for
     time or max. memory usage.
@@ -772,14 +863,14 @@ def test_symbolicate_v4_json_lru_causing_mischief(
     assert result["debug"]["downloads"]["count"] == 2
     assert result["debug"]["cache_lookups"]["count"] == 2
 
-    # Pretend the LRU evicted the 'xul.pdb/...' hashmap.
+    # Pretend the LRU evicted the 'xul.pdb/...' symbol table.
     store = caches["store"]
-    hashmap_key, = [
+    table_key, = [
         key
         for key in store.iter_keys("*")
-        if not key.endswith(":keys") and "xul.pdb" in key
+        if key.endswith(":packed") and "xul.pdb" in key
     ]
-    assert store.delete(hashmap_key)
+    assert store.delete(table_key)
 
     # Same symbolication one more time
     response = json_poster(
@@ -890,6 +981,122 @@ def test_symbolicate_v5_json_bad_module_offset(
     assert result["error"]
 
 
+def test_symbolicate_v5_msgpack(client, clear_redis_store, botomock):
+    reload_downloader("https://s3.example.com/public/prefix/")
+    url = reverse("symbolicate:symbolicate_v5_json")
+    job = {
+        "stacks": [[[0, 11_723_767], [1, 65802]]],
+        "memoryMap": [
+            ["xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2"],
+            ["wntdll.pdb", "D74F79EB1F8D4A45ABCD2F476CCABACC2"],
+        ],
+    }
+    with botomock(default_mock_api_call):
+        response = client.post(
+            url,
+            msgpack.dumps({"jobs": [job]}, use_bin_type=True),
+            content_type="application/msgpack",
+        )
+    assert response.status_code == 200
+    assert response["Content-Type"] == "application/msgpack"
+    result = msgpack.loads(response.content, raw=False)
+    result1, = result["results"]
+    frame1, frame2 = result1["stacks"][0]
+    # The offsets are integers, not hex strings like in JSON.
+    assert frame1 == {
+        "frame": 0,
+        "module": "xul.pdb",
+        "module_offset": 11_723_767,
+        "function": "XREMain::XRE_mainRun()",
+        "function_offset": 0,
+    }
+    assert frame2["function"] == "KiUserCallbackDispatcher"
+    assert frame2["module_offset"] == 65802
+
+    response = client.post(url, b"\xc1", content_type="application/msgpack")
+    assert response.status_code == 400
+    assert response.json() == {"error": "Invalid msgpack passed in"}
+
+
+def test_symbolicate_v4_no_msgpack(client):
+    """Only v5 answers in msgpack so only v5 accepts msgpack."""
+    url = reverse("symbolicate:symbolicate_v4_json")
+    body = {
+        "stacks": [[[0, 11_723_767]]],
+        "memoryMap": [["xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2"]],
+        "version": 4,
+    }
+    response = client.post(
+        url, msgpack.dumps(body, use_bin_type=True), content_type="application/msgpack"
+    )
+    assert response.status_code == 400
+    assert response.json() == {"error": "Invalid JSON passed in"}
+
+
+def test_symbolicate_server_timing(
+    json_poster, clear_redis_store, botomock, metricsmock
+):
+    reload_downloader("https://s3.example.com/public/prefix/")
+
+    def get_server_timing(response):
+        phases = {}
+        for metric in response["Server-Timing"].split(", "):
+            name, duration = metric.split(";dur=")
+            phases[name] = float(duration)
+        return phases
+
+    job = {
+        "stacks": [[[0, 11_723_767], [1, 65802]]],
+        "memoryMap": [
+            ["xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2"],
+            ["wntdll.pdb", "D74F79EB1F8D4A45ABCD2F476CCABACC2"],
+        ],
+    }
+    with botomock(default_mock_api_call):
+        url = reverse("symbolicate:symbolicate_v5_json")
+        response = json_poster(url, {"jobs": [job]})
+        assert response.status_code == 200
+        phases = get_server_timing(response)
+        assert list(phases) == [
+            "json",
+            "validate",
+            "lookup",
+            "parse",
+            "store",
+            "download",
+            "resolve",
+            "serialize",
+        ]
+        assert all(duration >= 0 for duration in phases.values())
+        assert metricsmock.filter_records(
+            HISTOGRAM, "tecken.symbolicate_phase_time", tags=["phase:download"]
+        )
+        # Both symbol files are tiny.
+        records = metricsmock.filter_records(
+            HISTOGRAM, "tecken.symbolicate_parse_time", tags=["size:lt1mb"]
+        )
+        assert len(records) == 2
+
+        # Now they're all in the Redis store.
+        url = reverse("symbolicate:symbolicate_v4_json")
+        response = json_poster(url, dict(job, version=4))
+        assert response.status_code == 200
+        phases = get_server_timing(response)
+        assert list(phases) == ["json", "validate", "lookup", "resolve", "serialize"]
+
+    # Even bad requests say how long it took to find out.
+    response = json_poster(url, {"stacks": "wrong"})
+    assert response.status_code == 400
+    assert list(get_server_timing(response)) == ["json", "validate"]
+
+
+def test_get_size_tag():
+    assert get_size_tag(0) == "size:lt1mb"
+    assert get_size_tag(5 * 1024 * 1024) == "size:lt10mb"
+    assert get_size_tag(50 * 1024 * 1024) == "size:lt100mb"
+    assert get_size_tag(500 * 1024 * 1024) == "size:gte100mb"
+
+
 def test_symbolicate_v4_json_happy_path_with_debug(
     json_poster, clear_redis_store, botomock
 ):
@@ -923,6 +1130,10 @@ def test_symbolicate_v4_json_happy_path_with_debug(
     # One cache lookup was attempted
     assert result["debug"]["cache_lookups"]["count"] == 2
     assert result["debug"]["cache_lookups"]["time"] > 0.0
+    phases = result["debug"]["cache_lookups"]["phases"]
+    assert sorted(phases) == ["lookup", "recheck"]
+    assert phases["lookup"]["count"] == 1
+    assert phases["recheck"]["count"] == 1
     assert result["debug"]["downloads"]["count"] == 2
     assert result["debug"]["downloads"]["size"] > 0.0
     assert result["debug"]["downloads"]["time"] > 0.0
@@ -958,8 +1169,10 @@ def test_symbolicate_v4_json_happy_path_with_debug(
     assert result["debug"]["stacks"]["real"] == 2
     assert result["debug"]["stacks"]["count"] == 2
     assert result["debug"]["time"] > 0.0
-    assert result["debug"]["cache_lookups"]["count"] == 5
+    # One MGET for all the packed symbol tables.
+    assert result["debug"]["cache_lookups"]["count"] == 1
     assert result["debug"]["cache_lookups"]["time"] > 0.0
+    assert list(result["debug"]["cache_lookups"]["phases"]) == ["lookup"]
     assert result["debug"]["downloads"]["count"] == 0
     assert result["debug"]["downloads"]["size"] == 0.0
     assert result["debug"]["downloads"]["time"] == 0.0
@@ -1303,17 +1516,61 @@ def test_symbolicate_v5_json_reused_memory_maps(
         response = json_poster(url, {"jobs": [job1, job2, job3]}, debug=True)
     result = response.json()
 
+    # All the symbols, of all the jobs, are looked up and downloaded
+    # together while doing the first job.
     result1 = result["results"][0]
-    assert result1["debug"]["downloads"]["count"] == 2
+    assert result1["debug"]["downloads"]["count"] == 3
     assert result1["debug"]["cache_lookups"]["count"] == 2
+    assert result1["debug"]["cache_lookups"]["phases"]["lookup"]["count"] == 1
 
     result2 = result["results"][1]
     assert result2["debug"]["downloads"]["count"] == 0
     assert result2["debug"]["cache_lookups"]["count"] == 0
+    assert result2["stacks"][0][0]["function"] == "XREMain::XRE_mainRun()"
+    # Even though it was looked up for the first job.
+    assert result2["found_modules"] == {
+        "xul.pdb/44E4EC8C2F41492B9369D6B9A059577C2": True
+    }
 
     result3 = result["results"][2]
-    assert result3["debug"]["downloads"]["count"] == 1
-    assert result3["debug"]["cache_lookups"]["count"] == 2
+    assert result3["debug"]["downloads"]["count"] == 0
+    assert result3["debug"]["cache_lookups"]["count"] == 0
+    assert result3["found_modules"] == {
+        "firefox.pdb/9A8C8930C5E935E3B441CC9D6E72BB990": True
+    }
+
+
+def test_symbolicate_v5_json_one_lookup_across_jobs(
+    json_poster, clear_redis_store, botomock, monkeypatch
+):
+    reload_downloader("https://s3.example.com/public/prefix/")
+    lookups = []
+    lookup_many = SymbolTable.lookup_many
+
+    def mocked_lookup_many(self, offsets):
+        offsets = list(offsets)
+        lookups.append(sorted(offsets))
+        return lookup_many(self, offsets)
+
+    monkeypatch.setattr(SymbolTable, "lookup_many", mocked_lookup_many)
+
+    url = reverse("symbolicate:symbolicate_v5_json")
+    memory_map = [["xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2"]]
+    jobs = [
+        {"stacks": [[[0, 11_723_767], [0, 10_613_656]]], "memoryMap": memory_map},
+        {"stacks": [[[0, 11_723_767]]], "memoryMap": memory_map},
+        {"stacks": [[[0, 10_613_656]], [[-1, 10]]], "memoryMap": memory_map},
+    ]
+    with botomock(default_mock_api_call):
+        response = json_poster(url, {"jobs": jobs})
+    assert response.status_code == 200
+    assert lookups == [[10_613_656, 10_613_656, 11_723_767, 11_723_767]]
+    result1, result2, result3 = response.json()["results"]
+    frame1, frame2 = result1["stacks"][0]
+    assert result2["stacks"][0][0] == frame1
+    assert result3["stacks"][0][0] == dict(frame2, frame=0)
+    assert frame1["function"] == frame2["function"] == "XREMain::XRE_mainRun()"
+    assert result3["stacks"][1][0]["module"] == UNKNOWN_MODULE
 
 
 def test_invalidate_symbols_invalidates_cache(
@@ -1450,8 +1707,8 @@ def test_symbolicate_huge_symbol_file(
     50,000 rows/signatures. In fact, it has 75,000 signatures and we're
     expecting to find the signature of the very last offset.
 
-    This test verifies that the "batch HMSET" code in the load_symbols()
-    function really works.
+    This test verifies that the "chunked APPEND" code in the
+    store_symbol_table() function really works.
     """
     settings.SYMBOL_URLS = ["https://s3.example.com/private/prefix/"]
     reload_downloader("https://s3.example.com/public/prefix/")
@@ -1494,3 +1751,804 @@ def test_symbolicate_huge_symbol_file(
             }
         ]
     ]
+
+
+def test_symbolicate_store_symbol_table_in_chunks(
+    json_poster, clear_redis_store, botomock
+):
+    """With a tiny STORE_CHUNK_SIZE the packed symbol table is written
+    to the Redis store in many chunks."""
+    reload_downloader("https://s3.example.com/public/prefix/")
+    with botomock(default_mock_api_call):
+        url = reverse("symbolicate:symbolicate_v5_json")
+        job = {
+            "stacks": [[[0, 11_723_767]]],
+            "memoryMap": [["xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2"]],
+        }
+        with mock.patch("tecken.symbolicate.utils.STORE_CHUNK_SIZE", 10):
+            response = json_poster(url, {"jobs": [job]})
+    assert response.status_code == 200
+    frame, = response.json()["results"][0]["stacks"][0]
+    assert frame["function"] == "XREMain::XRE_mainRun()"
+
+    store = caches["store"]
+    cache_key = make_symbol_key_cache_key(
+        ("xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2")
+    )
+    raw = get_redis_connection("store").get(
+        store.make_key(make_symbol_table_cache_key(cache_key))
+    )
+    table = SymbolTable(raw)
+    assert len(table) == 2
+    assert not list(store.iter_keys("*:tmp:*"))
+    # It doesn't keep the expiry of the temporary key.
+    assert (
+        get_redis_connection("store").ttl(
+            store.make_key(make_symbol_table_cache_key(cache_key))
+        )
+        == -1
+    )
+
+
+def test_queue_set_buffer_concurrently(clear_redis_store):
+    """Two chunked writes of the same key at the same time each write the
+    whole thing."""
+    connection = get_redis_connection("store")
+    key = caches["store"].make_key("concurrent")
+    first = connection.pipeline(transaction=False)
+    second = connection.pipeline(transaction=False)
+    with mock.patch("tecken.symbolicate.utils.STORE_CHUNK_SIZE", 10):
+        queue_set_buffer(first, key, b"a" * 25)
+        queue_set_buffer(second, key, b"b" * 25, timeout=100)
+    # Interleave the commands of the two.
+    for commands in zip(first.command_stack, second.command_stack):
+        for args, options in commands:
+            connection.execute_command(*args, **options)
+    assert connection.get(key) == b"b" * 25
+    assert 0 < connection.ttl(key) <= 100
+
+
+def test_pack_symbol_map():
+    table = SymbolTable(
+        pack_symbol_map({0x10: "foo", 0x30: "b\u00e4r", 0x20: "KiUser::Dispatch()"})
+    )
+    assert len(table) == 3
+    assert list(table.offsets) == [0x10, 0x20, 0x30]
+    assert table.get_name(2) == "b\u00e4r"
+    assert table.lookup(0x10) == (0x10, "foo")
+    assert table.lookup(0x2F) == (0x20, "KiUser::Dispatch()")
+    assert table.lookup(0x1000) == (0x30, "b\u00e4r")
+    # Like the old list based lookup, anything before the first function
+    # wraps around to the last function.
+    assert table.lookup(0x1) == (0x30, "b\u00e4r")
+
+    empty = SymbolTable(pack_symbol_map({}))
+    assert not empty
+    assert empty.lookup(100) is None
+    assert empty.lookup_many([100]) == {}
+
+
+def test_symbol_table_lookup_many():
+    table = SymbolTable(pack_symbol_map({0x10 * i: f"f{i}" for i in range(1, 100)}))
+    offsets = [0x1, 0x10, 0x11, 0x11, 0x2F, 0x500, 0x10 * 99, 0x10_000, 0x11]
+    found = table.lookup_many(offsets)
+    assert sorted(found) == sorted(set(offsets))
+    for offset in offsets:
+        assert found[offset] == table.lookup(offset)
+    assert found[0x1] == (0x10 * 99, "f99")
+
+
+def test_symbol_table_invalid():
+    with pytest.raises(InvalidSymbolTable):
+        SymbolTable(b"")
+    with pytest.raises(InvalidSymbolTable):
+        SymbolTable(b"x" * 100)
+    buffer = pack_symbol_map({1: "one", 2: "two"})
+    with pytest.raises(InvalidSymbolTable):
+        SymbolTable(buffer[:-1])
+    with pytest.raises(InvalidSymbolTable):
+        SymbolTable(buffer + b"x")
+    with pytest.raises(InvalidSymbolTable):
+        SymbolTable(buffer[:4] + b"\xff" + buffer[5:])
+
+
+def test_symbolicate_migrates_legacy_symbol_maps(
+    json_poster, clear_redis_store, metricsmock
+):
+    """Symbols stored the old way (a hashmap plus a list of all its keys)
+    should be used, and converted, without downloading anything."""
+    reload_downloader("https://s3.example.com/public/prefix/")
+    store = caches["store"]
+    cache_key = make_symbol_key_cache_key(
+        ("xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2")
+    )
+    get_redis_connection("store").hmset(
+        store.make_key(cache_key),
+        {0x26791A: "XREMain::XRE_mainRun()", 0xB2E3F7: "XREMain::XRE_main()"},
+    )
+    store.set(cache_key + ":keys", [0x26791A, 0xB2E3F7])
+
+    url = reverse("symbolicate:symbolicate_v5_json")
+    job = {
+        "stacks": [[[0, 11_723_767]]],
+        "memoryMap": [["xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2"]],
+    }
+    # Note, no botomock. Any download attempt would fail.
+    response = json_poster(url, {"jobs": [job]}, debug=True)
+    assert response.status_code == 200
+    result, = response.json()["results"]
+    frame, = result["stacks"][0]
+    assert frame["function"] == "XREMain::XRE_main()"
+    assert frame["function_offset"] == hex(11_723_767 - 0xB2E3F7)
+    assert metricsmock.has_record(
+        INCR, "tecken.symbolicate_migrate_legacy_symbol_map", 1, None
+    )
+    # One round trip to read the hashmap, one to store the symbol table.
+    assert result["debug"]["cache_lookups"]["phases"]["migrate"]["count"] == 2
+
+    raw = get_redis_connection("store").get(
+        store.make_key(make_symbol_table_cache_key(cache_key))
+    )
+    assert len(SymbolTable(raw)) == 2
+    assert not get_redis_connection("store").exists(store.make_key(cache_key))
+    assert store.get(cache_key + ":keys") is None
+
+
+def test_symbolicate_redis_round_trips(json_poster, clear_redis_store, metricsmock):
+    """However many modules there are, each phase of looking them up in the
+    Redis store is one single round trip."""
+    reload_downloader("https://s3.example.com/public/prefix/")
+    memory_map = [[f"lib{i}.pdb", "%033X" % i] for i in range(40)]
+    for symbol_key in memory_map:
+        store_symbol_table(
+            make_symbol_key_cache_key(tuple(symbol_key)), pack_symbol_map({})
+        )
+    url = reverse("symbolicate:symbolicate_v5_json")
+    job = {
+        "stacks": [[[i, 100] for i in range(len(memory_map))]],
+        "memoryMap": memory_map,
+    }
+    # Note, no botomock. Any download attempt would fail.
+    response = json_poster(url, {"jobs": [job]}, debug=True)
+    assert response.status_code == 200
+    result, = response.json()["results"]
+    assert result["found_modules"] == {
+        "{}/{}".format(*symbol_key): False for symbol_key in memory_map
+    }
+    assert result["debug"]["cache_lookups"]["count"] == 1
+    phases = result["debug"]["cache_lookups"]["phases"]
+    assert list(phases) == ["lookup"]
+    assert phases["lookup"]["count"] == 1
+    assert phases["lookup"]["time"] > 0.0
+    assert metricsmock.has_record(
+        INCR, "tecken.symbolicate_redis_round_trips", 1, ["phase:lookup"]
+    )
+
+
+def test_symbolicate_memory_cache(
+    json_poster, clear_redis_store, botomock, metricsmock, settings
+):
+    settings.SYMBOLICATE_MEMORY_CACHE_MAX_BYTES = 10 * 1024 * 1024
+    reload_downloader("https://s3.example.com/public/prefix/")
+    url = reverse("symbolicate:symbolicate_v5_json")
+    job = {
+        "stacks": [[[0, 11_723_767]]],
+        "memoryMap": [["xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2"]],
+    }
+
+    def symbolicate():
+        response = json_poster(url, {"jobs": [job]}, debug=True)
+        assert response.status_code == 200
+        result1, = response.json()["results"]
+        frame, = result1["stacks"][0]
+        assert frame["function"] == "XREMain::XRE_mainRun()"
+        return result1["debug"]
+
+    with botomock(default_mock_api_call):
+        debug = symbolicate()
+        assert debug["downloads"]["count"] == 1
+        assert debug["cache_lookups"]["memory_hits"] == 0
+        assert len(symbol_table_cache) == 1
+
+        debug = symbolicate()
+        assert debug["downloads"]["count"] == 0
+        assert debug["cache_lookups"]["count"] == 1
+        assert debug["cache_lookups"]["memory_hits"] == 1
+        assert metricsmock.has_record(
+            INCR, "tecken.symbolicate_symbol_key", 1, ["cache:memory"]
+        )
+
+        # Even if the Redis store LRU evicts it, it's still in memory.
+        store = caches["store"]
+        table_key, = store.iter_keys("*:packed")
+        assert store.delete(table_key)
+        debug = symbolicate()
+        assert debug["downloads"]["count"] == 0
+        assert debug["cache_lookups"]["memory_hits"] == 1
+
+        # Invalidating it is noticed even though another process did it.
+        invalidate_symbolicate_cache([("xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2")])
+        symbol_table_cache.set(
+            make_symbol_key_cache_key(("xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2")),
+            SymbolTable(pack_symbol_map({1: "stale"})),
+        )
+        debug = symbolicate()
+        assert debug["downloads"]["count"] == 1
+        assert debug["cache_lookups"]["memory_hits"] == 0
+
+
+def test_symbolicate_disk_cache(
+    json_poster, clear_redis_store, botomock, metricsmock, settings, tmpdir
+):
+    settings.SYMBOLICATE_DISK_CACHE_DIRECTORY = tmpdir
+    reload_downloader("https://s3.example.com/public/prefix/")
+    url = reverse("symbolicate:symbolicate_v5_json")
+    symbol_key = ("xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2")
+    job = {"stacks": [[[0, 11_723_767]]], "memoryMap": [list(symbol_key)]}
+
+    def symbolicate():
+        response = json_poster(url, {"jobs": [job]}, debug=True)
+        assert response.status_code == 200
+        result1, = response.json()["results"]
+        frame, = result1["stacks"][0]
+        assert frame["function"] == "XREMain::XRE_mainRun()"
+        return result1["debug"]
+
+    with botomock(default_mock_api_call):
+        debug = symbolicate()
+        assert debug["downloads"]["count"] == 1
+        assert debug["cache_lookups"]["disk_hits"] == 0
+        # Only what's fetched from the Redis store is written to disk.
+        assert not os.listdir(tmpdir)
+
+        debug = symbolicate()
+        assert debug["downloads"]["count"] == 0
+        assert debug["cache_lookups"]["disk_hits"] == 0
+        assert len(os.listdir(tmpdir)) == 1
+
+        # Even if the Redis store LRU evicts it, it's still on disk.
+        store = caches["store"]
+        table_key, = store.iter_keys("*:packed")
+        assert store.delete(table_key)
+        debug = symbolicate()
+        assert debug["downloads"]["count"] == 0
+        assert debug["cache_lookups"]["disk_hits"] == 1
+        assert metricsmock.has_record(
+            INCR, "tecken.symbolicate_symbol_key", 1, ["cache:disk"]
+        )
+
+        # Invalidating it is noticed even though the file was written
+        # before.
+        invalidate_symbolicate_cache([symbol_key])
+        debug = symbolicate()
+        assert debug["downloads"]["count"] == 1
+        assert debug["cache_lookups"]["disk_hits"] == 0
+        assert not os.listdir(tmpdir)
+
+
+def test_symbolicate_pinned(
+    json_poster, clear_redis_store, botomock, metricsmock, settings
+):
+    settings.SYMBOLICATE_PINNED_MODULES = ["XUL.*"]
+    reload_downloader("https://s3.example.com/public/prefix/")
+    url = reverse("symbolicate:symbolicate_v5_json")
+    symbol_key = ("xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2")
+    job = {
+        "stacks": [[[0, 11_723_767], [1, 65802]]],
+        "memoryMap": [
+            list(symbol_key),
+            ["wntdll.pdb", "D74F79EB1F8D4A45ABCD2F476CCABACC2"],
+        ],
+    }
+
+    def symbolicate():
+        response = json_poster(url, {"jobs": [job]}, debug=True)
+        assert response.status_code == 200
+        result1, = response.json()["results"]
+        frame1, frame2 = result1["stacks"][0]
+        assert frame1["function"] == "XREMain::XRE_mainRun()"
+        assert frame2["function"] == "KiUserCallbackDispatcher"
+        return result1["debug"]
+
+    assert is_pinned(symbol_key)
+    assert not is_pinned(("wntdll.pdb", "D74F79EB1F8D4A45ABCD2F476CCABACC2"))
+
+    with botomock(default_mock_api_call):
+        debug = symbolicate()
+        assert debug["downloads"]["count"] == 2
+        pinned, = get_pinned_symbol_tables()
+        assert pinned["symbol"] == "/".join(symbol_key)
+        assert pinned["size"]
+        # It's not kept forever.
+        pinned_key = make_pinned_key(make_symbol_key_cache_key(symbol_key))
+        connection = get_redis_connection("pinned")
+        assert 0 < connection.ttl(pinned_key) <= settings.SYMBOLICATE_PINNED_TTL_SECONDS
+
+        # Pretend the Redis store LRU evicts everything.
+        store = caches["store"]
+        for table_key in store.iter_keys("*:packed"):
+            assert store.delete(table_key)
+        debug = symbolicate()
+        # Only the one that isn't pinned has to be downloaded again.
+        assert debug["downloads"]["count"] == 1
+        assert debug["cache_lookups"]["phases"]["pinned"]["count"] == 1
+        assert metricsmock.has_record(
+            INCR, "tecken.symbolicate_symbol_key", 1, ["cache:pinned"]
+        )
+
+        # Invalidating it unpins it too.
+        invalidate_symbolicate_cache([symbol_key])
+        assert not get_pinned_symbol_tables()
+
+
+def test_symbolicate_pinned_disabled(settings):
+    settings.SYMBOLICATE_PINNED_MODULES = ["XUL.*"]
+    # Without a Redis that never evicts, there's no point pinning anything.
+    settings.REDIS_PINNED_URL = ""
+    assert not is_pinned(("xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2"))
+    assert get_pinned_symbol_tables() == []
+
+
+def test_symbol_table_disk_cache(tmpdir):
+    disk_cache = SymbolTableDiskCache(tmpdir, max_bytes=150)
+    buffer1 = pack_symbol_map({1: "a" * 20})
+    buffer2 = pack_symbol_map({2: "b" * 20})
+    assert len(buffer1) == 52
+    assert disk_cache.get("one") is None
+    disk_cache.set("one", 3, buffer1)
+    generation, table = disk_cache.get("one")
+    assert generation == 3
+    assert table.lookup(1) == (1, "a" * 20)
+    # Make "one" look older than "two" which is about to be written.
+    os.utime(os.path.join(tmpdir, os.listdir(tmpdir)[0]), (1, 1))
+    disk_cache.set("two", 3, buffer2)
+    assert disk_cache.total_bytes == 120
+    # Only once the total crosses 'max_bytes' is the directory scanned.
+    with mock.patch("os.scandir", wraps=os.scandir) as scandir:
+        disk_cache.set("three", 3, buffer2)
+    assert scandir.call_count == 1
+    assert disk_cache.get("one") is None
+    assert disk_cache.get("two")
+    assert disk_cache.get("three")
+    assert len(os.listdir(tmpdir)) == 2
+    assert disk_cache.total_bytes == 120
+    assert disk_cache.delete("two")
+    assert not disk_cache.delete("two")
+    assert disk_cache.total_bytes == 60
+
+    # Not invalidated since.
+    assert SymbolTableDiskCache.is_valid(3, 5, None)
+    assert SymbolTableDiskCache.is_valid(3, 5, b"2")
+    # Invalidated after it was written.
+    assert not SymbolTableDiskCache.is_valid(3, 5, b"4")
+    # The sorted set of invalidations has been reset.
+    assert not SymbolTableDiskCache.is_valid(3, None, None)
+
+
+def test_symbol_table_cache():
+    symbol_table_cache = SymbolTableCache(max_bytes=110)
+    table1 = SymbolTable(pack_symbol_map({1: "a" * 20}))
+    table2 = SymbolTable(pack_symbol_map({2: "b" * 20}))
+    table3 = SymbolTable(pack_symbol_map({3: "c" * 20}))
+    assert table1.nbytes == 52
+    symbol_table_cache.set("one", table1)
+    symbol_table_cache.set("two", table2)
+    assert symbol_table_cache.total_bytes == 104
+    # Touch 'one' so that 'two' is the least recently used.
+    assert symbol_table_cache.get("one") is table1
+    symbol_table_cache.set("three", table3)
+    assert "two" not in symbol_table_cache
+    assert symbol_table_cache.total_bytes == 104
+    # Too big to ever fit.
+    symbol_table_cache.set("big", SymbolTable(pack_symbol_map({4: "d" * 100})))
+    assert "big" not in symbol_table_cache
+    assert len(symbol_table_cache) == 2
+
+    assert not symbol_table_cache.apply_invalidations(5, [], known_generation=None)
+    assert symbol_table_cache.generation == 5
+    assert symbol_table_cache.apply_invalidations(
+        6, [b"one", b"never-heard-of"], known_generation=5
+    ) == {"one"}
+    assert symbol_table_cache.generation == 6
+    assert symbol_table_cache.total_bytes == 52
+    # Redis store got flushed so we can't know what's been invalidated.
+    assert symbol_table_cache.apply_invalidations(None, [], known_generation=6) == {
+        "three"
+    }
+    assert symbol_table_cache.total_bytes == 0
+
+
+def test_record_invalidations(clear_redis_store):
+    connection = get_redis_connection("store")
+    assert record_invalidations(connection, []) is None
+    first = record_invalidations(connection, ["one", "two"])
+    assert first > MAX_INVALIDATION_GENERATIONS
+    assert record_invalidations(connection, ["two"]) == first + 1
+    assert connection.zscore(INVALIDATIONS_KEY, GENERATION_MEMBER) == first + 1
+    assert connection.zscore(INVALIDATIONS_KEY, "one") == first
+    assert connection.zscore(INVALIDATIONS_KEY, "two") == first + 1
+
+    # If the sorted set gets evicted, whoever was on it is now too far
+    # behind and drops everything.
+    cache = SymbolTableCache(max_bytes=1000)
+    cache.apply_invalidations(first + 1, [], known_generation=None)
+    cache.set("three", SymbolTable(pack_symbol_map({3: "c" * 20})))
+    connection.delete(INVALIDATIONS_KEY)
+    with mock.patch("time.time", return_value=time.time() + 1):
+        generation = record_invalidations(connection, ["four"])
+    assert cache.apply_invalidations(
+        generation, [b"four"], known_generation=first + 1
+    ) == {"three"}
+    assert not SymbolTableDiskCache.is_valid(first + 1, generation, None)
+
+
+def test_store_symbol_table_invalidated(clear_redis_store, metricsmock):
+    connection = get_redis_connection("store")
+    symbol_key = ("xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2")
+    cache_key = make_symbol_key_cache_key(symbol_key)
+    table_key = caches["store"].make_key(make_symbol_table_cache_key(cache_key))
+    buffer = pack_symbol_map({1: "one"})
+    generation = get_generation(connection)
+    assert generation == 0
+
+    # Uploaded again since it was downloaded.
+    invalidate_symbolicate_cache([symbol_key])
+    store_symbol_table(cache_key, buffer, generation=generation)
+    assert not connection.exists(table_key)
+    assert metricsmock.has_record(INCR, "tecken.symbolicate_store_invalidated", 1)
+
+    # But not since this download started.
+    store_symbol_table(cache_key, buffer, generation=get_generation(connection))
+    assert connection.get(table_key) == buffer
+    # And invalidating it deletes it.
+    invalidate_symbolicate_cache([symbol_key])
+    assert not connection.exists(table_key)
+
+
+def test_symbolicate_invalidated_while_downloading(
+    json_poster, clear_redis_store, botomock
+):
+    reload_downloader("https://s3.example.com/public/prefix/")
+    url = reverse("symbolicate:symbolicate_v5_json")
+    symbol_key = ("xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2")
+    job = {"stacks": [[[0, 11_723_767]]], "memoryMap": [list(symbol_key)]}
+    uploads = []
+
+    def mock_api_call(self, operation_name, api_params):
+        if not uploads:
+            # It's uploaded again while it's being downloaded.
+            uploads.append(symbol_key)
+            invalidate_symbolicate_cache([symbol_key])
+        return default_mock_api_call(self, operation_name, api_params)
+
+    with botomock(mock_api_call):
+        response = json_poster(url, {"jobs": [job]}, debug=True)
+        result, = response.json()["results"]
+        assert result["debug"]["downloads"]["count"] == 1
+        # What was downloaded might be out of date so it's not stored.
+        response = json_poster(url, {"jobs": [job]}, debug=True)
+        result, = response.json()["results"]
+        assert result["debug"]["downloads"]["count"] == 1
+        # But what was downloaded after it was uploaded is.
+        response = json_poster(url, {"jobs": [job]}, debug=True)
+        result, = response.json()["results"]
+        assert result["debug"]["downloads"]["count"] == 0
+
+
+def test_symbolicate_concurrent_downloads_with_timeout(
+    json_poster, clear_redis_store, botomock, settings
+):
+    settings.SYNCHRONOUS_SYMBOLICATE_DOWNLOADS = False
+    settings.SYMBOLICATE_DOWNLOAD_TIMEOUT_SECONDS = 0.5
+    reload_downloader("https://s3.example.com/public/prefix/")
+
+    slow_download_can_finish = threading.Event()
+
+    def mock_api_call(self, operation_name, api_params):
+        if api_params["Key"].endswith("wntdll.sym"):
+            # Pretend this one is huge and takes forever.
+            slow_download_can_finish.wait(5)
+        return default_mock_api_call(self, operation_name, api_params)
+
+    url = reverse("symbolicate:symbolicate_v4_json")
+    with botomock(mock_api_call):
+        response = json_poster(
+            url,
+            {
+                "stacks": [[[0, 11_723_767], [1, 65802]]],
+                "memoryMap": [
+                    ["xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2"],
+                    ["wntdll.pdb", "D74F79EB1F8D4A45ABCD2F476CCABACC2"],
+                ],
+                "version": 4,
+            },
+            debug=True,
+        )
+        result = response.json()
+        assert result["knownModules"] == [True, None]
+        assert result["symbolicatedStacks"] == [
+            ["XREMain::XRE_mainRun() (in xul.pdb)", "0x1010a (in wntdll.pdb)"]
+        ]
+        assert result["debug"]["downloads"]["count"] == 1
+        assert result["debug"]["downloads"]["timeouts"] == 1
+        assert result["debug"]["downloads"]["wall_time"] < 5
+
+        # The slow download carries on in the background and, once done,
+        # is stored in the Redis store.
+        slow_download_can_finish.set()
+        store = caches["store"]
+        cache_key = make_symbol_key_cache_key(
+            ("wntdll.pdb", "D74F79EB1F8D4A45ABCD2F476CCABACC2")
+        )
+        for i in range(50):
+            if store.has_key(make_symbol_table_cache_key(cache_key)):
+                break
+            time.sleep(0.1)
+        else:
+            raise AssertionError("Slow download never stored")
+
+
+def test_symbolicate_download_pool_busy(
+    json_poster, clear_redis_store, botomock, settings, metricsmock
+):
+    """Modules that are still queued for the download pool when the time is
+    up are reported as unknown too."""
+    settings.SYNCHRONOUS_SYMBOLICATE_DOWNLOADS = False
+    settings.SYMBOLICATE_DOWNLOAD_TIMEOUT_SECONDS = 0.5
+    reload_downloader("https://s3.example.com/public/prefix/")
+
+    slow_download_can_finish = threading.Event()
+    api_calls = []
+
+    def mock_api_call(self, operation_name, api_params):
+        api_calls.append(api_params)
+        if len(api_calls) == 1:
+            # Whichever is first takes the only thread there is.
+            slow_download_can_finish.wait(5)
+        return default_mock_api_call(self, operation_name, api_params)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    url = reverse("symbolicate:symbolicate_v4_json")
+    with botomock(mock_api_call), mock.patch(
+        "tecken.symbolicate.views.get_download_executor", return_value=executor
+    ):
+        t0 = time.time()
+        response = json_poster(
+            url,
+            {
+                "stacks": [[[0, 65802], [1, 11_723_767]]],
+                "memoryMap": [
+                    ["wntdll.pdb", "D74F79EB1F8D4A45ABCD2F476CCABACC2"],
+                    ["xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2"],
+                ],
+                "version": 4,
+            },
+            debug=True,
+        )
+        assert time.time() - t0 < 5
+        result = response.json()
+        assert result["knownModules"] == [None, None]
+        assert result["debug"]["downloads"]["timeouts"] == 2
+        assert metricsmock.has_record(INCR, "tecken.symbolicate_download_cancelled", 1)
+        slow_download_can_finish.set()
+        executor.shutdown()
+
+
+def test_symbolicate_waits_for_other_workers_download(
+    json_poster, clear_redis_store, botomock, metricsmock
+):
+    reload_downloader("https://s3.example.com/public/prefix/")
+    store = caches["store"]
+    redis_store_connection = get_redis_connection("store")
+    cache_key = make_symbol_key_cache_key(
+        ("xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2")
+    )
+    # Pretend some other web worker is downloading it right now.
+    lease_key = store.make_key(cache_key + ":lease")
+    redis_store_connection.set(lease_key, "other", px=5000)
+
+    def other_worker_finishes():
+        time.sleep(0.3)
+        redis_store_connection.set(
+            store.make_key(make_symbol_table_cache_key(cache_key)),
+            pack_symbol_map({0x26791A: "XREMain::XRE_mainRun()"}),
+        )
+        redis_store_connection.delete(lease_key)
+
+    thread = threading.Thread(target=other_worker_finishes)
+    thread.start()
+
+    def mock_api_call(self, operation_name, api_params):
+        raise AssertionError("Should not need to download anything")
+
+    url = reverse("symbolicate:symbolicate_v4_json")
+    with botomock(mock_api_call):
+        response = json_poster(
+            url,
+            {
+                "stacks": [[[0, 11_723_767]]],
+                "memoryMap": [["xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2"]],
+                "version": 4,
+            },
+            debug=True,
+        )
+    thread.join()
+    result = response.json()
+    assert result["knownModules"] == [True]
+    assert result["symbolicatedStacks"] == [["XREMain::XRE_mainRun() (in xul.pdb)"]]
+    assert result["debug"]["downloads"]["count"] == 0
+    assert result["debug"]["downloads"]["coalesced"] == 1
+    assert metricsmock.has_record(
+        INCR, "tecken.symbolicate_download_coalesced", 1, None
+    )
+
+
+def test_symbolicate_download_lease_expires(
+    json_poster, clear_redis_store, botomock, metricsmock
+):
+    reload_downloader("https://s3.example.com/public/prefix/")
+    store = caches["store"]
+    cache_key = make_symbol_key_cache_key(
+        ("xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2")
+    )
+    # Pretend some other web worker started to download it but died.
+    lease_key = store.make_key(cache_key + ":lease")
+    get_redis_connection("store").set(lease_key, "other", px=300)
+
+    url = reverse("symbolicate:symbolicate_v4_json")
+    with botomock(default_mock_api_call):
+        response = json_poster(
+            url,
+            {
+                "stacks": [[[0, 11_723_767]]],
+                "memoryMap": [["xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2"]],
+                "version": 4,
+            },
+            debug=True,
+        )
+    result = response.json()
+    assert result["knownModules"] == [True]
+    assert result["debug"]["downloads"]["count"] == 1
+    assert result["debug"]["downloads"]["coalesced"] == 0
+    assert metricsmock.has_record(
+        INCR, "tecken.symbolicate_download_lease_expired", 1, None
+    )
+    assert not get_redis_connection("store").exists(lease_key)
+
+
+def test_symbol_file_parser():
+    content = SAMPLE_SYMBOL_CONTENT["firefox.sym"].encode("utf-8")
+    content += (
+        b"\nFUNC m 3400 10 0 with_m_prefix\r\n"
+        b"PUBLIC m 3410 0 public with spaces  \r\n"
+        b"FUNC xyz 10 0 not_hex\n"
+        b"FUNC 3420 10 0\n"
+        b"PUBLIC eb0 0 main_public_wins\n"
+        b"  FUNC 3430 10 0 indented\n"
+        b"INLINE 0 1e 0 0 1550 6f\n"
+        b"FUNC 3440 10 0 no trailing newline"
+    )
+    expected = {
+        0x0: b"_mh_execute_header",
+        0xE70: b"start",
+        0xEB0: b"main_public_wins",
+        0x1550: b"Output",
+        0x1620: b"int SprintfLiteral<1024ul>(char (&) [1024ul], char const*, ...)",
+        0x3400: b"with_m_prefix",
+        0x3410: b"public with spaces",
+        0x3440: b"no trailing newline",
+    }
+    # Every possible chunk size, including ones that split lines in the
+    # middle of "\r\n" and in the middle of the "FUNC " prefix.
+    for chunk_size in (1, 2, 3, 7, 64, len(content)):
+        chunks = [
+            memoryview(content)[i : i + chunk_size]  # noqa
+            for i in range(0, len(content), chunk_size)
+        ]
+        offsets, names, size = parse_symbol_file(chunks)
+        assert size == len(content)
+        assert list(offsets) == sorted(offsets)
+        symbols = dict(zip(offsets, names))
+        for offset, name in expected.items():
+            assert symbols[offset] == name, chunk_size
+        assert 0x3420 not in symbols
+        assert 0x3430 not in symbols
+        assert len(symbols) == 30
+
+    offsets, names, size = parse_symbol_file([])
+    assert not offsets
+    assert not names
+    assert not size
+
+
+def test_symbol_file_parser_close_index():
+    content = SAMPLE_SYMBOL_CONTENT["firefox.sym"].encode("utf-8")
+    content += (
+        b"\nFUNC 3400 10 0 first\n"
+        b"FUNC 3400 10 0 last_func_wins\n"
+        b"PUBLIC 3410 0 first public\n"
+        b"FUNC 3410 10 0 func\n"
+        b"PUBLIC 3410 0 last public wins\n"
+        b"FUNC 20 10 0 out_of_order\n"
+    )
+    parser = SymbolFileParser()
+    parser.feed(content)
+    offsets, names = parser.close()
+    parser = SymbolFileParser()
+    parser.feed(content)
+    packed = pack_symbol_table_from_index(*parser.close_index())
+    assert packed == pack_symbol_table(offsets, names)
+    table = SymbolTable(packed)
+    assert table.lookup(0x3400) == (0x3400, "last_func_wins")
+    assert table.lookup(0x3410) == (0x3410, "last public wins")
+    assert table.lookup(0x20) == (0x20, "out_of_order")
+    assert list(table.offsets) == sorted(set(table.offsets))
+
+    parser = SymbolFileParser()
+    offsets, index, names = parser.close_index()
+    assert not offsets
+    assert list(index) == [0]
+    assert not names
+
+
+def test_pack_symbol_table_from_parser():
+    offsets, names, _ = parse_symbol_file(
+        [SAMPLE_SYMBOL_CONTENT["wntdll.sym"].encode("utf-8")]
+    )
+    table = SymbolTable(pack_symbol_table(offsets, names))
+    assert table.lookup(65802) == (0x100DC, "KiUserCallbackDispatcher")
+    # Not valid UTF-8 doesn't break the lookup.
+    table = SymbolTable(pack_symbol_table([10], [b"caf\xe9"]))
+    assert table.lookup(10) == (10, "caf�")
+
+
+def test_store_writer(metricsmock):
+    written = []
+    unblock = threading.Event()
+
+    def write(*args):
+        unblock.wait(5)
+        written.append(args)
+
+    after = []
+    writer = StoreWriter(write, max_pending_bytes=20)
+    writer.submit("a", "a", 1, nbytes=10, after=lambda: after.append("a"))
+    # Wait for the background thread to pick up 'a' so that the next
+    # ones are pending.
+    for _ in range(50):
+        if not len(writer):
+            break
+        time.sleep(0.01)
+    writer.submit("b", "b", 1, nbytes=15, after=lambda: after.append("b1"))
+    writer.submit("b", "b", 2, nbytes=10, after=lambda: after.append("b2"))
+    writer.submit("c", "c", 1, nbytes=10)
+    assert len(writer) == 2
+    assert writer.pending_bytes == 20
+    assert metricsmock.has_record(
+        INCR, "tecken.symbolicate_store_writer_deduplicated", 1, None
+    )
+    assert not written
+    assert not writer.flush(timeout=0.05)
+
+    unblock.set()
+    # This can never fit so it's written right away.
+    writer.submit("d", "d", 1, nbytes=21)
+    assert ("d", 1) in written
+    assert metricsmock.has_record(INCR, "tecken.symbolicate_store_writer_full", 1, None)
+
+    assert writer.flush(timeout=5)
+    assert sorted(written) == [("a", 1), ("b", 2), ("c", 1), ("d", 1)]
+    assert sorted(after) == ["a", "b1", "b2"]
+    assert writer.pending_bytes == 0
+
+
+def test_store_writer_synchronous():
+    def write(key):
+        raise ValueError(key)
+
+    after = []
+    writer = StoreWriter(write, max_pending_bytes=0)
+    # A failing write is logged and the callback is called anyway.
+    writer.submit("a", "a", after=lambda: after.append("a"))
+    assert after == ["a"]
+    assert writer.flush(timeout=0)
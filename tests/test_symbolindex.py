@@ -0,0 +1,237 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+from io import StringIO
+
+import mock
+import pytest
+from markus import GAUGE, INCR
+
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django_redis import get_redis_connection
+from redis.exceptions import ResponseError
+
+from tecken.base.symboldownloader import SymbolDownloader
+from tecken.base.symbolindex import (
+    BloomFilter,
+    get_error_rate,
+    get_parameters,
+    symbol_index,
+)
+from tecken.storage import StorageBucket
+from tecken.upload.models import FileUpload
+
+
+@pytest.fixture
+def noeviction():
+    # The Redis the tests use evicts keys.
+    with mock.patch(
+        "tecken.base.symbolindex.get_eviction_policy", return_value="noeviction"
+    ):
+        yield
+
+
+def test_bloom_filter():
+    size, hashes = get_parameters(1000, 0.01)
+    assert (size, hashes) == (9586, 7)
+    bloom_filter = BloomFilter(size, hashes)
+    keys = [f"v0/module{i}.pdb/ABC/module{i}.sym" for i in range(1000)]
+    for key in keys:
+        bloom_filter.add(key)
+    assert bloom_filter.count == 1000
+    assert all(key in bloom_filter for key in keys)
+    others = [f"v0/other{i}.pdb/ABC/other{i}.sym" for i in range(10000)]
+    false_positives = sum(key in bloom_filter for key in others)
+    assert false_positives < 200
+    assert get_error_rate(size, hashes, 1000) == pytest.approx(0.01, rel=0.1)
+
+
+@pytest.mark.django_db
+def test_build_and_lookup(
+    botomock, settings, clear_redis_store, metricsmock, noeviction
+):
+    settings.SYMBOL_INDEX_ENABLED = True
+    settings.SYMBOL_INDEX_CAPACITY = 1000
+    source = StorageBucket("https://s3.example.com/private/prefix/", file_prefix="v0")
+    # Uploaded while the bucket was being listed.
+    FileUpload.objects.create(
+        bucket_name="private", key="prefix/v0/late.pdb/ABC/late.sym", size=100
+    )
+
+    def mock_api_call(self, operation_name, api_params):
+        assert operation_name == "ListObjectsV2"
+        assert api_params["Prefix"] == "prefix/v0/"
+        if api_params.get("ContinuationToken"):
+            return {"Contents": [{"Key": "prefix/v0/nss3.pdb/ABC/nss3.sym"}]}
+        return {
+            "Contents": [{"Key": "prefix/v0/xul.pdb/ABC/xul.sym"}],
+            "IsTruncated": True,
+            "NextContinuationToken": "next",
+        }
+
+    # Without a filter anything might exist.
+    assert symbol_index.might_exist(source, "prefix/v0/xxx.pdb/ABC/xxx.sym")
+    assert not symbol_index.has_filter(source)
+
+    with botomock(mock_api_call):
+        assert symbol_index.build(source) == 3
+
+    symbol_index.clear()
+    assert symbol_index.has_filter(source)
+    assert symbol_index.might_exist(source, "prefix/v0/xul.pdb/ABC/xul.sym")
+    assert symbol_index.might_exist(source, "prefix/v0/nss3.pdb/ABC/nss3.sym")
+    assert symbol_index.might_exist(source, "prefix/v0/late.pdb/ABC/late.sym")
+    assert not symbol_index.might_exist(source, "prefix/v0/xxx.pdb/ABC/xxx.sym")
+    assert metricsmock.filter_records(INCR, "tecken.symbolindex_negative")
+    age, = metricsmock.filter_records(GAUGE, "tecken.symbolindex_age_seconds")
+    assert age[3] == ["index:private/prefix/v0"]
+
+    # Uploaded afterwards.
+    symbol_index.add("private", ["prefix/v0/xxx.pdb/ABC/xxx.sym"])
+    assert symbol_index.might_exist(source, "prefix/v0/xxx.pdb/ABC/xxx.sym")
+    # Not under the prefix of the filter, or in another bucket.
+    symbol_index.add("private", ["other/v0/yyy.pdb/ABC/yyy.sym"])
+    symbol_index.add("other", ["prefix/v0/yyy.pdb/ABC/yyy.sym"])
+    assert not symbol_index.might_exist(source, "prefix/v0/yyy.pdb/ABC/yyy.sym")
+    meta, = symbol_index.get_all_meta().values()
+    assert meta["count"] == 4
+
+    # Turned off, it's not used.
+    settings.SYMBOL_INDEX_ENABLED = False
+    assert symbol_index.might_exist(source, "prefix/v0/yyy.pdb/ABC/yyy.sym")
+
+
+@pytest.mark.django_db
+def test_exists_in_source_skipped(
+    botomock, settings, clear_redis_store, metricsmock, noeviction
+):
+    settings.SYMBOL_INDEX_ENABLED = True
+    settings.SYMBOL_INDEX_CAPACITY = 1000
+    mock_api_calls = []
+    key = "prefix/v0/xul.pdb/44E4EC8C2F41492B9369D6B9A059577C2/xul.sym"
+
+    def mock_api_call(self, operation_name, api_params):
+        mock_api_calls.append(api_params)
+        if api_params["Prefix"] == "prefix/v0/":
+            # The listing of the bucket.
+            return {"Contents": [{"Key": key}]}
+        if api_params["Prefix"].endswith("xul.sym"):
+            return {"Contents": [{"Key": api_params["Prefix"]}]}
+        return {}
+
+    downloader = SymbolDownloader(["https://s3.example.com/private/prefix/"])
+    with botomock(mock_api_call):
+        symbol_index.build(downloader.sources[0])
+        assert len(mock_api_calls) == 1
+        assert downloader.has_symbol(
+            "xul.pdb", "44E4EC8C2F41492B9369D6B9A059577C2", "xul.sym"
+        )
+        assert len(mock_api_calls) == 2
+        # S3 is never asked.
+        assert not downloader.has_symbol(
+            "xxx.pdb", "44E4EC8C2F41492B9369D6B9A059577C2", "xxx.sym"
+        )
+        assert len(mock_api_calls) == 2
+        # And that isn't remembered, in case the filter is discarded.
+        meta, = symbol_index.get_all_meta().values()
+        symbol_index.discard("private/prefix/v0", meta)
+        assert not downloader.has_symbol(
+            "xxx.pdb", "44E4EC8C2F41492B9369D6B9A059577C2", "xxx.sym"
+        )
+        assert len(mock_api_calls) == 3
+    assert not metricsmock.filter_records(INCR, "tecken.symbolindex_false_positive")
+
+
+@pytest.mark.django_db
+def test_build_symbol_index_command(botomock, settings, clear_redis_store, noeviction):
+    settings.SYMBOL_URLS = ["https://s3.example.com/public/prefix/?access=public"]
+    settings.UPLOAD_TRY_SYMBOLS_URL = "https://s3.example.com/try/prefix/"
+
+    def mock_api_call(self, operation_name, api_params):
+        assert operation_name == "ListObjectsV2"
+        return {"Contents": [{"Key": api_params["Prefix"] + "xul.pdb/A/xul.sym"}]}
+
+    output = StringIO()
+    with botomock(mock_api_call):
+        call_command("build-symbol-index", stdout=output)
+    assert "Built public/prefix/v0 (1 keys)" in output.getvalue()
+    assert "Built try/prefix/v0 (1 keys)" in output.getvalue()
+    assert set(symbol_index.get_all_meta()) == {"public/prefix/v0", "try/prefix/v0"}
+
+
+@pytest.mark.django_db
+def test_add_to_missing_filter(botomock, settings, clear_redis_store, noeviction):
+    settings.SYMBOL_INDEX_ENABLED = True
+    settings.SYMBOL_INDEX_CAPACITY = 1000
+    source = StorageBucket("https://s3.example.com/private/prefix/", file_prefix="v0")
+
+    def mock_api_call(self, operation_name, api_params):
+        return {"Contents": [{"Key": "prefix/v0/xul.pdb/ABC/xul.sym"}]}
+
+    # The bytes of the filter are written in chunks.
+    with botomock(mock_api_call), mock.patch(
+        "tecken.symbolicate.utils.STORE_CHUNK_SIZE", 10
+    ):
+        symbol_index.build(source)
+    meta, = symbol_index.get_all_meta().values()
+    bits_key = caches["pinned"].make_key(
+        f"symbolindex:private/prefix/v0:{meta['size']}:{meta['hashes']}"
+    )
+    connection = get_redis_connection("pinned")
+    assert len(connection.get(bits_key)) == (meta["size"] + 7) // 8
+    assert symbol_index.might_exist(source, "prefix/v0/xul.pdb/ABC/xul.sym")
+
+    # E.g. evicted. Adding to it doesn't make a filter of only those keys.
+    connection.delete(bits_key)
+    symbol_index.add("private", ["prefix/v0/new.pdb/ABC/new.sym"])
+    assert not connection.exists(bits_key)
+    meta, = symbol_index.get_all_meta().values()
+    assert meta["count"] == 1
+
+
+@pytest.mark.django_db
+def test_add_failing(botomock, settings, clear_redis_store, metricsmock, noeviction):
+    settings.SYMBOL_INDEX_ENABLED = True
+    settings.SYMBOL_INDEX_CAPACITY = 1000
+    source = StorageBucket("https://s3.example.com/private/prefix/", file_prefix="v0")
+
+    def mock_api_call(self, operation_name, api_params):
+        return {"Contents": [{"Key": "prefix/v0/xul.pdb/ABC/xul.sym"}]}
+
+    with botomock(mock_api_call):
+        symbol_index.build(source)
+    assert not symbol_index.might_exist(source, "prefix/v0/new.pdb/ABC/new.sym")
+
+    connection = get_redis_connection("pinned")
+    with mock.patch.object(
+        type(connection), "transaction", side_effect=ResponseError("OOM")
+    ):
+        symbol_index.add("private", ["prefix/v0/new.pdb/ABC/new.sym"])
+    # Without it, the filter would say it doesn't exist. So it's gone.
+    assert not symbol_index.get_all_meta()
+    assert not symbol_index.has_filter(source)
+    assert symbol_index.might_exist(source, "prefix/v0/new.pdb/ABC/new.sym")
+    assert metricsmock.filter_records(INCR, "tecken.symbolindex_discarded")
+
+
+@pytest.mark.django_db
+def test_evicting_redis_not_used(botomock, settings, clear_redis_store):
+    settings.SYMBOL_INDEX_ENABLED = True
+    source = StorageBucket("https://s3.example.com/private/prefix/", file_prefix="v0")
+    with mock.patch(
+        "tecken.base.symbolindex.get_eviction_policy", return_value="allkeys-lru"
+    ), mock.patch("tecken.base.symbolindex.logger.warning") as mocked_warning:
+        assert not symbol_index.is_usable()
+        assert not symbol_index.has_filter(source)
+        assert symbol_index.might_exist(source, "prefix/v0/xxx.pdb/ABC/xxx.sym")
+        # Only once.
+        warning, = mocked_warning.call_args_list
+        assert "maxmemory-policy noeviction" in warning[0][0]
+        symbol_index.add("private", ["prefix/v0/xxx.pdb/ABC/xxx.sym"])
+    assert not symbol_index.get_all_meta()
+
+    with pytest.raises(CommandError):
+        call_command("build-symbol-index")
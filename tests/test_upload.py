@@ -11,10 +11,12 @@ from botocore.exceptions import ClientError
 from requests.exceptions import ConnectionError, RetryError
 from google.api_core.exceptions import BadRequest as google_BadRequest
 
+from django.core.cache import caches
 from django.urls import reverse
 from django.contrib.auth.models import Permission, User
 from django.core.exceptions import ImproperlyConfigured
 from django.utils import timezone
+from django_redis import get_redis_connection
 
 from tecken.tokens.models import Token
 from tecken.upload.models import Upload, FileUpload, UploadsCreated
@@ -30,7 +32,15 @@ from tecken.upload.utils import (
     dump_and_extract,
     key_existing,
     should_compressed_key,
+    should_upload_sidecar,
     get_key_content_type,
+    pack_symbol_file,
+    upload_symbol_sidecar,
+)
+from tecken.symbolicate.symboltable import SymbolTable
+from tecken.symbolicate.utils import (
+    make_symbol_key_cache_key,
+    make_symbol_table_cache_key,
 )
 from tecken.upload.tasks import update_uploads_created_task
 
@@ -100,6 +110,42 @@ def test_get_key_content_type(settings):
     assert get_key_content_type("foo.HTML") == "text/html"
 
 
+def test_should_upload_sidecar(settings):
+    settings.ENABLE_SYMBOL_SIDECARS = True
+    assert should_upload_sidecar("xul.pdb/ABC/xul.sym")
+    assert should_upload_sidecar("xul.pdb/ABC/xul.SYM")
+    assert not should_upload_sidecar("xul.pdb/ABC/xul.pd_")
+    settings.ENABLE_SYMBOL_SIDECARS = False
+    assert not should_upload_sidecar("xul.pdb/ABC/xul.sym")
+
+
+def test_upload_symbol_sidecar(tmpdir):
+    file_path = os.path.join(tmpdir, "xul.sym")
+    with open(file_path, "wb") as f:
+        f.write(
+            b"MODULE windows x86 ABC xul.pdb\n"
+            b"FUNC 1a 2 0 foo()\n"
+            b"1a 1 10 1\n"
+            b"PUBLIC 10 0 bar\n"
+        )
+
+    uploaded = []
+
+    class FakeS3Client:
+        def put_object(self, **kwargs):
+            uploaded.append(kwargs)
+
+    symbol_table = pack_symbol_file(file_path)
+    upload_symbol_sidecar(FakeS3Client(), "private", "v0/xul.sym", symbol_table)
+    sidecar, = uploaded
+    assert sidecar["Bucket"] == "private"
+    assert sidecar["Key"] == "v0/xul.sym.packed"
+    assert sidecar["ContentEncoding"] == "gzip"
+    symbol_table = SymbolTable(gzip.decompress(sidecar["Body"]))
+    assert symbol_table.lookup(0x10) == (0x10, "bar")
+    assert symbol_table.lookup(0x1B) == (0x1A, "foo()")
+
+
 @pytest.mark.django_db
 def test_upload_archive_happy_path(
     client,
@@ -407,6 +453,55 @@ def test_upload_archive_with_ignorable_files(
     assert FileUpload.objects.all().count() == 2
 
 
+@pytest.mark.django_db
+def test_upload_archive_warm_symbolicate_cache(
+    client,
+    gcsmock,
+    fakeuser,
+    clear_redis_store,
+    upload_mock_invalidate_symbolicate_cache,
+    upload_mock_update_uploads_created_task,
+    settings,
+):
+    settings.WARM_SYMBOLICATE_CACHE_ON_UPLOAD = True
+
+    token = Token.objects.create(user=fakeuser)
+    permission, = Permission.objects.filter(codename="upload_symbols")
+    token.permissions.add(permission)
+    url = reverse("upload:upload_archive")
+
+    mock_bucket = gcsmock.MockBucket()
+    gcsmock.get_bucket = lambda name: mock_bucket
+    mock_bucket.get_blob = lambda key: None
+
+    def mocked_create_blob(key):
+        blob = gcsmock.MockBlob(key)
+        blob.upload_from_file = lambda file: None
+        return blob
+
+    mock_bucket.blob = mocked_create_blob
+
+    symbol_key = ("xpcshell.dbg", "A7D6F1BB18CD4CB48")
+    cache_key = make_symbol_key_cache_key(symbol_key)
+    store = caches["store"]
+    # Pretend some old symbol table of it is stored already.
+    store.set(make_symbol_table_cache_key(cache_key), b"old")
+
+    with open(ZIP_FILE, "rb") as f:
+        response = client.post(url, {"file.zip": f}, HTTP_AUTH_TOKEN=token.key)
+        assert response.status_code == 201
+
+    # The .sym file didn't need to be invalidated. Only the other file.
+    delay_arguments, = upload_mock_invalidate_symbolicate_cache.all_delay_arguments
+    assert delay_arguments == (([("flag", "deadbeef")],), {})
+
+    # Instead, the new symbol table is already in the store.
+    table_key = store.make_key(make_symbol_table_cache_key(cache_key))
+    buffer = get_redis_connection("store").get(table_key)
+    symbol_table = SymbolTable(buffer)
+    assert len(symbol_table)
+
+
 @pytest.mark.django_db
 def test_upload_archive_happy_path_s3(
     client,
@@ -1723,6 +1818,77 @@ def test_upload_archive_with_cache_invalidation(
         assert len(lookups) == 3
 
 
+@pytest.mark.django_db
+def test_upload_archive_with_sidecar_cache_invalidation(
+    client,
+    gcsmock,
+    fakeuser,
+    settings,
+    upload_mock_invalidate_symbolicate_cache,
+    upload_mock_update_uploads_created_task,
+):
+    settings.ENABLE_SYMBOL_SIDECARS = True
+    settings.SYMBOL_URLS = ["https://storage.googleapis.example.com/mybucket"]
+    settings.UPLOAD_DEFAULT_URL = "https://storage.googleapis.example.com/mybucket"
+    downloader = SymbolDownloader(settings.SYMBOL_URLS)
+    utils.downloader = downloader
+
+    token = Token.objects.create(user=fakeuser)
+    permission, = Permission.objects.filter(codename="upload_symbols")
+    token.permissions.add(permission)
+    url = reverse("upload:upload_archive")
+
+    sidecar_key = "v0/xpcshell.dbg/A7D6F1BB18CD4CB48/xpcshell.sym.packed"
+    uploaded = []
+    mock_bucket = gcsmock.MockBucket()
+
+    def mock_get_bucket(bucket_name):
+        return mock_bucket
+
+    gcsmock.get_bucket = mock_get_bucket
+
+    def mock_get_blob(key):
+        if key == "v0/flag/deadbeef/flag.jpeg":
+            return gcsmock.mock_blob_factory(key, size=1000)
+        if key == "v0/xpcshell.dbg/A7D6F1BB18CD4CB48/xpcshell.sym":
+            return None
+        if key == sidecar_key:
+            if key in uploaded:
+                return gcsmock.mock_blob_factory(key, size=100)
+            return None
+        raise NotImplementedError(key)
+
+    mock_bucket.get_blob = mock_get_blob
+
+    def mocked_create_blob(key):
+        blob = gcsmock.MockBlob(key)
+
+        def mock_upload_from_file(file):
+            uploaded.append(key)
+
+        def mock_upload_from_string(body):
+            uploaded.append(key)
+
+        blob.upload_from_file = mock_upload_from_file
+        blob.upload_from_string = mock_upload_from_string
+        return blob
+
+    mock_bucket.blob = mocked_create_blob
+
+    # The lookup of the sidecar, which isn't there yet, is memoized.
+    assert not downloader.has_symbol(
+        "xpcshell.dbg", "A7D6F1BB18CD4CB48", "xpcshell.sym.packed"
+    )
+    with open(ZIP_FILE, "rb") as f:
+        response = client.post(url, {"file.zip": f}, HTTP_AUTH_TOKEN=token.key)
+    assert response.status_code == 201
+    assert sidecar_key in uploaded
+    # Uploading it invalidated that.
+    assert downloader.has_symbol(
+        "xpcshell.dbg", "A7D6F1BB18CD4CB48", "xpcshell.sym.packed"
+    )
+
+
 @pytest.mark.django_db
 def test_upload_archive_with_cache_invalidation_s3(
     client,